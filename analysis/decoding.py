@@ -0,0 +1,301 @@
+#!usr/bin/env python
+"""
+Leave-one-run-out decoding of the eye and the cued hemifield from the block patterns of an ROI
+
+Every stimulus block gives one sample: the average of its TRs (shifted by the hemodynamic lag) in every voxel of the
+ROI, after the drifts of the run are removed and each voxel is z-scored within the run. The classifier is a shrinkage
+ridge regression to +-1, which for two classes is a regularized linear discriminant. It has no intercept: the samples
+are centered on the training mean and classified by the sign of their prediction. The mean label of the training set
+would be a biased intercept, since the eye and the hemifield are fixed within a run. Every left-out run leaves its own
+class short in the training set, so that intercept would push every prediction towards the other class, and noise
+would decode far below chance.
+
+The folds are not fitted from scratch. The products of all the pairs of samples (their Gram matrix) are computed once,
+and the centered training statistics of every fold are blocks of it. A fold is then one solve the size of its training
+samples, whatever the number of voxels, and its test samples are projected through it once, so the predictions of any
+number of label sets (the true labels and all the permutations) are one matrix product per fold. The eye and the
+hemifield are fixed within a run, so the permutations shuffle the labels of the runs.
+
+Usage: python decoding.py [data directory] [label: eye or task_side] [ROI] [number of permutations]
+    [number of processes]
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from glm import read_events, TR
+from store import find_sessions, open_store
+
+LAG = 4.  # seconds between the blocks and the BOLD response
+
+
+def block_patterns(store, roi=None, part="stim", lag=LAG, tr=TR, n_drifts=3):
+    """
+    Samples of the blocks of a subject.
+
+    Parameters
+    ----------
+    store : VoxelStore
+    roi : str or list of str
+        voxels of the patterns (see VoxelStore.voxel_slice)
+    part : str
+        block part of the samples
+    lag : float
+        seconds the blocks are shifted by
+    tr : float
+    n_drifts : int
+        cosines removed from every run along with its mean
+
+    Returns
+    -------
+    tuple
+        (samples, voxels) patterns, the index of the run of every sample, and the events of the samples (with their
+        task_side and eye)
+    """
+    patterns, runs, events = [], [], []
+    for r, run in enumerate(store.runs):
+        data = np.asarray(store.get(roi, r), dtype=np.float64).T  # (TRs, voxels)
+        n_trs = len(data)
+
+        # remove the mean and the drifts, and z-score every voxel
+        t = np.arange(n_trs) / max(n_trs - 1, 1)
+        drifts = np.column_stack([np.ones(n_trs), np.cos(np.pi * np.outer(t, np.arange(1, n_drifts + 1)))])
+        data -= drifts @ np.linalg.lstsq(drifts, data, rcond=None)[0]
+        data /= np.where(data.std(axis=0) > 0, data.std(axis=0), 1)
+
+        # average of the TRs of every block as one matrix product
+        blocks = read_events(run["events"])
+        blocks = blocks[blocks["trial_type"] == part].reset_index(drop=True)
+        tr_times = np.arange(n_trs) * tr
+        start = blocks["onset"].to_numpy()[:, np.newaxis] + lag
+        avg = ((tr_times >= start) & (tr_times < start + blocks["duration"].to_numpy()[:, np.newaxis])).astype(float)
+        avg /= np.maximum(avg.sum(axis=1, keepdims=True), 1)
+
+        patterns.append(avg @ data)
+        runs.append(np.full(len(blocks), r))
+        events.append(blocks.assign(RUN=r))
+
+    return np.concatenate(patterns), np.concatenate(runs), pd.concat(events, ignore_index=True)
+
+
+def fold_projections(gram, runs, n_features, shrink=1.):
+    """
+    What every leave-one-run-out fold needs to predict its test samples from any labels.
+
+    The folds are blocks of the Gram matrix K = X X' of all the samples. The ridge weights of a fold in the dual form
+    are w = X_c' (K_c + l I)^-1 y, with the training samples X_c and their Gram matrix K_c centered on the training
+    mean, so the predictions of the test samples are P y with P = (X_test - mean) X_c' (K_c + l I)^-1. P is the same
+    for all the labels. There is no intercept (see the module docstring), so the class of a test sample is the sign of
+    its prediction.
+
+    Parameters
+    ----------
+    gram : np.ndarray
+        (..., samples, samples) Gram matrices, e.g. of many searchlights at once
+    runs : np.ndarray
+        run of every sample
+    n_features : int or np.ndarray
+        number of features of every Gram matrix (...)
+    shrink : float
+        ridge penalty l as a fraction of the mean variance of the features (the mean eigenvalue of their scatter)
+
+    Returns
+    -------
+    list of dict
+        run, test and training samples, and the (..., test samples, training samples) projection of every fold
+    """
+    n_features = np.asarray(n_features, dtype=float)[..., np.newaxis, np.newaxis]
+    folds = []
+    for run in np.unique(runs):
+        test, train = np.flatnonzero(runs == run), np.flatnonzero(runs != run)
+        k_train = gram[..., train[:, np.newaxis], train]
+        k_test = gram[..., test[:, np.newaxis], train]
+
+        # centering on the training mean from the sums of the blocks of K
+        row_means = k_train.mean(axis=-1)
+        grand_mean = row_means.mean(axis=-1)[..., np.newaxis, np.newaxis]
+        k_train = k_train - row_means[..., :, np.newaxis] - row_means[..., np.newaxis, :] + grand_mean
+        k_test = k_test - k_test.mean(axis=-1, keepdims=True) - row_means[..., np.newaxis, :] + grand_mean
+
+        penalty = shrink * np.trace(k_train, axis1=-2, axis2=-1)[..., np.newaxis, np.newaxis] / n_features
+        proj = np.linalg.solve(k_train + penalty * np.eye(len(train)), np.swapaxes(k_test, -1, -2))
+        folds.append({"run": run, "test": test, "train": train, "proj": np.swapaxes(proj, -1, -2)})
+    return folds
+
+
+def label_sets(labels, runs, n_perm=0, seed=None):
+    """
+    The true labels and permuted labels as +-1.
+
+    Parameters
+    ----------
+    labels : array_like
+        two classes
+    runs : np.ndarray
+        run of every sample
+    n_perm : int
+        number of permutations. Labels that are fixed within the runs are shuffled between the runs, other labels are
+        shuffled within the runs. With 4 runs of each eye there are only 70 ways to shuffle the runs, so the p-value
+        can't go below about 1/35 (a labeling and its mirror image are decoded the same), however many permutations
+        there are.
+    seed : int
+
+    Returns
+    -------
+    np.ndarray
+        (samples, 1 + n_perm), the true labels first
+    """
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    if len(classes) != 2:
+        raise ValueError(f"Decoding needs two classes, not {list(classes)}.")
+    y = np.where(labels == classes[1], 1., -1.)
+
+    rng = np.random.default_rng(seed)
+    run_ids, run_idx = np.unique(runs, return_inverse=True)
+    run_y = [np.unique(y[run_idx == r]) for r in range(len(run_ids))]
+    if all(len(values) == 1 for values in run_y):
+        perm_y = rng.permuted(np.tile(np.concatenate(run_y), (n_perm, 1)), axis=1)[:, run_idx]
+    else:
+        perm_y = np.tile(y, (n_perm, 1))
+        for r in range(len(run_ids)):
+            perm_y[:, run_idx == r] = rng.permuted(perm_y[:, run_idx == r], axis=1)
+    return np.column_stack([y, perm_y.T])
+
+
+def fold_accuracy(folds, y_all):
+    """
+    Cross-validated accuracy of every label set.
+
+    Parameters
+    ----------
+    folds : list of dict
+        from fold_projections
+    y_all : np.ndarray
+        (samples, label sets) from label_sets
+
+    Returns
+    -------
+    np.ndarray
+        (..., label sets)
+    """
+    correct = 0
+    for fold in folds:
+        pred = fold["proj"] @ y_all[fold["train"]]
+        correct = correct + (np.sign(pred) == y_all[fold["test"]]).sum(axis=-2)
+    return correct / len(y_all)
+
+
+def p_values(accuracy):
+    """Permutation p-values of (..., 1 + permutations) accuracies with the true labels first"""
+    n_perm = accuracy.shape[-1] - 1
+    return (1 + np.sum(accuracy[..., 1:] >= accuracy[..., :1], axis=-1)) / (1 + n_perm)
+
+
+def cross_validate(x, labels, runs, n_perm=0, shrink=1., seed=None):
+    """
+    Leave-one-run-out accuracy of the true labels and of permuted labels.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        (samples, features)
+    labels : array_like
+        two classes
+    runs : np.ndarray
+        run of every sample
+    n_perm : int
+        see label_sets
+    shrink : float
+        see fold_projections
+    seed : int
+
+    Returns
+    -------
+    dict
+        accuracy of the true labels, accuracies of the permutations, and the permutation p-value
+    """
+    y_all = label_sets(labels, runs, n_perm, seed)
+    accuracy = fold_accuracy(fold_projections(x @ x.T, runs, x.shape[1], shrink), y_all)
+    return {"accuracy": accuracy[0], "perm_accuracy": accuracy[1:], "p_value": p_values(accuracy)}
+
+
+def decode_subject(sub_dir, label="eye", roi=None, n_perm=1000, shrink=1., seed=None, ses=None):
+    """
+    Decodes a label from the block patterns of a session of a subject.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    label : str
+        column of the events: 'eye' or 'task_side' (the cued hemifield)
+    roi : str or list of str
+    n_perm : int
+    shrink : float
+    seed : int
+    ses : str
+        label of the session (see store.open_store)
+
+    Returns
+    -------
+    dict
+        subject, session, number of samples and voxels, and the results of cross_validate
+    """
+    x, runs, events = block_patterns(open_store(sub_dir, ses), roi)
+    results = cross_validate(x, events[label].to_numpy(), runs, n_perm, shrink, seed)
+    return {"SUBJECT": Path(sub_dir).name, "SESSION": ses, "N_SAMPLES": len(x), "N_VOXELS": x.shape[1], **results}
+
+
+def _decode_one(args):
+    sub_dir, kwargs = args
+    return decode_subject(sub_dir, **kwargs)
+
+
+def decode_tree(data_dir, label="eye", roi=None, n_perm=1000, n_jobs=None, seed=0, **kwargs):
+    """
+    Decodes a label in all the sessions under a data directory, one session per process.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+    label : str
+    roi : str or list of str
+    n_perm : int
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+    seed : int
+        seed of the permutations of the first session, the others count up from it
+    kwargs
+        passed to decode_subject
+
+    Returns
+    -------
+    tuple
+        (sessions table with the accuracies and p-values, (sessions, n_perm) permutation accuracies)
+    """
+    jobs = [(d, {"label": label, "roi": roi, "n_perm": n_perm, "seed": seed + s, "ses": ses, **kwargs})
+            for s, (d, ses) in enumerate(find_sessions(data_dir))]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(pool.map(_decode_one, jobs))
+
+    perm = np.array([res.pop("perm_accuracy") for res in results])
+    return pd.DataFrame(results).set_index(["SUBJECT", "SESSION"]), perm
+
+
+if __name__ == '__main__':
+
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    target = sys.argv[2] if len(sys.argv) > 2 else "eye"
+    roi_name = sys.argv[3] if len(sys.argv) > 3 else None
+    n_perms = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    n_procs = int(sys.argv[5]) if len(sys.argv) > 5 else None
+
+    table, _ = decode_tree(data_path, target, roi_name, n_perms, n_procs)
+    out_dir = data_path / "derivatives" / "decoding"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    table.to_csv(out_dir / f"decoding_label-{target}_roi-{roi_name or 'all'}.tsv", sep='\t')
+    print(table.round(3).to_string())
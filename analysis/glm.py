@@ -0,0 +1,261 @@
+#!usr/bin/env python
+"""
+Batched GLM of the fMRI runs
+
+The design matrix of a run is made once from its events.tsv (make_events.py): HRF-convolved blocks of every block
+part (cue, stim, fix) with the run's cued hemifield and eye, and a cosine basis for the slow drifts. The block parts
+cover the whole run, so together they take the place of the intercept (the wait for the first trigger before the run
+is a fixation block too). The matrix is factorized once (QR) and every voxel is fitted with the same factors: the
+time series are read from a voxel-major array (voxels x TRs) in chunks, so the memory doesn't grow with the number of
+voxels, and each chunk is a few matrix products.
+
+The time series come from the voxel store of each session (store.py).
+
+Usage: python glm.py [data directory] [number of processes]
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from hrf import block_regressors
+from store import find_sessions, open_store, session_name
+
+BLOCK_PARTS = ["cue", "stim", "fix"]
+TR = 2.
+PRE_RUN = 32.  # seconds of the wait for the first trigger that are modeled as fixation
+CONTRASTS = {  # block parts and their weights
+    "stim-fix": {"stim": 1, "fix": -1},
+    "cue-fix": {"cue": 1, "fix": -1}
+}
+
+
+def read_events(file_name):
+    """
+    Reads the events.tsv file of a run.
+
+    Parameters
+    ----------
+    file_name : str or Path
+
+    Returns
+    -------
+    pd.DataFrame
+        the events of older sessions, which have no trial_type, get the block parts in their order (cue, stim, fix)
+    """
+    events = pd.read_csv(file_name, sep='\t', dtype={"task_side": str, "eye": str})
+    if "trial_type" not in events:
+        events.insert(2, "trial_type", np.resize(BLOCK_PARTS, len(events)))
+    return events
+
+
+def design_matrix(events, n_trs, tr=TR, n_drifts=3):
+    """
+    Design matrix of a run.
+
+    Parameters
+    ----------
+    events : pd.DataFrame
+        from read_events
+    n_trs : int
+    tr : float
+    n_drifts : int
+        number of cosines for the slow drifts (the slowest have half a period to n_drifts / 2 periods per run)
+
+    Returns
+    -------
+    tuple
+        (n_trs, number of regressors) array, and the names of the regressors ('{block part}_{hemifield}_{eye}' for
+        the blocks, 'drift_{n}' for the cosines)
+    """
+    conditions, names = [], []
+    keys = events[["trial_type", "task_side", "eye"]].drop_duplicates()
+    keys = keys.assign(ORDER=keys["trial_type"].map(BLOCK_PARTS.index)).sort_values(["ORDER", "task_side", "eye"])
+    for part, hemi, eye in keys[["trial_type", "task_side", "eye"]].itertuples(index=False):
+        blocks = events[(events["trial_type"] == part) & (events["task_side"] == hemi) & (events["eye"] == eye)]
+        onsets, durations = blocks["onset"].to_numpy(), blocks["duration"].to_numpy()
+        if part == "fix" and (hemi, eye) == tuple(events[["task_side", "eye"]].iloc[0]):
+            onsets, durations = np.append(-PRE_RUN, onsets), np.append(PRE_RUN, durations)
+        conditions.append((onsets, durations))
+        names.append(f"{part}_{hemi}_{eye}")
+
+    t = np.arange(n_trs) / max(n_trs - 1, 1)
+    drifts = np.cos(np.pi * np.outer(t, np.arange(1, n_drifts + 1)))
+    names += [f"drift_{n + 1}" for n in range(n_drifts)]
+
+    return np.column_stack([block_regressors(conditions, n_trs, tr), drifts]), names
+
+
+def contrast_matrix(names, contrasts=None):
+    """
+    Weights of the regressors in every contrast.
+
+    Parameters
+    ----------
+    names : list of str
+        regressors of the design matrix
+    contrasts : dict
+        maps the name of every contrast to the weights of the block parts. A weight is shared by all the regressors
+        of its block part. Defaults to CONTRASTS.
+
+    Returns
+    -------
+    np.ndarray
+        (number of contrasts, number of regressors)
+    """
+    contrasts = CONTRASTS if contrasts is None else contrasts
+    parts = np.array([name.split('_')[0] for name in names])
+    weights = np.zeros((len(contrasts), len(names)))
+    for c, part_weights in enumerate(contrasts.values()):
+        for part, weight in part_weights.items():
+            weights[c, parts == part] = weight / max((parts == part).sum(), 1)
+    return weights
+
+
+def fit_glm(data, design, contrasts=None, chunk_size=20000, psc=True):
+    """
+    Fits the same design to every voxel with one factorization.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (voxels, TRs), e.g. a memory-mapped voxel-major array. Only chunk_size voxels are in memory at once.
+    design : np.ndarray
+        (TRs, regressors)
+    contrasts : np.ndarray
+        (contrasts, regressors) weights, e.g. from contrast_matrix. None has no t-maps.
+    chunk_size : int
+        voxels per chunk
+    psc : bool
+        scale every voxel to percent of its mean first, so the betas are in percent signal change
+
+    Returns
+    -------
+    dict
+        betas (regressors, voxels), t-maps (contrasts, voxels), residual variance (voxels), and the residual degrees
+        of freedom
+    """
+    n_voxels, n_trs = data.shape
+    q, r = np.linalg.qr(design)
+    r_inv = np.linalg.inv(r)
+    dof = n_trs - design.shape[1]
+
+    betas = np.empty((design.shape[1], n_voxels), dtype=np.float32)
+    resid_var = np.empty(n_voxels, dtype=np.float32)
+
+    for start in range(0, n_voxels, chunk_size):
+        y = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        if psc:
+            mean = y.mean(axis=1, keepdims=True)
+            y = np.divide(y, mean, out=np.full_like(y, np.nan), where=mean != 0) * 100
+
+        qty = y @ q  # (chunk, regressors)
+        betas[:, start:start + len(y)] = (qty @ r_inv.T).T
+        resid = y - qty @ q.T
+        resid_var[start:start + len(y)] = np.einsum('ij,ij->i', resid, resid) / dof
+
+    results = {"betas": betas, "resid_var": resid_var, "dof": dof}
+    if contrasts is not None:
+        contrasts = np.atleast_2d(contrasts)
+        # variance factor of every contrast: c (X'X)^-1 c' = |c R^-1|^2
+        var_factor = np.sum((contrasts @ r_inv) ** 2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results["t"] = ((contrasts @ betas) / np.sqrt(np.outer(var_factor, resid_var))).astype(np.float32)
+
+    return results
+
+
+def fit_run(data, events_file, contrasts=None, tr=TR, chunk_size=20000):
+    """
+    Fits the GLM of a run.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (voxels, TRs) time series of the run, e.g. VoxelStore.get
+    events_file : str or Path
+    contrasts : dict
+        see contrast_matrix
+    tr : float
+    chunk_size : int
+
+    Returns
+    -------
+    dict
+        the results of fit_glm, with the names of the regressors and the contrasts
+    """
+    design, names = design_matrix(read_events(events_file), data.shape[1], tr)
+    contrasts = CONTRASTS if contrasts is None else contrasts
+
+    results = fit_glm(data, design, contrast_matrix(names, contrasts), chunk_size)
+    results.update(names=names, contrast_names=list(contrasts))
+    return results
+
+
+def fit_subject(sub_dir, out_dir=None, roi=None, ses=None):
+    """
+    Fits every run of a session of a subject from its voxel store and saves the results as npz files.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    out_dir : str or Path
+        defaults to data/derivatives/glm
+    roi : str or list of str
+        the voxels to fit (see VoxelStore.voxel_slice). All the voxels of the store if None.
+    ses : str
+        label of the session (see store.open_store)
+
+    Returns
+    -------
+    list of Path
+        the results of the runs
+    """
+    sub_dir = Path(sub_dir)
+    out_dir = Path(out_dir) if out_dir is not None else sub_dir.parent / "derivatives" / "glm"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    store = open_store(sub_dir, ses)
+
+    saved = []
+    for r, run in enumerate(store.runs):
+        results = fit_run(store.get(roi, r), run["events"])
+        saved.append(out_dir / f"{run['name']}_glm.npz")
+        np.savez(saved[-1], roi=str(roi), **results)
+    return saved
+
+
+def _fit_one(session):
+    sub_dir, ses = session
+    return fit_subject(sub_dir, ses=ses)
+
+
+def fit_tree(data_dir, n_jobs=None):
+    """
+    Fits the runs of all the sessions under a data directory, one session per process.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict
+        maps every (subject directory, session) to its results files
+    """
+    sessions = find_sessions(data_dir)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return dict(zip(sessions, pool.map(_fit_one, sessions)))
+
+
+if __name__ == '__main__':
+
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    n_procs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    for (sub, ses), glms in fit_tree(data_path, n_procs).items():
+        print(f"{session_name(sub, ses)}: {len(glms)} runs")
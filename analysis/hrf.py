@@ -0,0 +1,73 @@
+#!usr/bin/env python
+"""
+Hemodynamic response and block regressors
+
+The blocks are made on a fine time grid (`oversampling` points per TR), convolved with the canonical double-gamma
+HRF of SPM in one FFT for all the conditions, and sampled at the start of every TR. Blocks can start before the run
+(negative onsets, up to the length of the HRF), e.g. the wait for the first trigger.
+"""
+import math
+
+import numpy as np
+
+
+def spm_hrf(tr, oversampling=16, length=32.):
+    """
+    Canonical double-gamma HRF (peak at 5 s, undershoot at 15 s with 1/6 of its size).
+
+    Parameters
+    ----------
+    tr : float
+        repetition time in seconds
+    oversampling : int
+        points per TR
+    length : float
+        seconds
+
+    Returns
+    -------
+    np.ndarray
+        sums to 1, so a long block reaches a plateau of 1
+    """
+    t = np.arange(0, length, tr / oversampling)
+    hrf = t ** 5 * np.exp(-t) / math.gamma(6) - t ** 15 * np.exp(-t) / math.gamma(16) / 6
+    return hrf / hrf.sum()
+
+
+def block_regressors(conditions, n_trs, tr, oversampling=16):
+    """
+    HRF-convolved boxcars of the conditions of a run.
+
+    Parameters
+    ----------
+    conditions : list of tuple
+        (onsets, durations) in seconds from the first TR of the blocks of every condition
+    n_trs : int
+        number of volumes
+    tr : float
+    oversampling : int
+
+    Returns
+    -------
+    np.ndarray
+        (n_trs, number of conditions)
+    """
+    dt = tr / oversampling
+    hrf = spm_hrf(tr, oversampling)
+    pad = len(hrf)  # fine points before the run
+    n_fine = pad + n_trs * oversampling
+
+    boxcars = np.zeros((n_fine, len(conditions)))
+    for c, (onsets, durations) in enumerate(conditions):
+        onsets = np.asarray(onsets, dtype=float)
+        starts = np.clip(np.round(onsets / dt).astype(int) + pad, 0, None)
+        stops = np.clip(np.round((onsets + durations) / dt).astype(int) + pad, 0, None)
+        # +1 at every start and -1 at every stop, summed up
+        np.add.at(boxcars[:, c], starts[starts < n_fine], 1)
+        np.add.at(boxcars[:, c], stops[stops < n_fine], -1)
+    boxcars = np.cumsum(boxcars, axis=0)
+
+    n_fft = 1 << int(np.ceil(np.log2(n_fine + len(hrf))))
+    conv = np.fft.irfft(np.fft.rfft(boxcars, n_fft, axis=0) * np.fft.rfft(hrf, n_fft)[:, np.newaxis], n_fft, axis=0)
+
+    return conv[pad:n_fine:oversampling]
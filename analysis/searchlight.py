@@ -0,0 +1,298 @@
+#!usr/bin/env python
+"""
+Searchlight decoding in the ROIs
+
+Every voxel of a mask (the ROIs of the voxel store, V1 by default) is the center of a ball of the mask voxels within a
+radius in mm, and the block patterns of the ball are decoded like decoding.py does for a whole ROI (leave-one-run-out,
+with the same shrinkage ridge classifier and permutations). The accuracy maps are saved as volumes, e.g. to compare
+the voxels along the physical and the illusory paths of the checkerboards.
+
+The neighbours of every center are found once per session and mask, and kept next to its store as a sparse (CSR)
+index: the neighbours of center i are indices[indptr[i]:indptr[i + 1]]. The searchlights are decoded in batches: the
+balls of a batch are padded with zeros to the largest one (which doesn't change their Gram matrices), so the Gram
+matrices and every fold of the whole batch are a few stacked matrix products and solves. The batches are spread over
+processes, which read the patterns, the index and the labels from shared memory instead of getting copies of them.
+
+Usage: python searchlight.py [data directory] [label: eye or task_side] [ROIs separated by commas] [radius in mm]
+    [number of permutations] [number of processes]
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+
+from decoding import block_patterns, fold_accuracy, fold_projections, label_sets, p_values
+from store import find_sessions, open_store, session_name
+
+RADIUS = 6.  # mm
+BATCH_SIZE = 256  # searchlights decoded at once
+
+_shared = {}  # arrays of the worker processes in shared memory
+
+
+def mask_name(roi):
+    """Name of a mask in file names ('all' for all the voxels of the store, ROIs joined by '+')"""
+    if roi is None:
+        return "all"
+    return roi if isinstance(roi, str) else "+".join(roi)
+
+
+def check_radius(radius, voxel_size):
+    """
+    Raises a ValueError if the radius is smaller than the voxels, where every ball would be its center alone.
+
+    Parameters
+    ----------
+    radius : float
+    voxel_size : array_like
+        mm in x, y and z
+    """
+    if radius < np.min(voxel_size):
+        raise ValueError(f"A radius of {radius:g} mm is smaller than the voxels ({np.min(voxel_size):g} mm), so every "
+                         f"searchlight would be a single voxel.")
+
+
+def build_neighbourhoods(voxels, shape, voxel_size=None, radius=RADIUS):
+    """
+    Sparse index of the neighbours of every voxel of a mask.
+
+    Parameters
+    ----------
+    voxels : np.ndarray
+        flat indices of the mask voxels in the volume
+    shape : tuple
+        shape of the volume
+    voxel_size : list of float
+        mm in x, y and z. The radius is in voxels if None.
+    radius : float
+
+    Returns
+    -------
+    tuple
+        indptr (voxels + 1) and indices (positions in voxels) of the neighbours of every voxel
+    """
+    voxel_size = np.ones(len(shape)) if voxel_size is None else np.asarray(voxel_size, dtype=float)
+    check_radius(radius, voxel_size)
+    lookup = np.full(int(np.prod(shape)), -1, dtype=np.int64)
+    lookup[voxels] = np.arange(len(voxels))
+    coords = np.column_stack(np.unravel_index(voxels, shape))
+
+    # offsets of the voxels within the radius
+    reach = np.floor(radius / voxel_size).astype(int)
+    offsets = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in reach], indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[np.linalg.norm(offsets * voxel_size, axis=1) <= radius]
+
+    neighbours = np.full((len(voxels), len(offsets)), -1, dtype=np.int64)
+    for o, offset in enumerate(offsets):
+        moved = coords + offset
+        inside = np.all((moved >= 0) & (moved < shape), axis=1)
+        neighbours[inside, o] = lookup[np.ravel_multi_index(moved[inside].T, shape)]
+
+    found = neighbours >= 0
+    indptr = np.concatenate([[0], np.cumsum(found.sum(axis=1))])
+    return indptr, neighbours[found]
+
+
+def neighbourhoods(store, roi=None, radius=RADIUS, rebuild=False):
+    """
+    Sparse neighbour index of a mask, from its file next to the store or built and saved there.
+
+    The file is built again when the voxels of the mask or their size changed. A radius smaller than the voxels is
+    rejected (see check_radius).
+
+    Parameters
+    ----------
+    store : VoxelStore
+    roi : str or list of str
+        the mask (see VoxelStore.voxel_slice)
+    radius : float
+        mm
+    rebuild : bool
+        build it again anyway
+
+    Returns
+    -------
+    tuple
+        indptr and indices (see build_neighbourhoods)
+    """
+    voxels = np.asarray(store.voxels[store.voxel_slice(roi)])
+    voxel_size = np.asarray(store.voxel_size if store.voxel_size is not None else np.ones(len(store.shape)))
+    check_radius(radius, voxel_size)
+    file_name = store.directory / f"searchlight_roi-{mask_name(roi)}_radius-{radius:g}.npz"
+
+    if not rebuild and file_name.exists():
+        cached = np.load(file_name)
+        if np.array_equal(cached["voxels"], voxels) and np.array_equal(cached["voxel_size"], voxel_size):
+            return cached["indptr"], cached["indices"]
+
+    indptr, indices = build_neighbourhoods(voxels, store.shape, store.voxel_size, radius)
+    np.savez(file_name, indptr=indptr, indices=indices, voxels=voxels, voxel_size=voxel_size, radius=radius)
+    return indptr, indices
+
+
+def decode_batch(x, indptr, indices, runs, y_all, start, stop, shrink=1.):
+    """
+    Decodes the searchlights of the centers start to stop at once.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        (samples, mask voxels) patterns
+    indptr, indices : np.ndarray
+        neighbour index of the mask
+    runs : np.ndarray
+        run of every sample
+    y_all : np.ndarray
+        (samples, label sets) from label_sets
+    start, stop : int
+    shrink : float
+
+    Returns
+    -------
+    np.ndarray
+        (searchlights, label sets) accuracies
+    """
+    sizes = np.diff(indptr[start:stop + 1])
+    position = np.arange(sizes.max())
+    used = position < sizes[:, np.newaxis]
+    columns = indices[np.where(used, indptr[start:stop, np.newaxis] + position, 0)]
+
+    balls = np.moveaxis(x[:, columns] * used, 0, 1)  # (searchlights, samples, largest ball)
+    gram = balls @ np.swapaxes(balls, 1, 2)
+    return fold_accuracy(fold_projections(gram, runs, sizes, shrink), y_all)
+
+
+def _share(arrays):
+    """Copies arrays into new shared memory blocks"""
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _attach(specs):
+    """Maps the shared arrays in a worker process"""
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = (block, np.ndarray(shape, dtype, buffer=block.buf))
+
+
+def _decode_shared(args):
+    start, stop, shrink = args
+    arrays = {name: array for name, (_, array) in _shared.items()}
+    return decode_batch(arrays["x"], arrays["indptr"], arrays["indices"], arrays["runs"], arrays["y_all"],
+                        start, stop, shrink)
+
+
+def searchlight(x, runs, labels, indptr, indices, n_perm=0, shrink=1., seed=None, batch_size=BATCH_SIZE,
+                n_jobs=None):
+    """
+    Leave-one-run-out accuracy of every searchlight.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        (samples, mask voxels) patterns
+    runs : np.ndarray
+        run of every sample
+    labels : array_like
+        two classes
+    indptr, indices : np.ndarray
+        neighbour index of the mask
+    n_perm : int
+        permutations, the same ones in every searchlight (see decoding.label_sets)
+    shrink : float
+    seed : int
+    batch_size : int
+        searchlights decoded at once
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs. 1 decodes in this process.
+
+    Returns
+    -------
+    np.ndarray
+        (mask voxels, 1 + n_perm) accuracies, the true labels first
+    """
+    y_all = label_sets(labels, runs, n_perm, seed)
+    batches = [(start, min(start + batch_size, len(indptr) - 1), shrink) for start in range(0, len(indptr) - 1,
+                                                                                            batch_size)]
+    if n_jobs == 1:
+        return np.concatenate([decode_batch(x, indptr, indices, runs, y_all, *batch) for batch in batches])
+
+    blocks, specs = _share({"x": np.ascontiguousarray(x), "indptr": indptr, "indices": indices, "runs": runs,
+                            "y_all": y_all})
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach, initargs=(specs,)) as pool:
+            return np.concatenate(list(pool.map(_decode_shared, batches)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def searchlight_subject(sub_dir, label="eye", roi=None, radius=RADIUS, n_perm=0, shrink=1., seed=None,
+                        n_jobs=None, out_dir=None, ses=None):
+    """
+    Searchlight maps of a session of a subject.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    label : str
+        column of the events: 'eye' or 'task_side'
+    roi : str or list of str
+        the mask
+    radius : float
+        mm
+    n_perm : int
+    shrink : float
+    seed : int
+    n_jobs : int
+    out_dir : str or Path
+        defaults to data/derivatives/searchlight
+    ses : str
+        label of the session (see store.open_store)
+
+    Returns
+    -------
+    Path
+        npz file with the accuracy and p-value volumes (NaN outside the mask) and the radius
+    """
+    sub_dir = Path(sub_dir)
+    out_dir = Path(out_dir) if out_dir is not None else sub_dir.parent / "derivatives" / "searchlight"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    store = open_store(sub_dir, ses)
+
+    x, runs, events = block_patterns(store, roi)
+    indptr, indices = neighbourhoods(store, roi, radius)
+    accuracy = searchlight(x, runs, events[label].to_numpy(), indptr, indices, n_perm, shrink, seed, n_jobs=n_jobs)
+
+    maps = {"accuracy": store.to_volume(accuracy[:, 0], roi)}
+    if n_perm:
+        maps["p_value"] = store.to_volume(p_values(accuracy), roi)
+    file_name = out_dir / f"{session_name(sub_dir, ses)}_label-{label}_roi-{mask_name(roi)}_searchlight.npz"
+    np.savez(file_name, radius=radius, **maps)
+    return file_name
+
+
+if __name__ == '__main__':
+
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    target = sys.argv[2] if len(sys.argv) > 2 else "eye"
+    rois = sys.argv[3].split(",") if len(sys.argv) > 3 else ["V1_L", "V1_R"]
+    size = float(sys.argv[4]) if len(sys.argv) > 4 else RADIUS
+    n_perms = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    n_procs = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+    # one session at a time, each with its searchlights spread over the processes
+    for sub, ses in find_sessions(data_path):
+        maps = np.load(searchlight_subject(sub, target, rois if len(rois) > 1 else rois[0], size, n_perms,
+                                           n_jobs=n_procs, ses=ses))
+        print(f"{session_name(sub, ses)}: mean accuracy {np.nanmean(maps['accuracy']):.3f}, "
+              f"best {np.nanmax(maps['accuracy']):.3f}")
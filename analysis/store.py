@@ -0,0 +1,369 @@
+#!usr/bin/env python
+"""
+Memory-mapped voxel time-series store of the fMRI runs
+
+The runs of a session of a subject (the bold .npy volumes in data/sub-XX/fmri with ses-XX in their names) are copied
+once into one voxel-major array (voxels x TRs of all the runs) in data/derivatives/store/sub-XX/ses-XX, so the
+sessions are never mixed. Runs without a session in their names (older data) make one store in
+data/derivatives/store/sub-XX. The voxels are sorted by ROI, so every ROI is a contiguous range of rows and every run
+a contiguous range of columns: reading the voxels of an ROI in a run is a slice of the memory map, without a copy, and
+only the pages that are used are read from the disk. The index (ROI ranges, runs and their events files, flat indices
+of the voxels in the volume, and the source files) is a json file next to it. The store is built again when one of
+its source files changes.
+
+The ROIs come from data/sub-XX/fmri/sub-XX_..._rois.npz (the one of the session if there is one) with a label volume
+('labels'), the names of the labels 1, 2, ... ('names'), and optionally a mask of the voxels to keep ('brain') and the
+size of the voxels in mm ('voxel_size'), like synthetic.py writes it.
+
+Usage: python store.py [data directory] [number of processes]
+"""
+import json
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+DATA_FILE = "bold.npy"
+VOXELS_FILE = "voxels.npy"
+SES_ENTITY = re.compile(r"_ses-([a-zA-Z0-9]+)_")
+
+
+def file_session(file_name):
+    """Label of the session in a BIDS file name (sub-XX_ses-01_... -> '01'), None if it has none"""
+    match = SES_ENTITY.search(Path(file_name).name)
+    return match.group(1) if match else None
+
+
+def store_dir(sub_dir, ses=None):
+    """Directory of the store of a session (data/sub-XX -> data/derivatives/store/sub-XX/ses-XX)"""
+    sub_dir = Path(sub_dir)
+    out_dir = sub_dir.parent / "derivatives" / "store" / sub_dir.name
+    return out_dir / f"ses-{ses}" if ses is not None else out_dir
+
+
+def session_name(sub_dir, ses=None):
+    """Subject and session in file names ('sub-XX_ses-XX', or 'sub-XX' without a session)"""
+    return f"{Path(sub_dir).name}_ses-{ses}" if ses is not None else Path(sub_dir).name
+
+
+def source_files(sub_dir, ses=None):
+    """
+    The files a store is made from.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    ses : str
+        label of the session. None for the runs without a session in their names.
+
+    Returns
+    -------
+    tuple
+        list of (bold file, events file) of the runs in order, and the ROI file (None if there isn't one)
+    """
+    runs = []
+    for bold in sorted(Path(sub_dir).glob("fmri/*_run-*_bold.npy")):
+        events = bold.with_name(bold.name.replace("_bold.npy", "_events.tsv"))
+        if file_session(bold) == ses and events.exists():
+            runs.append((bold, events))
+
+    # the ROIs of the session, or else the ones without a session
+    roi_files = sorted(Path(sub_dir).glob("fmri/*_rois.npz"))
+    roi_files = [f for f in roi_files if file_session(f) == ses] + [f for f in roi_files if file_session(f) is None]
+    return runs, roi_files[0] if roi_files else None
+
+
+def find_sessions(data_dir):
+    """
+    The sessions with runs under a data directory.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+
+    Returns
+    -------
+    list of tuple
+        (subject directory, label of the session) in order, the label is None for runs without a session
+    """
+    sessions = []
+    for sub_dir in sorted(Path(data_dir).glob("sub-*")):
+        labels = {file_session(bold) for bold in sub_dir.glob("fmri/*_run-*_bold.npy")}
+        sessions += [(sub_dir, ses) for ses in sorted(labels, key=lambda x: x or "")
+                     if source_files(sub_dir, ses)[0]]
+    return sessions
+
+
+def _stamps(runs, roi_file):
+    """Modification time and size of every source file"""
+    stamps = {}
+    for file_name in [f for run in runs for f in run] + ([roi_file] if roi_file is not None else []):
+        stat = Path(file_name).stat()
+        stamps[str(file_name)] = [stat.st_mtime_ns, stat.st_size]
+    return stamps
+
+
+def build_store(sub_dir, ses=None, out_dir=None, time_block=64):
+    """
+    Copies the runs of a session into a voxel-major store.
+
+    The volumes are read a block of TRs at a time (contiguous in the bold files) and written into the columns of
+    those TRs, so the memory is bounded by one block.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    ses : str
+        label of the session
+    out_dir : str or Path
+        defaults to store_dir(sub_dir, ses)
+    time_block : int
+        TRs read at once
+
+    Returns
+    -------
+    VoxelStore
+    """
+    sub_dir = Path(sub_dir)
+    out_dir = Path(out_dir) if out_dir is not None else store_dir(sub_dir, ses)
+    runs, roi_file = source_files(sub_dir, ses)
+    if not runs:
+        raise FileNotFoundError(f"No runs of {session_name(sub_dir, ses)} with bold and events files in "
+                                f"{sub_dir / 'fmri'}.")
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    first = np.load(runs[0][0], mmap_mode='r')
+    shape = first.shape[1:]
+    n_trs = [np.load(bold, mmap_mode='r').shape[0] for bold, _ in runs]
+
+    # voxels of every ROI in a row, then the rest of the kept voxels
+    labels = np.zeros(int(np.prod(shape)), dtype=np.int64)
+    keep = np.ones(len(labels), dtype=bool)
+    names = []
+    voxel_size = None
+    if roi_file is not None:
+        rois = np.load(roi_file)
+        labels = rois["labels"].ravel().astype(np.int64)
+        names = [str(name) for name in rois["names"]]
+        if "brain" in rois:
+            keep = rois["brain"].ravel() | (labels > 0)
+        if "voxel_size" in rois:
+            voxel_size = np.broadcast_to(rois["voxel_size"], (len(shape),)).astype(float).tolist()
+    order = np.argsort(np.where(labels > 0, labels, len(names) + 1), kind='stable')
+    voxels = order[keep[order]]
+    starts = np.concatenate([[0], np.cumsum(np.bincount(labels[voxels], minlength=len(names) + 1)[1:])])
+
+    data = np.lib.format.open_memmap(out_dir / DATA_FILE, mode='w+', dtype=first.dtype,
+                                     shape=(len(voxels), sum(n_trs)))
+    t_start = 0
+    for (bold_file, _), n in zip(runs, n_trs):
+        flat = np.load(bold_file, mmap_mode='r').reshape(n, -1)
+        for t in range(0, n, time_block):
+            block = np.asarray(flat[t:t + time_block])
+            data[:, t_start + t:t_start + t + len(block)] = block[:, voxels].T
+        t_start += n
+    data.flush()
+    del data
+    np.save(out_dir / VOXELS_FILE, voxels)
+
+    run_starts = np.concatenate([[0], np.cumsum(n_trs)]).tolist()
+    index = {
+        "shape": list(shape),
+        "voxel_size": voxel_size,
+        "n_voxels": int(len(voxels)),
+        "rois": {name: [int(starts[i]), int(starts[i + 1])] for i, name in enumerate(names)},
+        "runs": [
+            {
+                "name": bold.name.replace("_bold.npy", ""),
+                "events": str(events),
+                "start": run_starts[r],
+                "stop": run_starts[r + 1]
+            }
+            for r, (bold, events) in enumerate(runs)
+        ],
+        "sources": _stamps(runs, roi_file)
+    }
+    with open(out_dir / INDEX_FILE, 'w', encoding='utf8') as f:
+        json.dump(index, f, indent=1)
+
+    return VoxelStore(out_dir)
+
+
+def open_store(sub_dir, ses=None, rebuild=False):
+    """
+    Opens the store of a session, and builds it first if it is missing or one of its source files changed.
+
+    Parameters
+    ----------
+    sub_dir : str or Path
+        data/sub-XX
+    ses : str
+        label of the session, None for the runs without a session in their names
+    rebuild : bool
+        build it again anyway
+
+    Returns
+    -------
+    VoxelStore
+    """
+    out_dir = store_dir(sub_dir, ses)
+    if not rebuild and (out_dir / INDEX_FILE).exists():
+        store = VoxelStore(out_dir)
+        if _stamps(*source_files(sub_dir, ses)) == store.index["sources"]:
+            return store
+    return build_store(sub_dir, ses, out_dir)
+
+
+class VoxelStore:
+    """
+    Read-only view of the store of a session.
+
+    Parameters
+    ----------
+    directory : str or Path
+        the directory of the store (see store_dir)
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(self.directory / INDEX_FILE, encoding='utf8') as f:
+            self.index = json.load(f)
+        self.data = np.load(self.directory / DATA_FILE, mmap_mode='r')
+        self.voxels = np.load(self.directory / VOXELS_FILE, mmap_mode='r')
+        self.shape = tuple(self.index["shape"])
+        self.voxel_size = self.index["voxel_size"]  # mm in x, y and z, None if unknown
+        self.runs = self.index["runs"]
+        self.rois = {name: slice(*bounds) for name, bounds in self.index["rois"].items()}
+
+    def __len__(self):
+        return len(self.runs)
+
+    def voxel_slice(self, roi=None):
+        """
+        Rows of an ROI.
+
+        Parameters
+        ----------
+        roi : str or list of str
+            name of an ROI, or names of ROIs that are next to each other in the store. All the voxels if None.
+
+        Returns
+        -------
+        slice
+        """
+        if roi is None:
+            return slice(0, len(self.data))
+        if isinstance(roi, str):
+            return self.rois[roi]
+        slices = sorted((self.rois[name] for name in roi), key=lambda s: s.start)
+        if any(a.stop != b.start for a, b in zip(slices, slices[1:])):
+            raise ValueError(f"The ROIs {roi} aren't next to each other in the store, read them one by one.")
+        return slice(slices[0].start, slices[-1].stop)
+
+    def time_slice(self, run=None):
+        """
+        Columns of a run (index in self.runs), of consecutive runs (a slice), or of all of them (None).
+
+        Returns
+        -------
+        slice
+        """
+        if run is None:
+            return slice(0, self.data.shape[1])
+        if isinstance(run, slice):
+            runs = self.runs[run]
+            return slice(runs[0]["start"], runs[-1]["stop"])
+        return slice(self.runs[run]["start"], self.runs[run]["stop"])
+
+    def get(self, roi=None, run=None):
+        """
+        Time series of the voxels of an ROI in a run, without a copy.
+
+        Parameters
+        ----------
+        roi : str or list of str
+            see voxel_slice
+        run : int or slice
+            see time_slice
+
+        Returns
+        -------
+        np.memmap
+            (voxels, TRs) view of the store
+        """
+        return self.data[self.voxel_slice(roi), self.time_slice(run)]
+
+    def iter_chunks(self, roi=None, run=None, chunk_size=20000):
+        """
+        Streams the time series of an ROI in a run in chunks of voxels.
+
+        Yields
+        ------
+        tuple
+            (rows of the chunk in the ROI as a slice, (voxels, TRs) view of the chunk)
+        """
+        data = self.get(roi, run)
+        for start in range(0, len(data), chunk_size):
+            yield slice(start, min(start + chunk_size, len(data))), data[start:start + chunk_size]
+
+    def to_volume(self, values, roi=None, fill=np.nan):
+        """
+        Puts values of the voxels of an ROI (e.g. a t-map) back into the volume.
+
+        Parameters
+        ----------
+        values : np.ndarray
+            (..., voxels of the ROI)
+        roi : str or list of str
+        fill : float
+            value of the other voxels
+
+        Returns
+        -------
+        np.ndarray
+            (..., x, y, z)
+        """
+        values = np.asarray(values)
+        volume = np.full(values.shape[:-1] + (int(np.prod(self.shape)),), fill, dtype=np.result_type(values, fill))
+        volume[..., self.voxels[self.voxel_slice(roi)]] = values
+        return volume.reshape(values.shape[:-1] + self.shape)
+
+
+def _open_one(session):
+    return open_store(*session)
+
+
+def build_tree(data_dir, n_jobs=None):
+    """
+    Opens (and builds if needed) the stores of all the sessions under a data directory, one session per process.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict
+        maps every (subject directory, session) to the directory of its store
+    """
+    sessions = find_sessions(data_dir)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return dict(zip(sessions, [store.directory for store in pool.map(_open_one, sessions)]))
+
+
+if __name__ == '__main__':
+
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    n_procs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    for (sub, ses), directory in build_tree(data_path, n_procs).items():
+        store = VoxelStore(directory)
+        rois = ", ".join(f"{name} {s.stop - s.start}" for name, s in store.rois.items())
+        print(f"{session_name(sub, ses)}: {store.data.shape[0]} voxels ({rois}), {len(store)} runs, "
+              f"{store.data.shape[1]} TRs")
@@ -0,0 +1,325 @@
+#!usr/bin/env python
+"""
+Synthetic fMRI datasets with the design of run_scan.py, to test and benchmark the analysis without real scans
+
+Every subject gets the runs of one scan session (ses-01): the cued hemifield and the viewing eye are fixed within a
+run, the hemifields are counterbalanced within the runs of each eye, and every run has blocks of cue, stimulus and
+fixation.
+The BOLD signal of each run is made from
+
+- V1 of each hemisphere, where every voxel prefers one eye by a smooth random amount (the sampled ocular dominance
+  columns). The stimulus response is scaled up for the preferred eye and down for the other one, and attention adds
+  to the hemisphere opposite to the cued hemifield. The rest of the brain responds weakly to the stimulus.
+- block responses convolved with the canonical HRF (hrf.py)
+- noise: white (thermal) and AR(1) noise in every voxel, slow drifts, and a few shared fluctuations with smooth
+  spatial maps (physiology)
+
+The volumes are saved as memory-mapped .npy files (time, x, y, z) next to the events.tsv file of each run, in the
+same layout as the scan data (data/sub-XX/fmri), so every stage of the analysis can run on them. The ROIs (in the
+format store.py reads) and the true eye preferences are saved with each subject.
+
+Usage: python synthetic.py [number of subjects] [number of runs] [output directory] [number of processes]
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOTDIR / "fmri"))
+from mr_helpers import build_design  # noqa: E402
+from make_events import BIDS_HEADER, bids_prefix, write_sidecar  # noqa: E402
+from hrf import block_regressors  # noqa: E402
+
+# design of run_scan.py
+EXP = "DoubleDriftODC"
+PART = "fmri"
+TASK = "contrast_change"
+HEMIFIELDS = ["L", "R"]
+EYES = ["L", "R"]
+SESSION = "01"
+BLOCK_PARTS = ["cue", "stim", "fix"]
+PART_DURS = {"cue": 4, "stim": 11, "fix": 15}
+N_BLOCKS = 12
+N_RUNS = 8
+RUN_PER_COND = 2
+TR = 2.
+
+ROI_LABELS = {1: "V1_L", 2: "V1_R"}  # V1 of the left and right hemispheres
+TEMPLATE_BIDS = '{onset:.3f}\t{duration:.3f}\t{block_part}\t{hemifield}\t{eye}'
+
+
+def run_prefix(sub_id, data_dir, ses=SESSION):
+    """Path of the files of a session, without the run and the suffix (BIDS names, like make_events.py)"""
+    sub = f"sub-{sub_id:02d}"
+    return Path(data_dir) / sub / PART / bids_prefix(sub, TASK, ses)
+
+
+def bold_file(sub_id, run, data_dir, ses=SESSION):
+    """Memory-mapped volumes of a run"""
+    return Path(f"{run_prefix(sub_id, data_dir, ses)}_run-{run:02d}_bold.npy")
+
+
+def roi_file(sub_id, data_dir, ses=SESSION):
+    """ROI labels, their names, and the brain mask of a subject"""
+    return Path(f"{run_prefix(sub_id, data_dir, ses)}_rois.npz")
+
+
+def truth_file(sub_id, data_dir, ses=SESSION):
+    """True eye preferences of a subject"""
+    return Path(f"{run_prefix(sub_id, data_dir, ses)}_truth.npz")
+
+
+def make_runs(n_runs=N_RUNS, n_blocks=N_BLOCKS, init_eye=None, rng=None):
+    """
+    Runs of a scan session, as run_scan.py makes them.
+
+    Parameters
+    ----------
+    n_runs : int
+        the first n_runs of a session. With fewer than half of the runs, they are all with the initial eye.
+    n_blocks : int
+        blocks per run
+    init_eye : str
+        'Left' or 'Right'. Random if None.
+    rng : np.random.Generator
+
+    Returns
+    -------
+    list of dict
+        run number, cued hemifield, eye, and onsets, durations and block parts of the blocks
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    init_eye = init_eye or rng.choice(["Left", "Right"])
+
+    n_reps = max(RUN_PER_COND, -(-n_runs // (len(HEMIFIELDS) * len(EYES))))
+    run_order = build_design({"HEMIFIELD": HEMIFIELDS}, n_reps=n_reps, n_groups=len(EYES), rng=rng)
+    run_eyes = np.array(EYES if init_eye == "Left" else EYES[::-1])[run_order["GROUP"]]
+
+    durations = np.tile([PART_DURS[part] for part in BLOCK_PARTS], n_blocks).astype(float)
+    onsets = np.concatenate([[0], np.cumsum(durations)[:-1]])
+    return [
+        {
+            "RUN": run + 1,
+            "HEMIFIELD": str(run_order["HEMIFIELD"][run]),
+            "EYE": str(run_eyes[run]),
+            "ONSETS": onsets,
+            "DURATIONS": durations,
+            "BLOCK_PARTS": np.tile(BLOCK_PARTS, n_blocks)
+        }
+        for run in range(n_runs)
+    ]
+
+
+def write_events(run, file_name):
+    """
+    Writes the events.tsv file of a run and its sidecar like make_events.py does from the runtime log.
+
+    Parameters
+    ----------
+    run : dict
+        from make_runs
+    file_name : str or Path
+    """
+    with open(file_name, 'w', encoding='utf8') as f:
+        f.write(BIDS_HEADER + '\n')
+        for onset, duration, block_part in zip(run["ONSETS"], run["DURATIONS"], run["BLOCK_PARTS"]):
+            f.write(TEMPLATE_BIDS.format(onset=onset, duration=duration, block_part=block_part,
+                                         hemifield=run["HEMIFIELD"], eye=run["EYE"]) + '\n')
+    write_sidecar(file_name, TASK, PART, EXP)
+
+
+def smooth_field(shape, fwhm, rng):
+    """
+    Smooth random field with zero mean and unit sd.
+
+    Parameters
+    ----------
+    shape : tuple of int
+    fwhm : float
+        in voxels
+    rng : np.random.Generator
+
+    Returns
+    -------
+    np.ndarray
+    """
+    sigma = fwhm / np.sqrt(8 * np.log(2))
+    freqs = np.meshgrid(*[np.fft.fftfreq(n) for n in shape[:-1]], np.fft.rfftfreq(shape[-1]), indexing='ij')
+    gain = np.exp(-2 * (np.pi * sigma) ** 2 * sum(f ** 2 for f in freqs))
+    field = np.fft.irfftn(np.fft.rfftn(rng.standard_normal(shape)) * gain, shape, axes=range(len(shape)))
+    return (field - field.mean()) / field.std()
+
+
+def make_anatomy(shape, rng):
+    """
+    Brain mask, V1 of each hemisphere, and a smooth baseline intensity.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (x, y, z) with y going from the back to the front of the head
+    rng : np.random.Generator
+
+    Returns
+    -------
+    tuple of np.ndarray
+        brain mask (bool), ROI labels (0 outside, then the keys of ROI_LABELS), and baseline intensity
+    """
+    x, y, z = np.meshgrid(*[(np.arange(n) + .5) / n * 2 - 1 for n in shape], indexing='ij')
+    brain = x ** 2 / .85 ** 2 + y ** 2 / .9 ** 2 + z ** 2 / .8 ** 2 <= 1
+
+    # a band of cortex at the back of the head, around the calcarine sulcus of each hemisphere
+    v1 = brain & (y < -.45) & (np.abs(x) > .06) & (np.abs(x) < .45) & (np.abs(z + .1) < .3)
+    rois = np.zeros(shape, dtype=np.uint8)
+    rois[v1 & (x < 0)] = 1
+    rois[v1 & (x > 0)] = 2
+
+    baseline = 1000 * (1 + .1 * smooth_field(shape, 8, rng))
+    return brain, rois, baseline
+
+
+def generate_subject(sub_id, data_dir, n_runs=N_RUNS, n_blocks=N_BLOCKS, shape=(40, 40, 20), voxel_size=2.5,
+                     odc_gain=.15, attention_gain=.5, stim_psc=2., cue_psc=.5, noise_psc=1., ar_coef=.4,
+                     drift_psc=1., n_physio=4, seed=None):
+    """
+    Makes the runs of a synthetic subject.
+
+    Parameters
+    ----------
+    sub_id : int
+    data_dir : str or Path
+        the files go to data_dir/sub-XX/fmri
+    n_runs : int
+    n_blocks : int
+        blocks per run
+    shape : tuple of int
+        voxels in x (left to right), y (back to front) and z (bottom to top)
+    voxel_size : float
+        in mm
+    odc_gain : float
+        change of the stimulus response of a V1 voxel per sd of its eye preference, as a fraction of the response
+    attention_gain : float
+        percent signal change added to the V1 opposite to the cued hemifield
+    stim_psc : float
+        response of V1 to the stimulus in percent signal change
+    cue_psc : float
+        response of V1 to the cue
+    noise_psc : float
+        sd of the thermal and the AR(1) noise, each
+    ar_coef : float
+        lag-1 autocorrelation of the AR(1) noise
+    drift_psc : float
+        sd of the slow drifts
+    n_physio : int
+        number of shared fluctuations
+    seed : int
+
+    Returns
+    -------
+    list of Path
+        the bold files
+    """
+    rng = np.random.default_rng(seed)
+    prefix = run_prefix(sub_id, data_dir)
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+
+    brain, rois, baseline = make_anatomy(shape, rng)
+    eye_pref = smooth_field(shape, 1.5, rng)  # positive prefers the left eye
+    eye_pref[~brain] = 0
+    np.savez(roi_file(sub_id, data_dir), labels=rois, names=[ROI_LABELS[k] for k in sorted(ROI_LABELS)], brain=brain,
+             voxel_size=voxel_size)
+    np.savez(truth_file(sub_id, data_dir), eye_pref=eye_pref, voxel_size=voxel_size, tr=TR)
+
+    # response of every brain voxel to the stimulus, without eye and attention, and to the cue
+    in_brain = np.flatnonzero(brain)
+    roi = rois.ravel()[in_brain]
+    stim_amp = np.where(roi > 0, stim_psc, stim_psc * .2 * rng.random(len(in_brain)))
+    cue_amp = np.where(roi > 0, cue_psc, 0.)
+    pref = eye_pref.ravel()[in_brain]
+    s0 = baseline.ravel()[in_brain].astype(np.float32)
+    physio_maps = np.stack([smooth_field(shape, 6, rng).ravel()[in_brain] for _ in range(n_physio)]) * noise_psc / 2
+
+    runs = make_runs(n_runs, n_blocks, rng=rng)
+    n_trs = int(np.ceil((runs[0]["ONSETS"][-1] + runs[0]["DURATIONS"][-1]) / TR))
+    t = np.arange(n_trs) * TR
+    files = []
+    for run in runs:
+        parts = run["BLOCK_PARTS"]
+        regs = block_regressors(
+            [(run["ONSETS"][parts == part], run["DURATIONS"][parts == part]) for part in ("cue", "stim")], n_trs, TR
+        )
+
+        # the response is bigger for the preferred eye, and attention adds to the V1 opposite to the cued side
+        eye_sign = 1 if run["EYE"] == "L" else -1
+        attended = 2 if run["HEMIFIELD"] == "L" else 1
+        stim = stim_amp * (1 + odc_gain * eye_sign * pref * (roi > 0)) + attention_gain * (roi == attended)
+        psc = regs[:, :1] * cue_amp + regs[:, 1:] * stim
+
+        # noise
+        psc += rng.standard_normal(psc.shape) * noise_psc
+        ar = rng.standard_normal(psc.shape) * (noise_psc * np.sqrt(1 - ar_coef ** 2))
+        for tr in range(1, n_trs):
+            ar[tr] += ar_coef * ar[tr - 1]
+        psc += ar
+        drifts = np.cos(np.pi * np.outer(t / t[-1], np.arange(1, 4)))  # slowest cosines over the run
+        psc += drifts @ rng.standard_normal((3, len(in_brain))) * (drift_psc / np.sqrt(3))
+        physio = rng.standard_normal((n_trs, n_physio))
+        psc += physio @ physio_maps
+
+        # write the volumes, with a little noise outside the brain
+        files.append(bold_file(sub_id, run["RUN"], data_dir))
+        bold = np.lib.format.open_memmap(files[-1], mode='w+', dtype=np.float32, shape=(n_trs, *shape))
+        flat = bold.reshape(n_trs, -1)
+        flat[:] = np.abs(rng.standard_normal(flat.shape, dtype=np.float32)) * 10
+        flat[:, in_brain] = s0 * (1 + psc.astype(np.float32) / 100)
+        bold.flush()
+        del bold, flat
+
+        write_events(run, f"{prefix}_run-{run['RUN']:02d}_events.tsv")
+
+    return files
+
+
+def _generate_one(args):
+    sub_id, data_dir, kwargs = args
+    return generate_subject(sub_id, data_dir, **kwargs)
+
+
+def generate_cohort(n_subjects, data_dir, n_jobs=None, seed=0, **kwargs):
+    """
+    Makes the synthetic subjects sub-01, sub-02, ..., one subject per process.
+
+    Parameters
+    ----------
+    n_subjects : int
+    data_dir : str or Path
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+    seed : int
+        seed of the first subject, the others count up from it
+    kwargs
+        passed to generate_subject
+
+    Returns
+    -------
+    dict
+        maps the subjects to their bold files
+    """
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    jobs = [(s + 1, data_dir, {**kwargs, "seed": seed + s}) for s in range(n_subjects)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return dict(zip([s + 1 for s in range(n_subjects)], pool.map(_generate_one, jobs)))
+
+
+if __name__ == '__main__':
+
+    n_subs = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    n_run = int(sys.argv[2]) if len(sys.argv) > 2 else N_RUNS
+    out_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else ROOTDIR / "synthetic" / "data"
+    n_procs = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    for sub, bolds in generate_cohort(n_subs, out_dir, n_procs, n_runs=n_run).items():
+        size = sum(f.stat().st_size for f in bolds) / 2 ** 20
+        print(f"sub-{sub:02d}: {len(bolds)} runs, {size:.0f} MB -> {bolds[0].parent}")
@@ -0,0 +1,119 @@
+#!usr/bin/env python
+"""
+Adaptive stopping of the prescan conditions
+
+The running estimate and its standard error are kept for the reported orientation and length of every condition
+(speeds x quadrant). Once both are precise enough, the condition is done and its remaining trials are skipped, so the
+session only goes on with the conditions that still need trials. Orientations are axial, so they are tracked with the
+doubled angles like in sub_path.py.
+"""
+import numpy as np
+
+
+class AdaptiveSampler:
+    """
+    Decides which conditions still need trials.
+
+    Parameters
+    ----------
+    conditions : list of tuple
+        keys of the conditions, e.g. (internal speed, external speed, quadrant)
+    min_trials : int
+        trials of a condition before it can be done
+    max_trials : int
+        trials of a condition after which it is done anyway. None has no limit.
+    ori_se : float
+        target standard error of the circular mean orientation in degrees
+    length_se : float
+        target standard error of the mean length
+    """
+    def __init__(self, conditions, min_trials=6, max_trials=None, ori_se=1.5, length_se=.1):
+        self.min_trials = min_trials
+        self.max_trials = max_trials
+        self.ori_se = ori_se
+        self.length_se = length_se
+
+        self.conditions = list(conditions)
+        self.n = dict.fromkeys(self.conditions, 0)
+        self._sin2 = dict.fromkeys(self.conditions, 0.)
+        self._cos2 = dict.fromkeys(self.conditions, 0.)
+        self._len_mean = dict.fromkeys(self.conditions, 0.)
+        self._len_m2 = dict.fromkeys(self.conditions, 0.)  # sum of squared deviations (Welford)
+        self._done = set()
+
+    def update(self, condition, ori, length):
+        """
+        Adds the responses of a completed trial.
+
+        Parameters
+        ----------
+        condition : tuple
+        ori : float
+            reported orientation in degrees
+        length : float
+
+        Returns
+        -------
+        bool
+            True if the condition just became done
+        """
+        if np.isnan(ori) or np.isnan(length):
+            return False
+
+        doubled = np.deg2rad(2 * ori)
+        self._sin2[condition] += np.sin(doubled)
+        self._cos2[condition] += np.cos(doubled)
+
+        self.n[condition] += 1
+        delta = length - self._len_mean[condition]
+        self._len_mean[condition] += delta / self.n[condition]
+        self._len_m2[condition] += delta * (length - self._len_mean[condition])
+
+        if condition not in self._done and self._converged(condition):
+            self._done.add(condition)
+            return True
+        return False
+
+    def estimate(self, condition):
+        """
+        Running estimates of a condition.
+
+        Returns
+        -------
+        dict
+            number of trials, circular mean orientation (in (-90, 90]) and mean length, and their standard errors
+        """
+        n = self.n[condition]
+        if not n:
+            return {"n": 0, "ori": np.nan, "ori_se": np.inf, "length": np.nan, "length_se": np.inf}
+
+        r = min(np.hypot(self._sin2[condition], self._cos2[condition]) / n, 1.)
+        ori = np.rad2deg(np.arctan2(self._sin2[condition], self._cos2[condition])) / 2
+        ori_sd = np.rad2deg(np.sqrt(-2 * np.log(r))) / 2 if r > 0 else 90.  # circular sd of the axial angles
+        length_sd = np.sqrt(self._len_m2[condition] / (n - 1)) if n > 1 else np.inf
+
+        return {
+            "n": n,
+            "ori": ori,
+            "ori_se": ori_sd / np.sqrt(n),
+            "length": self._len_mean[condition],
+            "length_se": length_sd / np.sqrt(n)
+        }
+
+    def _converged(self, condition):
+        n = self.n[condition]
+        if self.max_trials is not None and n >= self.max_trials:
+            return True
+        if n < self.min_trials:
+            return False
+        est = self.estimate(condition)
+        return est["ori_se"] <= self.ori_se and est["length_se"] <= self.length_se
+
+    def done(self, condition):
+        """Whether a condition needs no more trials"""
+        return condition in self._done
+
+    @property
+    def remaining(self):
+        """The conditions that still need trials"""
+        return [c for c in self.conditions if c not in self._done]
@@ -0,0 +1,169 @@
+#!usr/bin/env python
+"""
+Bootstrap confidence intervals for the reports of many groups of trials at once
+
+The trials of all the groups (e.g. every subject, speed pair and quadrant of a cohort) are put in one array sorted by
+group. A resample of the whole cohort is one row of indices in which every column is drawn from its own group, so
+thousands of resamples are one index matrix, and the statistic of every group in every resample comes out of a few
+NumPy reductions over the contiguous groups. The resamples are made in chunks to keep the memory bounded.
+"""
+import numpy as np
+import pandas as pd
+
+STATS = ("mean", "median", "circmean")
+
+
+def _starts(sizes):
+    return np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+
+
+def resample_index(sizes, n_boot, rng=None):
+    """
+    Indices of bootstrap resamples of contiguous groups.
+
+    Parameters
+    ----------
+    sizes : array_like
+        number of values in every group, in the order they are in the array
+    n_boot : int
+        number of resamples
+    rng : np.random.Generator
+
+    Returns
+    -------
+    np.ndarray
+        (n_boot, total size) indices where every column is drawn with replacement from the group it belongs to
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    sizes = np.asarray(sizes, dtype=np.intp)
+    owner = np.repeat(np.arange(len(sizes)), sizes)
+    return _starts(sizes)[owner] + rng.integers(0, sizes[owner], size=(n_boot, len(owner)))
+
+
+def group_stat(values, sizes, stat="mean", period=180.):
+    """
+    Statistic of every group, along the last axis of the values.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        (..., total size) values sorted by group
+    sizes : array_like
+        number of values in every group
+    stat : str
+        'mean', 'median', or 'circmean' (circular mean)
+    period : float
+        period of the angles for 'circmean'. 180 degrees for orientations, which have no direction.
+
+    Returns
+    -------
+    np.ndarray
+        (..., number of groups). Circular means are in (-period / 2, period / 2].
+    """
+    sizes = np.asarray(sizes, dtype=np.intp)
+    starts = _starts(sizes)
+
+    if stat == "mean":
+        return np.add.reduceat(values, starts, axis=-1) / sizes
+
+    if stat == "circmean":
+        rad = values * (2 * np.pi / period)
+        sin = np.add.reduceat(np.sin(rad), starts, axis=-1)
+        cos = np.add.reduceat(np.cos(rad), starts, axis=-1)
+        return np.arctan2(sin, cos) * (period / (2 * np.pi))
+
+    if stat == "median":
+        # every group is lifted above the ones before it, so one sort orders the values inside all the groups
+        low = values.min()
+        step = values.max() - low + 1
+        lift = np.repeat(np.arange(len(sizes)), sizes) * step
+        ordered = np.sort(values - low + lift, axis=-1) - lift + low
+        return (ordered[..., starts + (sizes - 1) // 2] + ordered[..., starts + sizes // 2]) / 2
+
+    raise ValueError(f"stat should be one of {STATS}, not {stat!r}")
+
+
+def bootstrap(values, sizes, stat="mean", n_boot=10000, period=180., seed=None, chunk_size=2 ** 22):
+    """
+    Bootstrap distributions of a statistic of every group.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        values sorted by group
+    sizes : array_like
+        number of values in every group
+    stat : str
+        see group_stat
+    n_boot : int
+        number of resamples
+    period : float
+        see group_stat
+    seed : int or np.random.Generator
+    chunk_size : int
+        most resampled values held in memory at once
+
+    Returns
+    -------
+    np.ndarray
+        (n_boot, number of groups)
+    """
+    rng = np.random.default_rng(seed)
+    values = np.asarray(values, dtype=float)
+    per_chunk = max(1, chunk_size // max(len(values), 1))
+
+    boots = np.empty((n_boot, len(sizes)))
+    for start in range(0, n_boot, per_chunk):
+        n = min(per_chunk, n_boot - start)
+        boots[start:start + n] = group_stat(values[resample_index(sizes, n, rng)], sizes, stat, period)
+
+    return boots
+
+
+def bootstrap_ci(trials, column, by, stat="mean", n_boot=10000, ci=.95, period=180., seed=None):
+    """
+    Percentile bootstrap confidence intervals of a column of trials in every group.
+
+    Parameters
+    ----------
+    trials : pd.DataFrame
+        e.g. the prescan trials of a cohort
+    column : str
+        e.g. 'RESP_LENGTH', or 'RESP_ORI' with stat='circmean'
+    by : list of str
+        columns that define the groups (e.g. ['SUBJECT_ID', 'V_INTERNAL', 'V_EXTERNAL', 'QUADRANT'])
+    stat : str
+        'mean', 'median', or 'circmean'
+    n_boot : int
+    ci : float
+        coverage of the intervals
+    period : float
+        period of the angles for 'circmean'
+    seed : int
+
+    Returns
+    -------
+    pd.DataFrame
+        estimate, bootstrap standard error, and the lower and upper bounds of the interval of every group. The
+        circular intervals are around the estimate, so they can go past +-period / 2.
+    """
+    grouped = trials.groupby(by, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    values = trials[column].to_numpy(dtype=float)[order]
+    sizes = np.bincount(codes)
+
+    estimate = group_stat(values, sizes, stat, period)
+    boots = bootstrap(values, sizes, stat, n_boot, period, seed)
+    tails = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+
+    if stat == "circmean":
+        # the resamples as the shortest turn from the estimate, so an interval doesn't break where the angles wrap
+        turn = (boots - estimate + period / 2) % period - period / 2
+        low, high = estimate + np.percentile(turn, tails, axis=0)
+        se = np.sqrt(np.mean(turn ** 2, axis=0))
+    else:
+        low, high = np.percentile(boots, tails, axis=0)
+        se = boots.std(axis=0, ddof=1)
+
+    return pd.DataFrame({"ESTIMATE": estimate, "SE": se, "CI_LOW": low, "CI_HIGH": high}, index=grouped.size().index)
@@ -2,6 +2,12 @@
 """
 Helper functions for double-drift experiments
 """
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
 
 
 def setup_path(sub, root, exp_part):
@@ -79,3 +85,363 @@ def get_monitors(mon_name):
     }
 
     return test_monitors[mon_name]
+
+
+def build_design(factors, n_reps=1, n_groups=1, shuffle=True, rng=None):
+    """
+    Makes the fully crossed, repeated, and shuffled trial table in one vectorized pass.
+    Rows of the crossed design follow the order of itertools.product over the factors.
+
+    Parameters
+    ----------
+    factors : dict
+        maps column names to the list of levels. A tuple of names maps to levels that are rows (e.g. speed pairs),
+        so the linked columns vary together.
+    n_reps : int
+        number of repetitions of every condition
+    n_groups : int
+        number of independent copies of the design (e.g. runs). Each copy is shuffled on its own.
+    shuffle : bool
+        whether to shuffle the rows (within each group)
+    rng : np.random.Generator
+        random generator to use for shuffling. If None, a new one is seeded from numpy's global generator, so
+        np.random.seed makes the design reproducible (e.g. in simulated sessions).
+
+    Returns
+    -------
+    np.ndarray
+        structured array with one field per column
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+
+    # levels of each factor as a 2d array (n_levels, n_linked_columns)
+    names, levels = [], []
+    for key, lvls in factors.items():
+        key = key if isinstance(key, tuple) else (key,)
+        lvls = np.asarray(lvls)
+        names.append(key)
+        levels.append(lvls.reshape(len(lvls), len(key)))
+
+    # condition indices of the crossed design, then repeated and copied for groups
+    sizes = [len(lvls) for lvls in levels]
+    cond_idx = np.indices(sizes).reshape(len(sizes), -1)
+    n_per_group = cond_idx.shape[1] * n_reps
+    row_idx = np.tile(np.repeat(np.arange(cond_idx.shape[1]), n_reps), (n_groups, 1))
+
+    # shuffle every group independently
+    if shuffle:
+        if n_groups == 1:
+            row_idx = rng.permutation(row_idx[0])[np.newaxis]
+        else:
+            row_idx = np.take_along_axis(row_idx, rng.random(row_idx.shape).argsort(axis=1), axis=1)
+    row_idx = row_idx.ravel()
+
+    # fill in the columns
+    dtype = [(name, lvls.dtype) for key, lvls in zip(names, levels) for name in key]
+    if n_groups > 1:
+        dtype.append(("GROUP", np.int64))
+    design = np.empty(n_groups * n_per_group, dtype=dtype)
+
+    for f, (key, lvls) in enumerate(zip(names, levels)):
+        lvl_idx = cond_idx[f, row_idx]
+        for c, name in enumerate(key):
+            design[name] = lvls[lvl_idx, c]
+    if n_groups > 1:
+        design["GROUP"] = np.repeat(np.arange(n_groups), n_per_group)
+
+    return design
+
+
+class TrialTable:
+    """
+    Columnar trial table with native dtypes.
+
+    Columns that change from trial to trial are fields of one structured array, session-level columns (task, subject,
+    ...) are stored once in `meta`. Indexing with a column name returns a view of that column, so it can be read and
+    written in the trial loop without making new arrays.
+
+    Parameters
+    ----------
+    cols : list of str
+        all the columns, in the order of the exported file
+    design : np.ndarray or dict
+        structured array (e.g. from build_design) or dict of arrays with the trial-varying columns. Fields that are
+        not in `cols` are ignored.
+    meta : dict
+        session-level columns and their single value
+    dtypes : dict
+        dtypes of the columns that are in neither `design` nor `meta`. The default is float, initialized with NaN.
+    """
+    def __init__(self, cols, design, meta=None, dtypes=None):
+        self.cols = list(cols)
+        self.meta = dict(meta or {})
+        dtypes = dict(dtypes or {})
+
+        names = design.dtype.names if isinstance(design, np.ndarray) else list(design)
+        n_trials = len(design[names[0]])
+        fields = [c for c in self.cols if c not in self.meta]
+        self.data = np.empty(n_trials, dtype=[
+            (c, design[c].dtype if c in names else dtypes.get(c, np.float64)) for c in fields
+        ])
+
+        for c in fields:
+            if c in names:
+                self.data[c] = design[c]
+            elif self.data[c].dtype.kind == 'f':
+                self.data[c] = np.nan
+            else:
+                self.data[c] = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, col):
+        if col in self.meta:
+            return self.meta[col]
+        return self.data[col]
+
+    def row(self, trial):
+        """
+        Gets one trial with every column as a dict of python values.
+
+        Parameters
+        ----------
+        trial : int
+
+        Returns
+        -------
+        dict
+        """
+        rec = self.data[trial]
+        return {c: self.meta[c] if c in self.meta else rec[c].item() for c in self.cols}
+
+    def to_frame(self):
+        """
+        Makes a pandas dataframe with the columns in order. Session-level columns are repeated for every row.
+
+        Returns
+        -------
+        pd.DataFrame
+        """
+        return pd.DataFrame({c: self[c] for c in self.cols}, index=pd.RangeIndex(len(self)))
+
+    def to_csv(self, file_name, sep=','):
+        """
+        Saves the table in a csv file with the same columns as `cols`.
+
+        Parameters
+        ----------
+        file_name : str or Path
+        sep : str
+        """
+        self.to_frame().to_csv(file_name, sep=sep, index=False)
+
+
+class TrialJournal:
+    """
+    Append-only journal of completed trials, so a crash or an early quit doesn't lose the session.
+
+    The trial table (design, trial order, and session-level columns) is saved when the session starts, and every
+    completed trial is appended to the journal as one csv line. The lines go to the OS right away and are synced to
+    the disk in batches. An interrupted session can be loaded back and continued from its first unfinished trial. A
+    finished session (see finish) is never continued or overwritten by a resume.
+
+    Parameters
+    ----------
+    file_name : str
+        path of the experiment file without an extension
+    table : TrialTable
+        the trial table of the session. It is updated in place when a session is resumed.
+    sync_every : int
+        number of trials between syncs to the disk
+    """
+    DESIGN_SUFFIX = "_design.npz"
+    JOURNAL_SUFFIX = "_journal.csv"
+
+    def __init__(self, file_name, table, sync_every=10):
+        self.file_name = file_name
+        self.design_file = file_name + self.DESIGN_SUFFIX
+        self.journal_file = file_name + self.JOURNAL_SUFFIX
+        self.table = table
+        self.sync_every = sync_every
+        self.n_done = 0
+
+        self._file = None
+        self._writer = None
+        self._n_unsynced = 0
+
+    @classmethod
+    def saved_progress(cls, file_name):
+        """
+        Progress of the saved session of an experiment file, without loading it into a table.
+
+        Parameters
+        ----------
+        file_name : str
+            path of the experiment file without an extension
+
+        Returns
+        -------
+        tuple or None
+            (number of journaled trials, number of trials, finished) of the saved session, or None if there isn't one.
+            A session is finished when finish was called or all of its trials are journaled.
+        """
+        design_file, journal_file = file_name + cls.DESIGN_SUFFIX, file_name + cls.JOURNAL_SUFFIX
+        if not (os.path.exists(design_file) and os.path.exists(journal_file)):
+            return None
+        saved = np.load(design_file)
+        n_trials = len(saved["data"])
+        finished = "finished" in saved and bool(saved["finished"])
+
+        n_done = 0
+        with open(journal_file, 'rb') as f:
+            f.readline()
+            for line in f:
+                if not line.endswith(b'\n') or not line.split(b',', 1)[0].isdigit():
+                    break  # a half-written last line
+                n_done = int(line.split(b',', 1)[0]) + 1
+
+        return n_done, n_trials, finished or n_done >= n_trials
+
+    def open(self, resume=True):
+        """
+        Starts a new journal, or loads the existing one of this session.
+
+        Parameters
+        ----------
+        resume : bool
+            if False, an existing journal is overwritten. If True, an unfinished one is continued and a finished one
+            raises a FileExistsError.
+
+        Returns
+        -------
+        int
+            index of the first unfinished trial
+        """
+        saved_session = self.saved_progress(self.file_name) if resume else None
+        if saved_session is not None and saved_session[2]:
+            raise FileExistsError(f"{self.design_file} is a finished session, it can't be continued.")
+
+        if saved_session is not None:
+            saved = np.load(self.design_file)
+            if saved["data"].dtype != self.table.data.dtype or len(saved["data"]) != len(self.table):
+                raise ValueError(f"{self.design_file} doesn't match the trial table of this session.")
+            self.table.data[:] = saved["data"]
+            self.table.meta.update(json.loads(str(saved["meta"])))
+            self.n_done = self._load_journal()
+            self._file = open(self.journal_file, 'a', encoding='utf8', newline='')
+            self._writer = csv.writer(self._file, lineterminator='\n')
+        else:
+            np.savez(self.design_file, data=self.table.data, meta=json.dumps(self.table.meta))
+            self._file = open(self.journal_file, 'w', encoding='utf8', newline='')
+            self._writer = csv.writer(self._file, lineterminator='\n')
+            self._writer.writerow(["ROW"] + self.table.cols)
+            self.n_done = 0
+            self.sync()
+
+        return self.n_done
+
+    def _load_journal(self):
+        """Puts the journaled trials back in the table and drops a half-written last line"""
+        fields = [c for c in self.table.cols if c not in self.table.meta]
+        n_done, n_bytes = 0, 0
+        with open(self.journal_file, 'rb') as f:
+            n_bytes += len(f.readline())
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                values = next(csv.reader([line.decode('utf8')]))
+                if len(values) != len(self.table.cols) + 1:
+                    break
+                row = dict(zip(["ROW"] + self.table.cols, values))
+                trial = int(row["ROW"])
+                for c in fields:
+                    self.table.data[c][trial] = np.nan if row[c] == '' else row[c]
+                n_done = trial + 1
+                n_bytes += len(line)
+
+        with open(self.journal_file, 'r+b') as f:
+            f.truncate(n_bytes)
+
+        return n_done
+
+    def rewind(self, trial):
+        """
+        Drops the journaled trials from `trial` on, e.g. to restart an unfinished run from its beginning.
+
+        The rows of the table from `trial` on get their values from the saved design back, so the responses of the
+        dropped trials (RTs, answers, ...) don't stay in memory and the repeated trials start like new ones.
+
+        Parameters
+        ----------
+        trial : int
+            index of the first trial to drop
+        """
+        self._file.flush()
+        n_bytes, n_done = 0, 0
+        with open(self.journal_file, 'rb') as f:
+            n_bytes += len(f.readline())
+            for line in f:
+                row = int(line.split(b',', 1)[0])
+                if row >= trial:
+                    break
+                n_bytes += len(line)
+                n_done = row + 1
+        self._file.truncate(n_bytes)
+        self._file.seek(n_bytes)
+        self.n_done = n_done
+        self.table.data[trial:] = np.load(self.design_file)["data"][trial:]
+        self.sync()
+
+    def append(self, trial):
+        """
+        Adds a completed trial to the journal.
+
+        Parameters
+        ----------
+        trial : int
+            index of the trial in the table
+        """
+        row = self.table.row(trial)
+        self._writer.writerow([trial] + ['' if (isinstance(v, float) and np.isnan(v)) else v for v in row.values()])
+        self._file.flush()  # the line survives a crash of the experiment
+        self.n_done = trial + 1
+
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Makes sure the journaled trials are on the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+
+    def close(self):
+        """Syncs and closes the journal."""
+        if self._file is not None and not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def finish(self):
+        """
+        Marks the session as finished in its saved design, so it isn't continued when it is started again, e.g. when
+        the adaptive prescan skipped its last trials.
+        """
+        saved = dict(np.load(self.design_file))
+        np.savez(self.design_file, **saved, finished=True)
+
+    def to_csv(self, file_name):
+        """
+        Rebuilds the data file of the session from the journal, line by line.
+
+        Parameters
+        ----------
+        file_name : str or Path
+        """
+        if self._file is not None and not self._file.closed:
+            self._file.flush()
+        with open(self.journal_file, 'rb') as journal, open(file_name, 'wb') as out:
+            for line in journal:
+                out.write(line.split(b',', 1)[1])
@@ -0,0 +1,240 @@
+#!usr/bin/env python
+"""
+Frame intervals with trial markers, and their analysis
+
+PsychoPy saves the frame intervals of a session as one flat list. FrameMarkers keeps the index of the first frame of
+every trial phase next to it, so dropped frames can be attributed to the trial, phase, and condition they happened in.
+A continued session adds its frames and markers to the files of the interrupted one.
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+INTERVALS_SUFFIX = "_frame-intervals.log"
+MARKERS_SUFFIX = "_frame-markers.tsv"
+
+
+class FrameMarkers:
+    """
+    Marks where every trial phase starts in the frame intervals of a window.
+
+    Parameters
+    ----------
+    win : visual.Window
+        the window that records the frame intervals
+    first_frame : int
+        number of frames saved by the earlier part of a continued session (see saved_frames), which the marks count on
+        from
+    """
+    def __init__(self, win, first_frame=0):
+        self.win = win
+        self.first_frame = first_frame
+        self.frames = []
+        self.trials = []
+        self.phases = []
+
+    def mark(self, trial, phase):
+        """
+        Marks the start of a phase. Call it before drawing the first frame of the phase.
+
+        Parameters
+        ----------
+        trial : int
+            index of the trial in the trial table
+        phase : str
+        """
+        self.frames.append(self.first_frame + len(self.win.frameIntervals))
+        self.trials.append(trial)
+        self.phases.append(phase)
+
+    def save(self, file_name, append=False):
+        """
+        Saves the markers in a tsv file, with the refresh threshold of the window in the first line.
+
+        Parameters
+        ----------
+        file_name : str
+        append : bool
+            add the markers to the file of the earlier part of a continued session
+        """
+        append = append and os.path.exists(file_name)
+        with open(file_name, 'a' if append else 'w') as f:
+            if not append:
+                f.write(f"# refresh_threshold: {self.win.refreshThreshold}\n")
+                f.write("frame\ttrial\tphase\n")
+            for frame, trial, phase in zip(self.frames, self.trials, self.phases):
+                f.write(f"{frame}\t{trial}\t{phase}\n")
+
+
+def save_intervals(win, file_name, append=False):
+    """
+    Saves the frame intervals of a window like Window.saveFrameIntervals, and clears them.
+
+    Parameters
+    ----------
+    win : visual.Window
+    file_name : str
+    append : bool
+        add the intervals to the file of the earlier part of a continued session, on a new line
+    """
+    append = append and os.path.exists(file_name)
+    with open(file_name, 'a' if append else 'w') as f:
+        if append:
+            f.write('\n')
+        f.write(", ".join(str(float(i)) for i in win.frameIntervals))
+    win.frameIntervals = []
+
+
+def saved_frames(file_name):
+    """Number of frame intervals in a saved file, 0 if there isn't one"""
+    return len(load_intervals(file_name)) if os.path.exists(file_name) else 0
+
+
+def load_intervals(file_name):
+    """
+    Loads the frame intervals saved by Window.saveFrameIntervals.
+
+    Parameters
+    ----------
+    file_name : str or Path
+
+    Returns
+    -------
+    np.ndarray
+        intervals in seconds
+    """
+    with open(file_name) as f:
+        txt = f.read().replace('\n', ',').strip(', ')
+    return np.array(txt.split(','), dtype=float) if txt else np.empty(0)
+
+
+def load_markers(file_name):
+    """
+    Loads the frame markers saved by FrameMarkers.save.
+
+    Parameters
+    ----------
+    file_name : str or Path
+
+    Returns
+    -------
+    tuple
+        (markers dataframe, refresh threshold in seconds)
+    """
+    with open(file_name) as f:
+        threshold = float(f.readline().split(':')[1])
+    return pd.read_csv(file_name, sep='\t', comment='#'), threshold
+
+
+def analyze_session(intervals_file, markers_file, data_file=None, threshold=None):
+    """
+    Counts the dropped frames of every trial phase in a session.
+
+    Parameters
+    ----------
+    intervals_file : str or Path
+    markers_file : str or Path
+    data_file : str or Path
+        csv file of the trials. Its columns are added to the phases as the conditions, by the trial number (TRIAL) of
+        its rows, since trials that were skipped (e.g. by the adaptive prescan) have no row.
+    threshold : float
+        intervals longer than this (in seconds) are dropped frames. Defaults to the refresh threshold of the window.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per phase with the number of frames, dropped frames, and the longest interval
+    """
+    intervals = load_intervals(intervals_file)
+    markers, win_threshold = load_markers(markers_file)
+    threshold = win_threshold if threshold is None else threshold
+
+    # the phase of every frame, and frames before the first marker are left out
+    starts = markers["frame"].to_numpy()
+    phase_idx = np.searchsorted(starts, np.arange(len(intervals)), side='right') - 1
+    marked = phase_idx >= 0
+    phase_idx, intervals = phase_idx[marked], intervals[marked]
+
+    n_phases = len(markers)
+    phases = markers.copy()
+    phases["n_frames"] = np.bincount(phase_idx, minlength=n_phases)
+    phases["n_dropped"] = np.bincount(phase_idx, weights=intervals > threshold, minlength=n_phases).astype(int)
+    longest = np.zeros(n_phases)
+    np.maximum.at(longest, phase_idx, intervals)
+    phases["max_interval"] = longest
+
+    if data_file is not None:
+        data = pd.read_csv(data_file)
+        phases = phases.join(data.set_index(data["TRIAL"] - 1), on="trial")  # the markers have the trial indices
+
+    return phases
+
+
+def summarize_session(phases, conditions=()):
+    """
+    Dropped frames per phase (and condition) of a session.
+
+    Parameters
+    ----------
+    phases : pd.DataFrame
+        output of analyze_session
+    conditions : list of str
+        columns of the trial data to group by
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    summary = phases.groupby(["phase", *conditions], sort=False).agg(
+        n_frames=("n_frames", "sum"),
+        n_dropped=("n_dropped", "sum"),
+        n_trials_with_drops=("n_dropped", lambda d: int((d > 0).sum())),
+        max_interval=("max_interval", "max")
+    )
+    summary["drop_rate"] = summary["n_dropped"] / summary["n_frames"]
+    return summary.reset_index()
+
+
+def _summarize_file(args):
+    markers_file, conditions = args
+    base = str(markers_file)[:-len(MARKERS_SUFFIX)]
+    data_file = Path(base + ".csv")
+    phases = analyze_session(base + INTERVALS_SUFFIX, markers_file, data_file if data_file.exists() else None)
+    summary = summarize_session(phases, conditions if data_file.exists() else ())
+    summary.insert(0, "session", Path(base).name)
+    return summary
+
+
+def summarize_tree(data_dir, conditions=(), n_jobs=None):
+    """
+    Dropped frame summaries of all the sessions under a data directory, one session per process.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+    conditions : list of str
+        columns of the trial data to group by
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    markers_files = sorted(Path(data_dir).glob(f"sub-*/*/*{MARKERS_SUFFIX}"))
+    if not markers_files:
+        return pd.DataFrame()
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        summaries = list(pool.map(_summarize_file, [(f, tuple(conditions)) for f in markers_files]))
+    return pd.concat(summaries, ignore_index=True)
+
+
+if __name__ == '__main__':
+
+    # Usage: python frames.py [data directory] [condition columns...]
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    print(summarize_tree(data_path, sys.argv[2:]).to_string(index=False))
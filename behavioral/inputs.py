@@ -0,0 +1,238 @@
+#!usr/bin/env python
+"""
+Response capture separate from the frame loop
+
+Keyboard keys, button-box bytes (serial), and mouse-wheel steps are collected as single events with their own
+timestamps, so a response is not rounded to the next flip and wheel steps between two flips are not merged. The
+keyboard and the serial port are read on a background thread. Events go into a deque, which is safe to append to
+from one thread and pop from another without a lock, and the trial code drains it once per frame.
+"""
+import threading
+import time
+from collections import deque, namedtuple
+
+InputEvent = namedtuple("InputEvent", ["time", "source", "value"])
+InputEvent.__doc__ = "A response: time on the listener's clock, source ('keyboard', 'serial', 'wheel'), and value"
+
+
+class InputListener:
+    """
+    Collects responses on a background thread.
+
+    Parameters
+    ----------
+    clock : object
+        anything with a getTime() method (e.g. core.Clock) that the events are timestamped with
+    keys : list of str
+        keys that are collected. Other keys stay in the keyboard's buffer (e.g. the scanner's '5' for the trigger
+        listener). None collects every key. An empty list doesn't read the keyboard at all.
+    serial_path : str
+        path of a serial button box. None if there isn't one.
+    baudrate : int
+    buttons : dict
+        maps the bytes the button box sends to the names of the buttons. Other bytes are ignored.
+    win : visual.Window
+        window whose mouse-wheel steps are collected. The window gets them when it dispatches its events (on every
+        flip), so their timestamps are only as precise as the frames. None doesn't collect the wheel.
+    port : object
+        an already opened port with read() and in_waiting (e.g. for testing). Overrides `serial_path`.
+    keyboard : object
+        an already made keyboard with getKeys() and a clock, like psychopy.hardware.keyboard.Keyboard (e.g. for
+        testing)
+    poll_interval : float
+        seconds between reads of the keyboard and the port
+    """
+    def __init__(self, clock, keys=None, serial_path=None, baudrate=19200, buttons=None, win=None, port=None,
+                 keyboard=None, poll_interval=.0005):
+        self.clock = clock
+        self.keys = keys
+        self.serial_path = serial_path
+        self.baudrate = baudrate
+        self.buttons = buttons or {str(b).encode(): str(b) for b in range(1, 5)}
+        self.win = win
+        self.poll_interval = poll_interval
+
+        self._port = port
+        self._events = deque()
+        self._stop = threading.Event()
+        self._thread = None
+        self._kb = keyboard
+        self._kb_offset = 0.
+
+    @property
+    def sources(self):
+        """The sources this listener reads"""
+        sources = []
+        if self.keys is None or len(self.keys):
+            sources.append("keyboard")
+        if self._port is not None or self.serial_path is not None:
+            sources.append("serial")
+        if self.win is not None:
+            sources.append("wheel")
+        return sources
+
+    def start(self):
+        """Opens the devices and starts collecting."""
+        if "keyboard" in self.sources:
+            # the psychtoolbox keyboard timestamps the keys itself, so they are moved to our clock with the offset
+            # between the two clocks instead of being stamped when they are read
+            if self._kb is None:
+                from psychopy.hardware import keyboard
+                self._kb = keyboard.Keyboard()
+            self._kb_offset = self.clock.getTime() - self._kb.clock.getTime()
+        if "serial" in self.sources and self._port is None:
+            import serial
+            self._port = serial.Serial(self.serial_path, self.baudrate, timeout=0)
+        if self._port is not None and hasattr(self._port, "reset_input_buffer"):
+            self._port.reset_input_buffer()
+        if self.win is not None:
+            self.win.winHandle.push_handlers(on_mouse_scroll=self._on_scroll)
+
+        self._stop.clear()
+        if "keyboard" in self.sources or "serial" in self.sources:
+            self._thread = threading.Thread(target=self._listen, name="input_listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops collecting and closes the port if it was opened here."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.win is not None:
+            self.win.winHandle.remove_handlers(on_mouse_scroll=self._on_scroll)
+        if self.serial_path is not None and self._port is not None:
+            self._port.close()
+            self._port = None
+
+    def _listen(self):
+        while not self._stop.is_set():
+            n_new = 0
+            if self._kb is not None:
+                for key in self._kb.getKeys(keyList=self.keys, waitRelease=False):
+                    t = key.rt + self._kb_offset if key.rt is not None else self.clock.getTime()
+                    self._events.append(InputEvent(t, "keyboard", key.name))
+                    n_new += 1
+            if self._port is not None:
+                try:
+                    n_new += self._read_serial()
+                except OSError:  # the device was disconnected
+                    self._port = None
+            if not n_new:
+                time.sleep(self.poll_interval)
+
+    def _read_serial(self):
+        data = self._port.read(getattr(self._port, "in_waiting", 0) or 1)
+        t = self.clock.getTime()
+        n_new = 0
+        for byte in data:
+            button = self.buttons.get(bytes([byte]))
+            if button is not None:
+                self._events.append(InputEvent(t, "serial", button))
+                n_new += 1
+        return n_new
+
+    def _on_scroll(self, x, y, scroll_x, scroll_y):
+        self._events.append(InputEvent(self.clock.getTime(), "wheel", scroll_y))
+
+    def inject(self, source, value, t=None):
+        """
+        Adds a synthetic event, as if it came from a device (e.g. for testing).
+
+        Parameters
+        ----------
+        source : str
+        value : str or float
+        t : float
+            time on the clock. Now if None.
+        """
+        self._events.append(InputEvent(self.clock.getTime() if t is None else t, source, value))
+
+    def drain(self):
+        """
+        Takes all the events collected since the last call.
+
+        Returns
+        -------
+        list of InputEvent
+            in the order they were collected
+        """
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    def clear(self):
+        """Drops the events collected so far."""
+        self._events.clear()
+
+
+def inject_events(listener, schedule):
+    """
+    Injects a schedule of synthetic events from a background thread, each at its time.
+
+    Parameters
+    ----------
+    listener : InputListener
+    schedule : list of tuple
+        (seconds after the start, source, value) of every event
+
+    Returns
+    -------
+    tuple
+        (the thread, list that gets the send time of every event on the listener's clock)
+    """
+    sent = []
+
+    def send():
+        t_start = listener.clock.getTime()
+        for delay, source, value in sorted(schedule, key=lambda ev: ev[0]):
+            while listener.clock.getTime() < t_start + delay:
+                time.sleep(max(0., min(t_start + delay - listener.clock.getTime() - .001, .01)))
+            sent.append(listener.clock.getTime())
+            listener.inject(source, value, sent[-1])
+
+    thread = threading.Thread(target=send, name="inject_events", daemon=True)
+    thread.start()
+
+    return thread, sent
+
+
+if __name__ == '__main__':
+
+    # dry run: button presses from a fake button box on a pseudo-terminal, drained by a 165 Hz frame loop
+    import os
+    import pty  # only on unix
+
+    class PerfClock:
+        @staticmethod
+        def getTime():
+            return time.perf_counter()
+
+    box, device = pty.openpty()
+    listener = InputListener(PerfClock(), keys=[], serial_path=os.ttyname(device))
+    listener.start()
+
+    sent_times = []
+    for press in range(20):
+        time.sleep(.0137)
+        sent_times.append(time.perf_counter())
+        os.write(box, str(press % 4 + 1).encode())
+
+    # synthetic events on top, as the test harness would
+    thread, injected = inject_events(listener, [(i * .01, "keyboard", "1") for i in range(10)])
+    thread.join()
+
+    frame_dur = 1 / 165
+    got = []
+    t_end = time.perf_counter() + .1
+    while time.perf_counter() < t_end:
+        got += listener.drain()
+        time.sleep(frame_dur)
+    listener.stop()
+    os.close(box)
+
+    serial_events = [ev for ev in got if ev.source == "serial"]
+    lags = [(ev.time - sent) * 1000 for ev, sent in zip(serial_events, sent_times)]
+    print(f"{len(serial_events)} button presses, {len(got) - len(serial_events)} injected events")
+    print(f"timestamp lag: mean {sum(lags) / len(lags):.3f} ms, max {max(lags):.3f} ms")
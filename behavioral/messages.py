@@ -0,0 +1,29 @@
+#!usr/bin/env python
+"""
+Pre-rendered text messages
+
+Changing the text of a TextStim lays out the glyphs and rebuilds its texture, which can take longer than a frame.
+Every message gets its own stimulus instead, made once at startup, so showing a message is only a draw call.
+"""
+from psychopy import visual
+
+
+def make_messages(win, messages, **kwargs):
+    """
+    Makes one text stimulus for every message.
+
+    Parameters
+    ----------
+    win : visual.Window
+    messages : dict
+        maps the name of every message to its text
+    kwargs
+        passed to every TextStim (e.g. height, pos, wrapWidth)
+
+    Returns
+    -------
+    dict
+        maps the names to their stimuli
+    """
+    kwargs.setdefault("autoLog", False)
+    return {name: visual.TextStim(win=win, text=text, name=name, **kwargs) for name, text in messages.items()}
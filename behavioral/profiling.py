@@ -0,0 +1,177 @@
+#!usr/bin/env python
+"""
+Per-frame profiling of the render loops
+
+Opt-in timings of every frame, split into the stimulus update, the draw calls, waiting for the flip, and garbage
+collection pauses. The timings go into a preallocated ring buffer, so profiling doesn't grow any lists during the
+session. At the end, the buffer is saved as a binary trace (.npy) with a short text summary.
+"""
+import gc
+import time
+
+import numpy as np
+
+# stages of a frame, which are also their columns in the buffer after the start time
+UPDATE, DRAW, FLIP, GC = range(1, 5)
+STAGES = ("update", "draw", "flip", "gc")
+TRIAL, PHASE = 5, 6
+
+TRACE_DTYPE = np.dtype([
+    ("start", np.int64),  # ns since the profiler was made
+    ("update", np.int32),  # ns
+    ("draw", np.int32),
+    ("flip", np.int32),
+    ("gc", np.int32),
+    ("trial", np.int32),
+    ("phase", np.int16)
+])
+
+
+class FrameProfiler:
+    """
+    Ring buffer of per-frame timings.
+
+    Call start() at the top of the frame and lap() after the update, the draw calls, and the flip. Garbage collection
+    pauses are timed separately, and their time is also part of the stage they happened in.
+
+    Parameters
+    ----------
+    size : int
+        number of frames kept. Older frames are overwritten.
+    phases : list of str
+        names of the phases that set_context() can be called with
+    enabled : bool
+        if False, all the methods do nothing so the calls can stay in the render loops
+    """
+    def __init__(self, size=2 ** 18, phases=(), enabled=True):
+        self.phases = list(phases)
+        self.enabled = enabled
+        self.n_frames = 0
+
+        self._buffer = np.zeros((size if enabled else 0, len(TRACE_DTYPE)), dtype=np.int64)
+        self._i = 0
+        self._t_zero = time.perf_counter_ns()
+        self._last = self._t_zero
+        self._gc_start = 0
+        self._trial = -1
+        self._phase = -1
+
+        if enabled:
+            gc.callbacks.append(self._on_gc)
+        else:
+            self.start = self.lap = self.set_context = self._skip
+
+    @staticmethod
+    def _skip(*args):
+        pass
+
+    def set_context(self, trial, phase):
+        """
+        Labels the next frames with a trial and a phase.
+
+        Parameters
+        ----------
+        trial : int
+        phase : str
+        """
+        self._trial = trial
+        self._phase = self.phases.index(phase)
+
+    def start(self):
+        """Starts timing a new frame."""
+        i = self._i = self.n_frames % len(self._buffer)
+        buffer = self._buffer
+        buffer[i, UPDATE] = buffer[i, DRAW] = buffer[i, FLIP] = buffer[i, GC] = 0
+        buffer[i, TRIAL] = self._trial
+        buffer[i, PHASE] = self._phase
+        self._last = time.perf_counter_ns()
+        buffer[i, 0] = self._last - self._t_zero
+
+    def lap(self, stage):
+        """
+        Ends a stage of the frame. The flip stage also ends the frame.
+
+        Parameters
+        ----------
+        stage : int
+            UPDATE, DRAW, or FLIP
+        """
+        now = time.perf_counter_ns()
+        self._buffer[self._i, stage] = now - self._last
+        self._last = now
+        if stage == FLIP:
+            self.n_frames += 1
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.perf_counter_ns()
+        elif len(self._buffer):
+            self._buffer[self._i, GC] += time.perf_counter_ns() - self._gc_start
+
+    def trace(self):
+        """
+        The profiled frames in the order they happened.
+
+        Returns
+        -------
+        np.ndarray
+            structured array with the start of every frame, its stage timings in ns, and its trial and phase
+        """
+        size = len(self._buffer)
+        if not size:
+            return np.zeros(0, dtype=TRACE_DTYPE)
+        order = np.arange(max(0, self.n_frames - size), self.n_frames) % size
+        rows = self._buffer[order]
+        trace = np.empty(len(rows), dtype=TRACE_DTYPE)
+        for col, name in enumerate(TRACE_DTYPE.names):
+            info = np.iinfo(TRACE_DTYPE[name])
+            trace[name] = np.clip(rows[:, col], info.min, info.max)
+        return trace
+
+    def summary(self):
+        """
+        Summary of the stage timings in milliseconds.
+
+        Returns
+        -------
+        str
+        """
+        trace = self.trace()
+        lines = [f"{len(trace)} frames profiled ({self.n_frames} in total)",
+                 f"{'stage':>8} {'mean':>8} {'median':>8} {'p95':>8} {'p99':>8} {'max':>8}"]
+        for name in STAGES:
+            ms = trace[name] / 1e6
+            if len(ms):
+                lines.append(f"{name:>8} {ms.mean():8.3f} {np.median(ms):8.3f} {np.percentile(ms, 95):8.3f} "
+                             f"{np.percentile(ms, 99):8.3f} {ms.max():8.3f}")
+        n_gc = int(np.sum(trace["gc"] > 0))
+        lines.append(f"frames with a garbage collection: {n_gc}")
+
+        # the slowest frames and where their time went
+        total = sum(trace[name].astype(np.int64) for name in STAGES[:3])
+        lines.append("slowest frames (trial, phase: update/draw/flip/gc ms):")
+        for i in np.argsort(total)[::-1][:10]:
+            phase = self.phases[trace["phase"][i]] if trace["phase"][i] >= 0 else "-"
+            lines.append(f"  {trace['trial'][i]}, {phase}: " +
+                         "/".join(f"{trace[name][i] / 1e6:.2f}" for name in STAGES))
+        return "\n".join(lines)
+
+    def save(self, file_name):
+        """
+        Saves the binary trace (file_name.npy) and the summary (file_name.txt).
+
+        Parameters
+        ----------
+        file_name : str
+            path without an extension
+        """
+        if not self.enabled:
+            return
+        np.save(file_name + ".npy", self.trace())
+        with open(file_name + ".txt", 'w') as f:
+            f.write(self.summary() + "\n")
+
+    def close(self):
+        """Stops listening to the garbage collector."""
+        if self.enabled and self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
@@ -0,0 +1,159 @@
+#!usr/bin/env python
+"""
+Real-time mode for the experiment sessions
+
+- the garbage collector is disabled while stimuli are shown, and only collects in the idle phases (response, ITI)
+- the process gets a higher priority and its own CPUs (all but the first one) where the OS allows it
+- every stimulus is drawn for a few warm-up frames before the first trial, so its textures and shaders are already
+  on the GPU when the first trial starts
+"""
+import gc
+import os
+
+from psychopy import core
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def default_cpus():
+    """
+    CPUs for a session: all but the first one, which serves most of the interrupts and the system's work.
+
+    Returns
+    -------
+    list of int
+        None on a single CPU
+    """
+    n_cpus = os.cpu_count() or 1
+    return list(range(1, n_cpus)) if n_cpus > 1 else None
+
+
+class RealTimeMode:
+    """
+    Switches the session between stimulus and idle phases.
+
+    Parameters
+    ----------
+    enabled : bool
+        if False, nothing is changed but the calls can stay in the script
+    cpus : list of int
+        CPUs the process (with its listener and log threads) is pinned to, e.g. default_cpus(). None leaves the
+        affinity as it is.
+    """
+    def __init__(self, enabled=True, cpus=None):
+        self.enabled = enabled
+        self.cpus = cpus
+        self.in_stimulus = False
+        self.n_stim_collections = 0  # collections that still happened in stimulus phases
+        self.n_idle_collections = 0
+
+    def start(self):
+        """
+        Raises the priority, pins the CPUs, and moves everything made during setup out of the collector's way. Call it
+        once, after the setup: the frozen objects are never collected, so freezing again later would keep the garbage
+        of the trials forever.
+
+        Returns
+        -------
+        str
+            what could be changed, for the log
+        """
+        if not self.enabled:
+            return "Real-time mode is off."
+
+        changes = [f"priority raised: {core.rush(True)}"]
+
+        if self.cpus is not None:
+            try:
+                if hasattr(os, "sched_setaffinity"):
+                    os.sched_setaffinity(0, self.cpus)
+                elif psutil is not None and hasattr(psutil.Process, "cpu_affinity"):  # not on macOS
+                    psutil.Process().cpu_affinity(list(self.cpus))
+                else:
+                    raise OSError("no way to set the affinity")
+                changes.append(f"pinned to CPUs {list(self.cpus)}")
+            except OSError as err:
+                changes.append(f"CPU affinity not set ({err})")
+
+        gc.collect()
+        gc.freeze()
+        gc.callbacks.append(self._on_gc)
+        changes.append("garbage collection only in idle phases")
+
+        return "Real-time mode: " + ", ".join(changes) + "."
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            if self.in_stimulus:
+                self.n_stim_collections += 1
+
+    def stimulus_phase(self):
+        """Call before showing a stimulus: no garbage collection from now on."""
+        if self.enabled:
+            self.in_stimulus = True
+            gc.disable()
+
+    def idle_phase(self, generation=2):
+        """
+        Call when timing doesn't matter (response, ITI): collects the garbage of the last stimulus phase.
+
+        Parameters
+        ----------
+        generation : int
+            oldest generation that is collected. The objects made during setup were frozen in start(), so even a full
+            collection only goes through what the trials made.
+        """
+        if self.enabled:
+            self.in_stimulus = False
+            gc.enable()
+            gc.collect(generation)
+            self.n_idle_collections += 1
+
+    def warm_up(self, win, stimuli, n_frames=10, markers=None):
+        """
+        Draws every stimulus for a few frames and clears the screen.
+
+        Parameters
+        ----------
+        win : visual.Window
+        stimuli : list
+            stimuli with a draw() method
+        n_frames : int
+            frames per stimulus
+        markers : FrameMarkers
+            if given, the warm-up frames are marked as the "warmup" phase of trial -1
+        """
+        if not self.enabled:
+            return
+        if markers is not None:
+            markers.mark(-1, "warmup")
+        for stim in stimuli:
+            for frame in range(n_frames):
+                stim.draw()
+                win.flip()
+        win.flip()
+
+    def report(self):
+        """
+        Summary of the garbage collections, for the log.
+
+        Returns
+        -------
+        str
+        """
+        return (f"Real-time mode: {self.n_idle_collections} collections in idle phases, "
+                f"{self.n_stim_collections} during stimuli.")
+
+    def stop(self):
+        """Gives back the normal priority and garbage collection."""
+        if not self.enabled:
+            return
+        core.rush(False)
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        gc.unfreeze()
+        gc.enable()
+        self.in_stimulus = False
@@ -6,11 +6,18 @@ Created at 10/23/21
 Pre-scan behavioral experiment for determining illusion size of each participant
 """
 from psychopy import visual, monitors, event, core, logging, gui
-from dd_helpers import setup_path, get_monitors
+from dd_helpers import setup_path, get_monitors, build_design, TrialTable, TrialJournal
+from trajectory import drift_path, n_path_frames
+from logsink import AsyncLogFile
+from frames import FrameMarkers, save_intervals, saved_frames
+from profiling import FrameProfiler, UPDATE, DRAW, FLIP
+from realtime import RealTimeMode, default_cpus
+from inputs import InputListener
+from messages import make_messages
+from adaptive import AdaptiveSampler
 
 import numpy as np
 from pathlib import Path
-import pandas as pd
 from itertools import product
 
 # =========================================================================== #
@@ -28,6 +35,7 @@ input_gui.addField('Age: ', choices=list(range(18, 81)))
 input_gui.addField('Vision: ', choices=["Normal", "Corrected", "Other"])
 input_gui.addField('Participant Number: ', choices=list(range(1, 25)))
 input_gui.addField('Debug: ', choices=[True, False])
+input_gui.addField('Adaptive: ', choices=[False, True])  # stop the conditions that are precise enough
 
 # show
 part_info = input_gui.show()
@@ -37,11 +45,12 @@ if not part_info.OK:
 # check debug
 debug = part_info.data[4]
 if not debug:
-    sub_init = part_info.data[1]
+    sub_init = part_info.data[0]
     sub_id = part_info.data[3]
 else:
     sub_init = 'gg'
     sub_id = 0
+adaptive = bool(part_info.data[5])
 
 # Directories and files
 EXP = "DoubleDriftODC"
@@ -54,8 +63,25 @@ run_file = PARTDIR / f"sub-{sub_id:02d}_task-{TASK}_part-{PART}_exp-{EXP}"
 # file names
 exp_file = str(run_file)
 frames_file = str(run_file) + "_frame-intervals.log"
+markers_file = str(run_file) + "_frame-markers.tsv"
 log_file = str(run_file) + "_runtime-log.log"
 
+# a saved session of the participant is continued if it is unfinished, and a finished one is never overwritten
+resume = False
+saved_session = None if debug else TrialJournal.saved_progress(exp_file)
+if saved_session is not None:
+    n_saved, n_planned, finished = saved_session
+    resume_gui = gui.Dlg(title=">_<")
+    if finished:
+        resume_gui.addText(f"sub-{sub_id:02d} has already finished the prescan. Check the participant number.")
+        resume_gui.show()
+        core.quit()
+    resume_gui.addText(f"sub-{sub_id:02d} has an unfinished prescan ({n_saved} of {n_planned} trials). Continue it?")
+    resume_gui.show()
+    if not resume_gui.OK:
+        core.quit()
+    resume = True
+
 # Monitor
 mon_name = 'Asus'
 mon_specs = get_monitors(mon_name)
@@ -73,6 +99,13 @@ else:
     full_screen = True
     fake_ans = False
 
+# per-frame profiling of the render loops, saved next to the data file
+profile_frames = False
+
+# real-time mode: garbage collection only in idle phases, higher priority, and warm-up frames before the first trial
+realtime_mode = True
+realtime_cpus = default_cpus()  # CPUs the session is pinned to (all but the first one). None leaves them to the OS
+
 # Window
 exp_win = visual.Window(
     monitor=exp_mon,
@@ -88,7 +121,8 @@ exp_win = visual.Window(
 # Logging
 log_clock = core.Clock()
 logging.setDefaultClock(log_clock)
-log_data = logging.LogFile(log_file, filemode='w', level=logging.INFO)
+# written to disk at idle points. A continued session adds to the log of the interrupted one
+log_data = AsyncLogFile(log_file, filemode='a' if resume else 'w', level=logging.INFO)
 logging.console.setLevel(logging.ERROR)
 
 # =========================================================================== #
@@ -126,10 +160,6 @@ resp_line = visual.Line(
     autoLog=False
 )
 
-# Text messages
-msg_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, alignText='left', autoLog=False)
-rep_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, pos=[0, -5], autoLog=False)
-
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
 # ------------------------------ ! PROCEDURE -------------------------------- #
@@ -137,20 +167,20 @@ rep_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, pos=[0, -5], au
 # =========================================================================== #
 
 # Instructions
-resp_stages = ['Length', 'Orientation']  # reporting stages
-resp_order = np.random.rand() < .5
-resp_stages = [resp_stages[resp_order],
-               resp_stages[1 - resp_order]]  # so order 0 is [length, orientation] and order 1 is [orientation, length]
+stages = ['Length', 'Orientation']  # reporting stages
+resp_order = int(np.random.rand() < .5)
+resp_stages = [stages[resp_order],
+               stages[1 - resp_order]]  # so order 0 is [length, orientation] and order 1 is [orientation, length]
 
 instr_msg = \
     "On each trial, maintain fixation at the center of the screen on the black circle.\n\n" \
     "Pay attention to the path that the Gabor moves on.\n\n" \
     "When the Gabor disappears, a line appears on the fixation circle.\n\n" \
-    f"First, use the mouse wheel to change the {resp_stages[0]} of the line to match the {resp_stages[0]} of the " \
-    f"Gabor's path.\n\n" \
-    f"Press the Spacebar when you are done adjusting the {resp_stages[0]}.\n\n" \
-    f"Then, use the mouse wheel to change the {resp_stages[1]} of the line to match the {resp_stages[1]} of the " \
-    f"Gabor's path.\n\n" \
+    "First, use the mouse wheel to change the {0} of the line to match the {0} of the " \
+    "Gabor's path.\n\n" \
+    "Press the Spacebar when you are done adjusting the {0}.\n\n" \
+    "Then, use the mouse wheel to change the {1} of the line to match the {1} of the " \
+    "Gabor's path.\n\n" \
     "Again, press the Spacebar to submit your report and move on to the next trial.\n\n" \
     "Press the spacebar to start the experiment..."
 
@@ -182,50 +212,39 @@ cols = [
 ]
 
 # blocks and trials
-exp_blocks = None  # actual dataframe
-
-# in the speed block, speeds are varied. In the duration block, durations are varied.
 conds = list(product(speeds, quadrants))
 n_trials = n_trials_per_cond * len(conds)  # total number of trials in the blocks
 
-# loop through conditions, make every permutation, and save it to a numpy array
-rows = None
-for cond in list(conds):
-    row = np.array([
-        int(resp_order),
-        cond[0][0],  # internal speed
-        cond[0][1],  # external speed
-        cond[1],  # quadrant
-        np.NaN,  # reported orientation
-        np.NaN,  # reported length
-        np.NaN,  # trial
-        TASK,  # task
-        EXP,  # experiment
-        sub_id,  # subject ID
-        sub_init,  # subject's initials
-    ])
-    if rows is None:
-        rows = row
-    else:
-        rows = np.vstack((rows, row))
-
-# repeat conditions for however many trials
-this_block = np.repeat(rows, n_trials_per_cond, axis=0)
-
-# shuffle them
-np.random.shuffle(this_block)  # this preserves the order within row and just shuffles the rows
+# make every permutation of conditions, repeat them, and shuffle the rows in one go
+design = build_design({("V_INTERNAL", "V_EXTERNAL"): speeds, "QUADRANT": quadrants}, n_reps=n_trials_per_cond)
 
 # sanity check
-# print(f"Shape of block {b}: {this_block.shape}")
-assert this_block.shape == (n_trials, len(cols))
+assert design.shape == (n_trials,)
+
+# actual dataframe
+# speeds and quadrant come from the design, responses are filled in the trial loop,
+# and session-level columns are stored only once
+exp_blocks = TrialTable(
+    cols,
+    design,
+    meta={
+        "RESP_ORDER": resp_order,
+        "TASK": TASK,
+        "EXPERIMENT": EXP,
+        "SUBJECT_ID": sub_id,
+        "SUB_INITIALS": sub_init
+    },
+    dtypes={"TRIAL": np.int64}
+)
+exp_blocks["TRIAL"][:] = np.arange(1, n_trials + 1)  # trial labels are ordered numbers
 
-# add trial labels
-this_block[:, 6] = np.arange(1, n_trials + 1)  # trial is the 7(-1)th col. set it to a list of ordered numbers
+# every completed trial is saved in a journal, so an interrupted session can be continued
+journal = TrialJournal(exp_file, exp_blocks)
+first_trial = journal.open(resume=resume)
 
-if exp_blocks is None:
-    exp_blocks = this_block
-else:
-    exp_blocks = np.vstack((exp_blocks, this_block))
+# a continued session keeps its own trial order and response order
+resp_order = exp_blocks["RESP_ORDER"]
+resp_stages = [stages[resp_order], stages[1 - resp_order]]
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -243,34 +262,77 @@ gabor.sf = gab_sf
 
 # runtime params
 exp_win.refreshThreshold = (1 / mon_specs["refresh_rate"]) + 0.003
+refresh_rate = int(mon_specs["refresh_rate"])
 path_dur = 1000  # milli-second
-n_frames = np.floor(path_dur * int(mon_specs["refresh_rate"]) / 1000)
+n_frames = 2 * n_path_frames(refresh_rate, path_dur / 1000)  # up and down the path
+
+# trial parameters: precomputed phase and position of the gabor on every frame (shared between trials with the same
+# speeds and quadrant), and views of the response columns
+gab_starts = np.where(exp_blocks["QUADRANT"] == "L", -gab_shift, gab_shift)  # gabors start on the horizontal meridian
+trial_speeds = zip(exp_blocks["V_INTERNAL"].tolist(), exp_blocks["V_EXTERNAL"].tolist(), gab_starts.tolist())
+drift_paths = [drift_path(v_int, v_ext, refresh_rate, path_dur / 1000, (x, 0)) for v_int, v_ext, x in trial_speeds]
+resp_oris = exp_blocks["RESP_ORI"]
+resp_lengths = exp_blocks["RESP_LENGTH"]
+
+# adaptive mode: running estimates of every condition, and the trials of the conditions that are done are skipped
+trial_conds = list(zip(exp_blocks["V_INTERNAL"].tolist(), exp_blocks["V_EXTERNAL"].tolist(),
+                       exp_blocks["QUADRANT"].tolist()))
+sampler = AdaptiveSampler([(v_int, v_ext, quad) for (v_int, v_ext), quad in conds], max_trials=n_trials_per_cond)
+for trial in range(first_trial):  # a continued session picks up the estimates of its completed trials
+    sampler.update(trial_conds[trial], resp_oris[trial], resp_lengths[trial])
+
+# text messages, each laid out once
+msg_stims = make_messages(
+    exp_win,
+    {"instr": instr_msg.format(*resp_stages), "end": end_msg},
+    wrapWidth=30, height=.8, alignText='left'
+)
+rep_stims = make_messages(exp_win, {stage: f"Match {stage.lower()}" for stage in stages}, wrapWidth=30, height=.8,
+                          pos=[0, -5])
 
 # clocks
 exp_clock = core.Clock()
 
+# start of every trial phase in the frame intervals
+frame_markers = FrameMarkers(exp_win, first_frame=saved_frames(frames_file) if resume else 0)
+profiler = FrameProfiler(phases=["drift", "response"], enabled=profile_frames)
+realtime = RealTimeMode(enabled=realtime_mode, cpus=realtime_cpus)
+logging.exp(realtime.start())
+
+# draw every stimulus a few times so everything is on the GPU before the first trial
+exp_win.recordFrameIntervals = True
+realtime.warm_up(exp_win, [gabor, fix, resp_line, *rep_stims.values(), *msg_stims.values()], n_frames=5,
+                 markers=frame_markers)
+
 # show instructions and wait for keypress
-msg_stim.text = instr_msg
-msg_stim.draw()
+msg_stims["instr"].draw()
 exp_win.flip()
 event.waitKeys(keyList=['space'])
 logging.exp("===========================")
-logging.exp("Experiment started")
+logging.exp("Experiment started" if not first_trial else f"Experiment continued from trial {first_trial + 1}")
 logging.exp("===========================")
 exp_win.flip()
 exp_clock.reset()
 
+# the wheel steps and the keys are collected as single events (the keys on a background thread) and drained once per
+# frame, instead of reading the mouse and the keyboard on every flip
+event.Mouse(visible=False, win=exp_win)
+inputs = InputListener(exp_clock, keys=['space', 'escape'], win=exp_win)
+inputs.start()
+
 # start trials
-for trial in range(n_trials):
+for trial in range(first_trial, n_trials):
+
+    # skip the conditions that need no more trials
+    if adaptive and sampler.done(trial_conds[trial]):
+        continue
 
     # log it
     logging.exp(f"---------------------------")
     logging.exp(f"Trial {trial} started.")
 
     # run parameters
-    # from Hz to cycles/frame
-    v_tex = [exp_blocks[trial, 1] / mon_specs["refresh_rate"], 0]
-    v_env = [0, exp_blocks[trial, 2] / mon_specs["refresh_rate"]]
+    phases, positions = drift_paths[trial]
 
     # start recording frames
     exp_win.recordFrameIntervals = True
@@ -280,33 +342,31 @@ for trial in range(n_trials):
 
     # log it
     logging.exp("Moving the stimulus.")
+    frame_markers.mark(trial, "drift")
+    profiler.set_context(trial, "drift")
+    realtime.stimulus_phase()
 
-    # show the drift
-    for rep in range(2):
-
-        # control drawing every frame
-        for frame in range(n_frames):
+    # show the drift: drift right and move up, then drift left and move down
+    for frame in range(n_frames):
 
-            # drift right / move up on odd repetitions
-            if not rep:
-                gabor.phase += v_tex
-                gabor.pos += v_env
+        profiler.start()
+        gabor.phase = phases[frame]
+        gabor.pos = positions[frame]
+        profiler.lap(UPDATE)
 
-            # drift left / move down on even repetitions
-            else:
-                gabor.phase -= v_tex
-                gabor.pos -= v_env
-
-            gabor.draw()
-            exp_win.flip()
+        gabor.draw()
+        profiler.lap(DRAW)
+        exp_win.flip()
+        profiler.lap(FLIP)
 
     # Get the response
+    frame_markers.mark(trial, "response")
+    profiler.set_context(trial, "response")
+    realtime.idle_phase()
+
     # clean buffer
     event.clearEvents()
 
-    # reporting device
-    ans_mouse = event.Mouse(visible=False, win=exp_win)
-
     # initialize response line length and ori every trial
     resp_line.size = .1 if resp_stages[0] == 'Length' else 1  # starting line size with 1 dva
     resp_line.ori = 90
@@ -314,28 +374,24 @@ for trial in range(n_trials):
     # for debugging
     if not fake_ans:
 
-        # text message
-        rep_stim.autoDraw = True
-
         # reporting stages
         for stage in resp_stages:
 
             # get response
             resp = True
+            inputs.clear()
 
             # reporting loop
             while resp:
 
-                # mouse wheel for controlling the line
-                wheel_dX, wheel_dY = ans_mouse.getWheelRel()
+                profiler.start()
+
+                # mouse wheel for controlling the line, and the keys, since the last frame
+                events = inputs.drain()
+                wheel_dY = sum(ev.value for ev in events if ev.source == "wheel")
 
                 # change the orientation
                 if stage == 'Orientation':
-
-                    # text message
-                    rep_stim.text = "Match orientation"
-                    rep_stim.draw()
-
                     if 0 <= resp_line.ori < 180:  # don't allow weird responses
                         resp_line.setOri(wheel_dY * 2, '-')
                     else:
@@ -343,48 +399,48 @@ for trial in range(n_trials):
 
                 # change the length
                 else:
-
-                    # text message
-                    rep_stim.text = "Match length"
-                    rep_stim.draw()
-
                     if resp_line.size > 0:  # don't allow below 0 size!
                         resp_line.size += wheel_dY * .05
                     else:
                         resp_line.size = .1
+                profiler.lap(UPDATE)
 
+                rep_stims[stage].draw()  # text message
                 resp_line.draw()
+                profiler.lap(DRAW)
                 exp_win.flip()
+                profiler.lap(FLIP)
 
                 # get the keypress for end of reporting
-                keys = event.getKeys()
+                presses = [ev for ev in events if ev.source == "keyboard"]
 
-                for key in keys:
+                for press in presses:
 
                     # space is the end of reporting
-                    if key == 'space':
+                    if press.value == 'space':
 
                         # save the orientation
                         if stage == 'Orientation':
-                            exp_blocks[trial, 4] = resp_line.ori
+                            resp_oris[trial] = resp_line.ori
 
                         # save the length
                         else:
                             # sometimes .size returns an np array!
                             try:
                                 # the default response line size=1 means 2dva
-                                exp_blocks[trial, 5] = np.round(resp_line.size, 2)
+                                resp_lengths[trial] = np.round(resp_line.size, 2)
                             except:
-                                exp_blocks[trial, 5] = np.round(resp_line.size[0], 2)
+                                resp_lengths[trial] = np.round(resp_line.size[0], 2)
 
                         # log and end reporting
-                        logging.exp(f"Response recorded: {exp_blocks[trial, 4]}")
+                        logging.exp(f"Response recorded: {resp_oris[trial]} at {press.time:.3f}")
                         resp = False  # end reporting
-                        rep_stim.autoDraw = False
 
                     # escape is quitting
-                    elif key == 'escape':  # quit button
+                    elif press.value == 'escape':  # quit button
                         logging.error("Aborted experiment.")
+                        inputs.stop()
+                        journal.close()
                         exp_win.close()
                         core.quit()
 
@@ -393,8 +449,8 @@ for trial in range(n_trials):
         # just generate fake responses
         exp_win.flip()
         core.wait(4)  # approximate response time
-        exp_blocks[trial, 4] = .33  # random orientation
-        exp_blocks[trial, 5] = .69  # random size
+        resp_oris[trial] = .33  # random orientation
+        resp_lengths[trial] = .69  # random size
 
     # Turn fixation off
     fix.autoDraw = False
@@ -402,6 +458,11 @@ for trial in range(n_trials):
     # clear buffer
     event.clearEvents()
     logging.exp(f"Trial ended.")
+    if sampler.update(trial_conds[trial], resp_oris[trial], resp_lengths[trial]) and adaptive:
+        logging.exp(f"Condition {trial_conds[trial]} done after {sampler.n[trial_conds[trial]]} trials. "
+                    f"{len(sampler.remaining)} conditions remaining.")
+    journal.append(trial)
+    log_data.commit()
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -409,25 +470,34 @@ for trial in range(n_trials):
 # --------------------------------------------------------------------------- #
 # =========================================================================== #
 
+# stop listening to the keys and the wheel
+inputs.stop()
+
 # time it
 t_end = np.round(exp_clock.getTime() / 60, 2)
-logging.exp(f"Experiment finished. Duration: {t_end} minutes.")
+logging.exp(f"Experiment finished. Duration: {t_end} minutes. {sum(sampler.n.values())} trials completed.")
 print(f"Experiment finished. Duration: {t_end} minutes.")
 
 # show than you message
-msg_stim.text = end_msg
-msg_stim.draw()
+msg_stims["end"].draw()
 exp_win.flip()
 core.wait(2)
 exp_win.logOnFlip("Experiment ended.", level=logging.EXP)
 exp_win.flip()
 
-# save in csv
-exp_df = pd.DataFrame(exp_blocks, columns=cols)  # turn it into a pandas dataframe
-exp_df.to_csv(exp_file + '.csv', sep=',', index=False)
+# save in csv (rebuilt from the journal of the trials), and don't continue the session when it is started again
+journal.close()
+journal.finish()
+journal.to_csv(exp_file + '.csv')
 
 # save recorded frames
-exp_win.saveFrameIntervals(fileName=frames_file)
-
+save_intervals(exp_win, frames_file, append=resume)
+frame_markers.save(markers_file, append=resume)
+profiler.save(str(run_file) + "_frame-profile")
+profiler.close()
+logging.exp(realtime.report())
+realtime.stop()
+
+log_data.close()
 exp_win.close()
 core.quit()
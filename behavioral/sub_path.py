@@ -6,24 +6,314 @@ Created at 10/24/21
 Description: Script to calculate the mean of the path length and orientation for a subject based on their report and
 shows the parameters that lead to the largest illusion size. It also shows the dimensions of the checkerboard that
 should be used as the input to the fmri script for the subject.
+
+All the prescan files under the data directory are summarized together: the csv files are loaded in parallel, and
+the statistics of every subject, speed condition and quadrant (hemifield) are computed in one groupby. The summary
+tables are saved in data/derivatives and reused the next time, so only the subjects whose csv file changed are
+computed again.
+The subjects table is also where fmri/run_scan.py gets the path orientation and length of a subject from.
+
+Orientations are the reported tilt of the path from vertical (clockwise is positive, in (-90, 90]). Since a path has
+no direction, their circular statistics are computed on the doubled angles. The circular mean tilt and the mean
+length of every condition get bootstrap confidence intervals (see bootstrap.py).
+
+The quadrants are never pooled: the illusion can tilt the other way in the other hemifield, and the reports of
+mirrored tilts would average towards vertical. Every statistic is per quadrant, the best speeds are the ones with the
+largest tilt averaged over the quadrants (in size, so mirrored tilts don't cancel), and the path orientation and
+length for the fmri experiment are given for each quadrant (PATH_ORI_L, PATH_ORI_R, ...).
+
+Usage: python sub_path.py [subject numbers...]
 """
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pandas as pd
 import sys
 
-# Get subject number
-if len(sys.argv) > 1:
-    sub_id = f"{sys.argv[1]}:02d"
+import numpy as np
+import pandas as pd
+
+from bootstrap import bootstrap_ci
 
 # Paths
 ROOTDIR = Path(__file__).resolve().parent.parent
 DATADIR = ROOTDIR / "data"
 EXP = "DoubleDriftODC"
-PART = "behavioral"
+PART = "psychophysics"
 TASK = "IllusionSize"
-data_file = DATADIR / f"sub-{sub_id}" / PART / f"sub-{sub_id}_task-{TASK}_part-{PART}_exp-{EXP}.csv"
 
-# Load the file
-df = pd.read_csv(data_file)
+CONDITIONS = ["V_INTERNAL", "V_EXTERNAL"]
+GROUPS = ["SUBJECT_ID", *CONDITIONS, "QUADRANT"]  # the quadrants aren't pooled
+TRIAL_COLS = [*GROUPS, "RESP_ORI", "RESP_LENGTH"]
+SUBJECTS_FILE = "illusion-size_subjects.tsv"
+CONDITIONS_FILE = "illusion-size_conditions.tsv"
+
+
+def data_file(sub_id, data_dir=DATADIR):
+    """Prescan csv file of a subject"""
+    sub = f"sub-{sub_id:02d}"
+    return Path(data_dir) / sub / PART / f"{sub}_task-{TASK}_part-{PART}_exp-{EXP}.csv"
+
+
+def find_subjects(data_dir=DATADIR):
+    """
+    Finds the prescan files under a data directory.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+
+    Returns
+    -------
+    dict
+        maps the subject numbers to their csv files
+    """
+    files = {}
+    for sub_dir in sorted(Path(data_dir).glob("sub-*")):
+        try:
+            sub_id = int(sub_dir.name[4:])
+        except ValueError:
+            continue
+        if data_file(sub_id, data_dir).exists():
+            files[sub_id] = data_file(sub_id, data_dir)
+    return files
+
+
+def load_trials(file_name):
+    """
+    Loads the completed trials of a prescan file.
+
+    Parameters
+    ----------
+    file_name : str or Path
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    trials = pd.read_csv(file_name, usecols=TRIAL_COLS)
+    return trials.dropna(subset=["RESP_ORI", "RESP_LENGTH"])
+
+
+def path_tilt(ori):
+    """
+    Tilt of the reported path from vertical.
+
+    Parameters
+    ----------
+    ori : array_like
+        orientation of the response line in degrees
+
+    Returns
+    -------
+    np.ndarray
+        in degrees, in (-90, 90]
+    """
+    return 90 - np.mod(90 - np.asarray(ori, dtype=float), 180)
+
+
+def describe(trials, by):
+    """
+    Statistics of the reports in every group of trials.
+
+    Parameters
+    ----------
+    trials : pd.DataFrame
+        trials of one or more subjects
+    by : list of str
+        columns to group by
+
+    Returns
+    -------
+    pd.DataFrame
+        number of trials, mean, median and circular mean of the tilt, the mean resultant length of the tilt (1 when
+        every report is the same), and mean, median and sd of the length
+    """
+    tilt = path_tilt(trials["RESP_ORI"])
+    doubled = np.deg2rad(2 * tilt)
+    stats = trials.assign(TILT=tilt, SIN2=np.sin(doubled), COS2=np.cos(doubled)).groupby(by).agg(
+        N_TRIALS=("TILT", "size"),
+        ORI_MEAN=("TILT", "mean"),
+        ORI_MEDIAN=("TILT", "median"),
+        SIN2=("SIN2", "mean"),
+        COS2=("COS2", "mean"),
+        LEN_MEAN=("RESP_LENGTH", "mean"),
+        LEN_MEDIAN=("RESP_LENGTH", "median"),
+        LEN_SD=("RESP_LENGTH", "std")
+    )
+    stats.insert(3, "ORI_CIRC_MEAN", np.rad2deg(np.arctan2(stats["SIN2"], stats["COS2"])) / 2)
+    stats.insert(4, "ORI_CIRC_R", np.hypot(stats["SIN2"], stats["COS2"]))
+    return stats.drop(columns=["SIN2", "COS2"])
+
+
+def condition_cis(trials, n_boot=10000, ci=.95, seed=None):
+    """
+    Bootstrap confidence intervals of the circular mean tilt and the mean length of every subject, speed condition and
+    quadrant.
+
+    Parameters
+    ----------
+    trials : pd.DataFrame
+    n_boot : int
+    ci : float
+    seed : int
+
+    Returns
+    -------
+    pd.DataFrame
+        lower and upper bounds of the intervals
+    """
+    by = GROUPS
+    tilts = trials.assign(TILT=path_tilt(trials["RESP_ORI"]))
+    ori = bootstrap_ci(tilts, "TILT", by, "circmean", n_boot, ci, 180., seed)
+    length = bootstrap_ci(trials, "RESP_LENGTH", by, "mean", n_boot, ci, seed=seed)
+    return pd.DataFrame({
+        "ORI_CI_LOW": ori["CI_LOW"],
+        "ORI_CI_HIGH": ori["CI_HIGH"],
+        "LEN_CI_LOW": length["CI_LOW"],
+        "LEN_CI_HIGH": length["CI_HIGH"]
+    })
+
+
+def best_conditions(conditions):
+    """
+    The speed condition with the largest illusion of every subject: the size of the circular mean tilt (its distance
+    from vertical) averaged over the quadrants.
+
+    Parameters
+    ----------
+    conditions : pd.DataFrame
+        output of describe grouped by subject, speeds and quadrant
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per subject with the speeds, and the path orientation and length of every quadrant to use in the fmri
+        experiment (with their confidence intervals if the conditions have them)
+    """
+    size = conditions["ORI_CIRC_MEAN"].abs().groupby(level=["SUBJECT_ID", *CONDITIONS]).mean()
+    best = size.groupby(level="SUBJECT_ID").idxmax()
+    rows = conditions[conditions.index.droplevel("QUADRANT").isin(best.to_list())]
+    quadrants = rows.droplevel(CONDITIONS).unstack("QUADRANT")
+
+    speeds = pd.DataFrame(best.to_list(), columns=["SUBJECT_ID", *CONDITIONS]).set_index("SUBJECT_ID")
+    table = pd.DataFrame({"BEST_V_INTERNAL": speeds["V_INTERNAL"], "BEST_V_EXTERNAL": speeds["V_EXTERNAL"]})
+    for stat, path in (("ORI_CIRC_MEAN", "PATH_ORI"), ("LEN_MEAN", "PATH_LEN")):
+        for quad in quadrants[stat].columns:
+            table[f"{path}_{quad}"] = quadrants[stat][quad]
+    for stat, path in (("ORI", "PATH_ORI"), ("LEN", "PATH_LEN")):
+        if f"{stat}_CI_LOW" in quadrants:
+            for quad in quadrants[f"{stat}_CI_LOW"].columns:
+                for bound in ("LOW", "HIGH"):
+                    table[f"{path}_{quad}_CI_{bound}"] = quadrants[f"{stat}_CI_{bound}"][quad]
+    return table
+
+
+def quadrant_summary(trials):
+    """
+    Statistics of all the reports of every subject in each quadrant, one row per subject.
+
+    Parameters
+    ----------
+    trials : pd.DataFrame
+
+    Returns
+    -------
+    pd.DataFrame
+        the columns of describe with the quadrant at the end of their names (e.g. ORI_CIRC_MEAN_L)
+    """
+    stats = describe(trials, ["SUBJECT_ID", "QUADRANT"]).unstack("QUADRANT")
+    stats.columns = [f"{stat}_{quad}" for stat, quad in stats.columns]
+    return stats
+
+
+def _file_stamp(file_name):
+    stat = Path(file_name).stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def summarize(data_dir=DATADIR, n_jobs=None, force=False, n_boot=10000, seed=None):
+    """
+    Summary tables of all the subjects, computed again only for the subjects whose csv file changed since the last
+    summary. The tables are saved in data_dir/derivatives.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+    n_jobs : int
+        number of processes that load the csv files. Defaults to the number of CPUs.
+    force : bool
+        compute every subject again
+    n_boot : int
+        number of bootstrap resamples for the confidence intervals of the conditions. 0 skips them.
+    seed : int
+        seed of the bootstrap
+
+    Returns
+    -------
+    tuple of pd.DataFrame
+        (subjects, conditions): one row per subject with its best speeds and the statistics of each quadrant, and one
+        row per subject, speed condition and quadrant
+    """
+    data_dir = Path(data_dir)
+    out_dir = data_dir / "derivatives"
+    files = find_subjects(data_dir)
+    stamps = {sub_id: _file_stamp(f) for sub_id, f in files.items()}
+
+    # the last summary, without the subjects that changed or are gone
+    subjects = conditions = None
+    if not force and (out_dir / SUBJECTS_FILE).exists() and (out_dir / CONDITIONS_FILE).exists():
+        subjects = pd.read_csv(out_dir / SUBJECTS_FILE, sep='\t', index_col="SUBJECT_ID")
+        conditions = pd.read_csv(out_dir / CONDITIONS_FILE, sep='\t')
+        if "QUADRANT" in conditions:
+            conditions = conditions.set_index(GROUPS)
+            cached = [
+                sub_id for sub_id in subjects.index
+                if stamps.get(sub_id) == (subjects.at[sub_id, "SOURCE_MTIME_NS"], subjects.at[sub_id, "SOURCE_SIZE"])
+            ]
+        else:  # a summary from before the quadrants were kept apart
+            cached = []
+        subjects = subjects.loc[cached]
+        conditions = conditions[conditions.index.get_level_values("SUBJECT_ID").isin(cached)]
+    todo = [sub_id for sub_id in files if subjects is None or sub_id not in subjects.index]
+
+    # load the new and changed subjects in parallel and describe them all at once
+    if todo:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            trials = pd.concat(pool.map(load_trials, [files[sub_id] for sub_id in todo]), ignore_index=True)
+        new_conditions = describe(trials, GROUPS)
+        if n_boot:
+            new_conditions = new_conditions.join(condition_cis(trials, n_boot, seed=seed))
+        new_subjects = best_conditions(new_conditions).join(quadrant_summary(trials))
+        new_subjects["SOURCE_MTIME_NS"] = [stamps[sub_id][0] for sub_id in new_subjects.index]
+        new_subjects["SOURCE_SIZE"] = [stamps[sub_id][1] for sub_id in new_subjects.index]
+
+        subjects = new_subjects if subjects is None else pd.concat([subjects, new_subjects])
+        conditions = new_conditions if conditions is None else pd.concat([conditions, new_conditions])
+
+    if subjects is None:
+        return pd.DataFrame(), pd.DataFrame()
+    subjects, conditions = subjects.sort_index(), conditions.sort_index()
+
+    out_dir.mkdir(exist_ok=True)
+    subjects.to_csv(out_dir / SUBJECTS_FILE, sep='\t')
+    conditions.to_csv(out_dir / CONDITIONS_FILE, sep='\t')
+
+    return subjects, conditions
+
+
+if __name__ == '__main__':
+
+    # Get subject numbers
+    sub_ids = [int(arg) for arg in sys.argv[1:]]
 
+    sub_table, cond_table = summarize(DATADIR)
+    if sub_table.empty:
+        sys.exit(f"No prescan data in {DATADIR}")
+    if sub_ids:
+        sub_table = sub_table.loc[sub_table.index.intersection(sub_ids)]
+        cond_table = cond_table[cond_table.index.get_level_values("SUBJECT_ID").isin(sub_ids)]
 
+    pd.set_option("display.width", 160)
+    print(cond_table.drop(columns=["ORI_MEDIAN", "LEN_MEDIAN"]).round(2).to_string())
+    print()
+    print("Path parameters for the fmri experiment (orientation in degrees, length as reported):")
+    print(sub_table.filter(regex="^(BEST|PATH)_|N_TRIALS").round(2).to_string())
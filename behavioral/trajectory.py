@@ -0,0 +1,72 @@
+#!usr/bin/env python
+"""
+Precomputed double-drift trajectories
+
+The gabor drifts up its path for one duration and comes back down for another. Instead of adding the speeds to the
+gabor's phase and position on every frame, the whole path is computed once from the frame number, so it has no
+accumulated floating point error and the frame loop only indexes into the arrays.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+
+def n_path_frames(refresh_rate, path_dur=1.):
+    """
+    Number of frames for one direction of the path.
+
+    Parameters
+    ----------
+    refresh_rate : int
+        in Hz
+    path_dur : float
+        in seconds
+
+    Returns
+    -------
+    int
+    """
+    return int(np.floor(path_dur * refresh_rate + 1e-9))
+
+
+@lru_cache(maxsize=None)
+def drift_path(v_internal, v_external, refresh_rate, path_dur=1., start=(0., 0.)):
+    """
+    Makes the per-frame phase and position of a double-drift gabor going up and coming back down.
+    Results are cached, so every (speeds, refresh rate, start) combination is only computed once per session.
+
+    Parameters
+    ----------
+    v_internal : float
+        internal (texture) speed in cycles per second
+    v_external : float
+        external (envelope) speed in degrees per second
+    refresh_rate : int
+        in Hz
+    path_dur : float
+        duration of one direction of the path in seconds
+    start : tuple
+        starting position of the gabor in degrees
+
+    Returns
+    -------
+    tuple of np.ndarray
+        phases and positions, each with the shape (2 * n_frames, 2). They are read-only since they are shared.
+    """
+    n_frames = n_path_frames(refresh_rate, path_dur)
+
+    # frames since the start: up for n_frames, then back down to the start
+    steps = np.concatenate([np.arange(1, n_frames + 1), np.arange(n_frames - 1, -1, -1)])
+
+    # texture drifts horizontally (phase wraps around every cycle), envelope moves vertically
+    phases = np.zeros((len(steps), 2))
+    phases[:, 0] = np.mod(steps * v_internal / refresh_rate, 1)
+
+    positions = np.empty((len(steps), 2))
+    positions[:, 0] = start[0]
+    positions[:, 1] = start[1] + steps * v_external / refresh_rate
+
+    phases.flags.writeable = False
+    positions.flags.writeable = False
+
+    return phases, positions
@@ -0,0 +1,89 @@
+#!usr/bin/env python
+"""
+Frame-time benchmark of counter-phase checkerboard flicker: the old lists of Rect stimuli (one draw call per check)
+against the single-texture checkerboards. The textures are rasters of the same overlapping Rects at the resolution of
+the window, so both draw the same stimulus.
+
+Needs a display. Usage: python benchmarks/bench_checkerboard.py [n_frames]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from psychopy import visual
+from psychopy.tools.monitorunittools import deg2pix
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOTDIR / "fmri"))
+from checkerboard import make_checkerboards  # noqa: E402
+
+
+def rect_checkerboards(win, x_offset, path_ori, sqr_sz=3, n_sqrs=8):
+    """The checkerboards as they used to be made in run_scan.py"""
+    checkers = {}
+    for lr in ["left", "right"]:
+        for pat in ["pat1", "pat2"]:
+            for ori in ["vert", "obl"]:
+                checkers[f"{lr}_{pat}_{ori}"] = [
+                    visual.Rect(
+                        win=win,
+                        size=sqr_sz,
+                        pos=[-x_offset if lr == "left" else x_offset, sqr_sz / 2 + s],
+                        lineColor=0,
+                        ori=0 if (ori == "vert") else path_ori,
+                        fillColor=(1 if s % 2 else -1) if (pat == "pat1") else (-1 if s % 2 else 1),
+                        autoLog=False
+                    )
+                    for s in range(n_sqrs)
+                ]
+    return checkers
+
+
+def run_flicker(win, draw_side, n_frames, flicker_frames=4):
+    """Flickers both sides in counter-phase and returns the draw times and frame intervals in ms"""
+    draw_times = np.empty(n_frames)
+    win.recordFrameIntervals = False
+    win.frameIntervals = []
+    win.flip()
+    win.recordFrameIntervals = True
+
+    for frame in range(n_frames):
+        pat = "pat1" if (frame // flicker_frames) % 2 else "pat2"
+        t0 = time.perf_counter()
+        for side in ["left", "right"]:
+            draw_side(f"{side}_{pat}_obl")
+        draw_times[frame] = time.perf_counter() - t0
+        win.flip()
+
+    win.recordFrameIntervals = False
+    return draw_times * 1000, np.asarray(win.frameIntervals) * 1000
+
+
+def summarize(name, draw_ms, frame_ms, threshold_ms):
+    print(f"{name:>8}: draw {np.mean(draw_ms):6.3f} ms (95th {np.percentile(draw_ms, 95):6.3f}), "
+          f"frame {np.mean(frame_ms):6.3f} ms (95th {np.percentile(frame_ms, 95):6.3f}), "
+          f"dropped {np.sum(frame_ms > threshold_ms)}")
+
+
+if __name__ == '__main__':
+
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1200
+
+    win = visual.Window(size=[1024, 768], units='deg', monitor='testMonitor', fullscr=False, autoLog=False)
+    threshold_ms = 1000 / win.getActualFrameRate() + 3
+
+    rects = rect_checkerboards(win, x_offset=7, path_ori=10)
+    textures = make_checkerboards(win, x_offset=7, path_ori=10, px_per_deg=deg2pix(1, win.monitor))
+
+    def draw_rects(key):
+        for rect in rects[key]:
+            rect.draw()
+
+    def draw_texture(key):
+        textures[key].draw()
+
+    summarize("rects", *run_flicker(win, draw_rects, n_frames), threshold_ms)
+    summarize("texture", *run_flicker(win, draw_texture, n_frames), threshold_ms)
+
+    win.close()
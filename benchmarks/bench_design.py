@@ -0,0 +1,54 @@
+#!usr/bin/env python
+"""
+Benchmark of the trial-table builder against the old np.vstack loop.
+The builder should scale linearly with the number of rows up to 10^6 rows.
+
+Usage: python benchmarks/bench_design.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOTDIR / "behavioral"))
+from dd_helpers import build_design  # noqa: E402
+
+
+def vstack_design(n_levels, n_reps):
+    """The row by row loop that used to build the table in the run scripts"""
+    rows = None
+    for internal in range(n_levels):
+        for quad in ["L", "R"]:
+            row = np.array([internal, internal + 2, quad, np.nan, "IllusionSize"])
+            rows = row if rows is None else np.vstack((rows, row))
+    this_block = np.repeat(rows, n_reps, axis=0)
+    np.random.shuffle(this_block)
+    return this_block
+
+
+def best_time(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(0)
+    n_reps = 10
+
+    print(f"{'rows':>10} {'builder (s)':>12} {'ns/row':>8} {'vstack (s)':>12}")
+    for n_rows in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+
+        # number of speed levels so that levels x quadrants x reps = rows
+        n_levels = n_rows // (2 * n_reps)
+        factors = {
+            ("V_INTERNAL", "V_EXTERNAL"): np.column_stack([np.arange(n_levels), np.arange(n_levels) + 2]),
+            "QUADRANT": ["L", "R"]
+        }
+        t_build = best_time(lambda: build_design(factors, n_reps=n_reps, rng=rng))
+
+        # the old loop is quadratic, so only time it while it is still reasonable
+        t_vstack = best_time(lambda: vstack_design(n_levels, n_reps), repeat=1) if n_rows <= 10 ** 4 else np.nan
+
+        print(f"{n_rows:>10} {t_build:>12.5f} {t_build / n_rows * 1e9:>8.1f} {t_vstack:>12.5f}")
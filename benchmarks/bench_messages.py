@@ -0,0 +1,72 @@
+#!usr/bin/env python
+"""
+Frame-time benchmark of the text prompt in the prescan response loop: setting the text of one TextStim on every frame
+(as the loop used to) against drawing the pre-rendered message of the stage.
+
+Needs a display. Usage: python benchmarks/bench_messages.py [n_frames]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from psychopy import visual
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOTDIR / "behavioral"))
+from messages import make_messages  # noqa: E402
+
+STAGES = ["Length", "Orientation"]
+
+
+def run_prompts(win, draw_prompt, n_frames, stage_frames=60):
+    """Shows the prompt and the response line, switching stages every second, and returns the draw times and frame
+    intervals in ms"""
+    resp_line = visual.Line(win=win, start=(0, 0), end=(0, 1), lineWidth=7, lineColor=-1, autoLog=False)
+    draw_times = np.empty(n_frames)
+    win.recordFrameIntervals = False
+    win.frameIntervals = []
+    win.flip()
+    win.recordFrameIntervals = True
+
+    for frame in range(n_frames):
+        stage = STAGES[(frame // stage_frames) % 2]
+        t0 = time.perf_counter()
+        draw_prompt(stage)
+        resp_line.ori = frame % 180
+        resp_line.draw()
+        draw_times[frame] = time.perf_counter() - t0
+        win.flip()
+
+    win.recordFrameIntervals = False
+    return draw_times * 1000, np.asarray(win.frameIntervals) * 1000
+
+
+def summarize(name, draw_ms, frame_ms, threshold_ms):
+    print(f"{name:>8}: draw {np.mean(draw_ms):6.3f} ms (95th {np.percentile(draw_ms, 95):6.3f}), "
+          f"frame {np.mean(frame_ms):6.3f} ms (95th {np.percentile(frame_ms, 95):6.3f}), "
+          f"dropped {np.sum(frame_ms > threshold_ms)}")
+
+
+if __name__ == '__main__':
+
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1200
+
+    win = visual.Window(size=[1024, 768], units='deg', monitor='testMonitor', fullscr=False, autoLog=False)
+    threshold_ms = 1000 / win.getActualFrameRate() + 3
+
+    rep_stim = visual.TextStim(win=win, wrapWidth=30, height=.8, pos=[0, -5], autoLog=False)
+    rep_stims = make_messages(win, {stage: f"Match {stage.lower()}" for stage in STAGES}, wrapWidth=30, height=.8,
+                              pos=[0, -5])
+
+    def set_text(stage):
+        rep_stim.text = f"Match {stage.lower()}"
+        rep_stim.draw()
+
+    def draw_cached(stage):
+        rep_stims[stage].draw()
+
+    summarize("set text", *run_prompts(win, set_text, n_frames), threshold_ms)
+    summarize("cached", *run_prompts(win, draw_cached, n_frames), threshold_ms)
+
+    win.close()
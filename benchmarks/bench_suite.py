@@ -0,0 +1,382 @@
+#!usr/bin/env python
+"""
+Benchmark suite of the hot paths of the run scripts. It runs against the PsychoPy stubs of simulation/stubs.py, so it
+doesn't need a display.
+
+- design: trial-table generation (build_design and TrialTable) up to 10^6 rows
+- frame: per-frame cost of the prescan drift and response loops and of the scan stimulus loop at 60, 165 and 240 Hz
+- log: runtime log records through AsyncLogFile
+- checkerboard: construction of the checkerboard stimuli
+- export: journal, csv and frame marker files at the end of a session
+
+Drawing and flipping are almost free with the stubs, so the frame timings are the Python cost of the loops, which is
+the part the scripts control. The results are saved as json along with the commit they were measured at. Pass a
+previous results file to compare against it.
+
+Usage: python benchmarks/bench_suite.py [output file] [baseline file]
+"""
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOTDIR / "simulation"), str(ROOTDIR / "behavioral"), str(ROOTDIR / "fmri")]
+from stubs import PsychopyStubs  # noqa: E402
+
+STUBS = PsychopyStubs()
+STUBS.install()
+
+from psychopy import visual, event, logging, core  # noqa: E402
+from dd_helpers import build_design, TrialTable, TrialJournal  # noqa: E402
+from trajectory import drift_path, n_path_frames  # noqa: E402
+from checkerboard import make_checkerboards  # noqa: E402
+from scheduler import BlockScheduler  # noqa: E402
+from logsink import AsyncLogFile  # noqa: E402
+from frames import FrameMarkers  # noqa: E402
+from profiling import FrameProfiler, UPDATE, DRAW, FLIP  # noqa: E402
+from messages import make_messages  # noqa: E402
+from inputs import InputListener  # noqa: E402
+
+REFRESH_RATES = [60, 165, 240]
+PRESCAN_COLS = ["RESP_ORDER", "V_INTERNAL", "V_EXTERNAL", "QUADRANT", "RESP_ORI", "RESP_LENGTH", "TRIAL", "TASK",
+                "EXPERIMENT", "SUBJECT_ID", "SUB_INITIALS"]
+PRESCAN_META = {"RESP_ORDER": 0, "TASK": "IllusionSize", "EXPERIMENT": "DoubleDriftODC", "SUBJECT_ID": 0,
+                "SUB_INITIALS": "gg"}
+
+
+def best_time(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def prescan_table(n_trials):
+    """A prescan trial table with about n_trials rows and made-up responses"""
+    n_speeds = max(1, n_trials // 30)
+    speeds = np.column_stack([np.full(n_speeds, 4), np.arange(3, 3 + n_speeds)])
+    design = build_design({("V_INTERNAL", "V_EXTERNAL"): speeds, "QUADRANT": ["L", "R"]}, n_reps=15)
+    table = TrialTable(PRESCAN_COLS, design, meta=PRESCAN_META, dtypes={"TRIAL": np.int64})
+    table["TRIAL"][:] = np.arange(1, len(table) + 1)
+    table["RESP_ORI"][:] = np.random.uniform(0, 180, len(table))
+    table["RESP_LENGTH"][:] = np.random.uniform(0, 5, len(table))
+    return table
+
+
+# --------------------------------------------------------------------------- #
+# benchmarks, each returns a list of result records
+# --------------------------------------------------------------------------- #
+
+def bench_design(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6), n_reps=10):
+    """Crossed, repeated and shuffled design and its trial table"""
+    results = []
+    for n_rows in sizes:
+        n_levels = n_rows // (2 * n_reps)
+        factors = {
+            ("V_INTERNAL", "V_EXTERNAL"): np.column_stack([np.arange(n_levels), np.arange(n_levels) + 2]),
+            "QUADRANT": ["L", "R"]
+        }
+        t_build = best_time(lambda: build_design(factors, n_reps=n_reps), repeat=3)
+        design = build_design(factors, n_reps=n_reps)
+        t_table = best_time(lambda: TrialTable(PRESCAN_COLS, design, meta=PRESCAN_META), repeat=3)
+        results.append(record("design.build", {"n_rows": n_rows}, t_build * 1e9 / n_rows, "ns/row"))
+        results.append(record("design.table", {"n_rows": n_rows}, t_table * 1e9 / n_rows, "ns/row"))
+    return results
+
+
+def bench_frames(refresh_rates=REFRESH_RATES, n_seconds=20):
+    """Per-frame cost of the render loops, about n_seconds of frames each"""
+    results = []
+    for rate in refresh_rates:
+        STUBS.refresh_rate = rate
+        win = visual.Window(size=[1024, 768], units='deg')
+        n_frames = n_seconds * rate
+        for name, loop in [("frame.prescan_drift", prescan_drift), ("frame.prescan_response", prescan_response),
+                           ("frame.scan_stim", scan_stim)]:
+            profiler = FrameProfiler(size=n_frames, phases=["bench"])
+            profiler.set_context(0, "bench")
+            loop(win, profiler, rate, n_frames)
+            profiler.close()
+            results.append(frame_record(name, profiler, rate))
+    return results
+
+
+def prescan_drift(win, profiler, rate, n_frames):
+    """The drift loop of run_prescan.py, including the path of every trial"""
+    gabor = visual.GratingStim(win=win, mask='gauss', contrast=1, interpolate=False, autoLog=False)
+    n_path = 2 * n_path_frames(rate, 1.)
+    drift_path.cache_clear()
+    for trial in range(int(np.ceil(n_frames / n_path))):
+        phases, positions = drift_path(4, 3 + trial % 3, rate, 1., (-7 if trial % 2 else 7, 0))
+        for frame in range(n_path):
+            profiler.start()
+            gabor.phase = phases[frame]
+            gabor.pos = positions[frame]
+            profiler.lap(UPDATE)
+
+            gabor.draw()
+            profiler.lap(DRAW)
+            win.flip()
+            profiler.lap(FLIP)
+
+
+def prescan_response(win, profiler, rate, n_frames):
+    """The response loop of run_prescan.py with the wheel steps and the keys drained from the input listener, half of
+    it in each stage"""
+    resp_line = visual.Line(win=win, start=(0, 0), end=(0, 1), lineWidth=7, lineColor=-1, autoLog=False)
+    rep_stims = make_messages(win, {stage: f"Match {stage.lower()}" for stage in ["Length", "Orientation"]},
+                              wrapWidth=30, height=.8, pos=[0, -5])
+    event.Mouse(visible=False, win=win)
+    inputs = InputListener(core.Clock(), keys=['space', 'escape'], win=win)
+    inputs.start()
+    resp_line.ori = 90
+    for frame in range(n_frames):
+        stage = "Orientation" if frame < n_frames // 2 else "Length"
+
+        profiler.start()
+        events = inputs.drain()
+        wheel_dY = sum(ev.value for ev in events if ev.source == "wheel")
+        if stage == 'Orientation':
+            if 0 <= resp_line.ori < 180:
+                resp_line.setOri(wheel_dY * 2, '-')
+            else:
+                resp_line.ori = 0
+        else:
+            if resp_line.size > 0:
+                resp_line.size += wheel_dY * .05
+            else:
+                resp_line.size = .1
+        profiler.lap(UPDATE)
+
+        rep_stims[stage].draw()
+        resp_line.draw()
+        profiler.lap(DRAW)
+        win.flip()
+        profiler.lap(FLIP)
+        for press in events:
+            pass
+    inputs.stop()
+
+
+def scan_stim(win, profiler, rate, n_frames):
+    """The stimulus part of a block in run_scan.py: two double-drift gabors, the cued one dims, and the button presses
+    are drained from the input listener"""
+    gabors = {side: visual.GratingStim(win=win, mask='gauss', pos=[x, 0], contrast=1, interpolate=False)
+              for side, x in [("L", -7), ("R", 7)]}
+    fix = visual.Circle(win=win, radius=0.1, fillColor='black', size=.3, autoLog=False)
+    gab_paths = {side: drift_path(4, 5, rate, 1., tuple(gab.pos)) for side, gab in gabors.items()}
+    n_path = len(gab_paths["L"][0])
+    hemi, dim_time, dim_dur = "L", 3., .5
+
+    run_clock = core.Clock()
+    inputs = InputListener(run_clock, keys=['1', '2', '3', '4', 'escape'])
+    inputs.start()
+    scheduler = BlockScheduler({"stim": n_frames / rate}, 1, 1 / rate)
+    scheduler.start(run_clock.getTime())
+    while True:
+        profiler.start()
+        t = max(run_clock.getTime() - scheduler.onset(0), 0)
+        frame = int(t * rate) % n_path
+        for side, gab in gabors.items():
+            gab.phase = gab_paths[side][0][frame]
+            gab.pos = gab_paths[side][1][frame]
+            gab.contrast = .5 if (side == hemi and dim_time <= t < dim_time + dim_dur) else 1
+        profiler.lap(UPDATE)
+
+        for gab in gabors.values():
+            gab.draw()
+        fix.draw()
+        profiler.lap(DRAW)
+        win.flip()
+        profiler.lap(FLIP)
+        flip_time = run_clock.getTime()
+
+        for press in inputs.drain():
+            pass
+        if scheduler.is_done(0, flip_time):
+            break
+    inputs.stop()
+
+
+def bench_log(n_records=20000, commit_every=50):
+    """Log records on the main thread, committed to the background writer every few records like between trials"""
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = AsyncLogFile(str(Path(tmp) / "bench.log"), filemode='w', level=logging.INFO)
+        t0 = time.perf_counter()
+        for i in range(n_records):
+            logging.exp(f"Block {i // 3 + 1} stim onset: planned {i * 1.5:.3f}, actual {i * 1.5 + .002:.3f} (2.0 ms)")
+            if i % commit_every == commit_every - 1:
+                log_file.commit()
+        t_log = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        log_file.close()
+        t_close = time.perf_counter() - t0
+    return [
+        record("log.record", {"n_records": n_records}, t_log * 1e6 / n_records, "us/record"),
+        record("log.close", {"n_records": n_records}, t_close * 1e3, "ms")
+    ]
+
+
+def bench_checkerboard(n_checks=(8, 64, 512)):
+    """All the checkerboard stimuli of the scan (sides x patterns x orientations)"""
+    STUBS.refresh_rate = 60
+    win = visual.Window(size=[1024, 768], units='deg')
+    return [
+        record("checkerboard.make", {"n_checks": n},
+               best_time(lambda: make_checkerboards(win, x_offset=7, path_ori=10, n_sqrs=n)) * 1e3, "ms")
+        for n in n_checks
+    ]
+
+
+def bench_export(n_trials=(90, 10 ** 5), n_intervals=(10 ** 4, 10 ** 6)):
+    """
+    Journal writes during the session and the files saved at the end of it. The frame intervals themselves are saved
+    by PsychoPy, so only the markers are timed.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in n_trials:
+            table = prescan_table(n)
+            params = {"n_trials": len(table)}
+            exp_file = str(Path(tmp) / f"bench_{n}")
+
+            journal = TrialJournal(exp_file, table)
+            t0 = time.perf_counter()
+            journal.open(resume=False)
+            for trial in range(len(table)):
+                journal.append(trial)
+            journal.close()
+            t_append = (time.perf_counter() - t0) / len(table)
+
+            t_journal_csv = best_time(lambda: journal.to_csv(exp_file + '.csv'), repeat=3)
+            t_table_csv = best_time(lambda: table.to_csv(exp_file + '_table.csv'), repeat=3)
+            results += [
+                record("export.journal_append", params, t_append * 1e6, "us/trial"),
+                record("export.journal_csv", params, t_journal_csv * 1e3, "ms"),
+                record("export.table_csv", params, t_table_csv * 1e3, "ms")
+            ]
+
+        STUBS.refresh_rate = 165
+        win = visual.Window(size=[1024, 768], units='deg')
+        for n in n_intervals:
+            markers = FrameMarkers(win)
+            for i in range(0, n, 500):
+                win.frameIntervals = [1 / 165] * i
+                markers.mark(i // 500, "stim")
+            t_markers = best_time(lambda: markers.save(str(Path(tmp) / "markers.tsv")), repeat=3)
+            results.append(record("export.frame_markers", {"n_frames": n}, t_markers * 1e3, "ms"))
+    return results
+
+
+# --------------------------------------------------------------------------- #
+# results
+# --------------------------------------------------------------------------- #
+
+def record(name, params, value, unit, **extra):
+    return {"name": name, "params": params, "value": float(value), "unit": unit, **extra}
+
+
+def frame_record(name, profiler, rate):
+    """Median per-frame time of a profiled loop, its stage timings, and the share of the frame budget it uses"""
+    trace = profiler.trace()
+    us = {stage: trace[stage] / 1e3 for stage in ["update", "draw", "flip"]}
+    total = us["update"] + us["draw"] + us["flip"]
+    return record(
+        name, {"refresh_rate": rate}, np.median(total), "us/frame",
+        mean=float(total.mean()),
+        p95=float(np.percentile(total, 95)),
+        update_us=float(us["update"].mean()),
+        draw_us=float(us["draw"].mean()),
+        flip_us=float(us["flip"].mean()),
+        budget=float(total.mean() / (1e6 / rate)),
+        n_frames=len(trace)
+    )
+
+
+def git_commit():
+    """Commit of the repository, with '-dirty' if there are uncommitted changes. None if git is not available."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOTDIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOTDIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_suite():
+    """
+    Runs every benchmark.
+
+    Returns
+    -------
+    dict
+        the environment (commit, versions, machine) and the list of results
+    """
+    results = []
+    for bench in [bench_design, bench_frames, bench_log, bench_checkerboard, bench_export]:
+        print(f"running {bench.__name__}...")
+        results += bench()
+
+    return {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "results": results
+    }
+
+
+def compare(results, baseline, tolerance=.2):
+    """
+    Prints every result next to the same one in a baseline file.
+
+    Parameters
+    ----------
+    results : dict
+        output of run_suite
+    baseline : dict
+        an earlier output of run_suite
+    tolerance : float
+        results slower than the baseline by more than this fraction are flagged
+    """
+    def key(res):
+        return res["name"], json.dumps(res["params"], sort_keys=True)
+
+    old = {key(res): res for res in baseline["results"]}
+    print(f"compared to {baseline.get('commit')} ({baseline.get('date')})")
+    print(f"{'benchmark':>24} {'params':>24} {'before':>10} {'after':>10} {'ratio':>7}")
+    for res in results["results"]:
+        before = old.get(key(res))
+        if before is None:
+            continue
+        ratio = res["value"] / before["value"] if before["value"] else np.nan
+        flag = "  slower" if ratio > 1 + tolerance else ""
+        params = ",".join(f"{k}={v}" for k, v in res["params"].items())
+        print(f"{res['name']:>24} {params:>24} {before['value']:>10.3f} {res['value']:>10.3f} {ratio:>7.2f}{flag}")
+
+
+if __name__ == '__main__':
+
+    suite = run_suite()
+    out_file = Path(sys.argv[1]) if len(sys.argv) > 1 else \
+        ROOTDIR / "benchmarks" / "results" / f"{suite['commit'] or 'unknown'}.json"
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, 'w') as f:
+        json.dump(suite, f, indent=1)
+
+    for res in suite["results"]:
+        params = ",".join(f"{k}={v}" for k, v in res["params"].items())
+        print(f"{res['name']:>24} {params:>24} {res['value']:>10.3f} {res['unit']}")
+    print(f"saved in {out_file}")
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            compare(suite, json.load(f))
@@ -0,0 +1,154 @@
+#!usr/bin/env python
+"""
+Checkerboard stimuli for the fMRI experiment
+
+Each checkerboard is a column of alternating checks along the path of the gabor. The whole column is one texture, so
+drawing a checkerboard (or its counter-phase pattern) is a single draw call instead of one per check.
+
+The texture is a raster of the checkerboard as it was drawn with one Rect per check: squares of sqr_sz degrees with a
+gray outline, whose centers are sqr_step degrees apart going up from the horizontal meridian, each drawn over the
+last one and each rotated around its own center on the oblique paths. With the default 3 dva squares and 1 dva steps
+the column is 10 dva tall: seven 1 dva bands and a full square at the top. Everything around the squares is
+transparent (masked), and the texture has the resolution of the screen so the outlines keep their width in pixels.
+"""
+import numpy as np
+from psychopy import visual
+
+
+def checker_layout(theta, sqr_sz=3, sqr_step=1, n_sqrs=8, px_per_deg=32., line_width=1.5):
+    """
+    Rasterizes the overlapping squares of a checkerboard column.
+
+    Parameters
+    ----------
+    theta : float
+        orientation of every square in degrees (clockwise)
+    sqr_sz : float
+        size of the squares in degrees
+    sqr_step : float
+        distance between the centers of the squares in degrees
+    n_sqrs : int
+        number of squares
+    px_per_deg : float
+        texels per degree
+    line_width : float
+        width of the outlines in texels (pixels), like the lineWidth of a Rect
+
+    Returns
+    -------
+    tuple
+        (rows, columns) index of the square seen in every texel (-1 for none), (rows, columns) mask of the outlines,
+        and the (left, bottom, right, top) extent of the texture in degrees from the start of the path
+    """
+    half = sqr_sz / 2
+    half_line = line_width / px_per_deg / 2
+    cos, sin = np.cos(np.deg2rad(theta)), np.sin(np.deg2rad(theta))
+    reach = (half + half_line) * (abs(cos) + abs(sin))  # half the width of a rotated square
+    centers = half + sqr_step * np.arange(n_sqrs)
+
+    n_cols = int(np.ceil(2 * reach * px_per_deg))
+    n_rows = int(np.ceil((centers[-1] - centers[0] + 2 * reach) * px_per_deg))
+    left, top = -n_cols / px_per_deg / 2, centers[0] - reach + n_rows / px_per_deg
+    x = left + (np.arange(n_cols) + .5) / px_per_deg
+    y = top - (np.arange(n_rows) + .5) / px_per_deg  # the first row is the top of the image
+
+    owner = np.full((n_rows, n_cols), -1)
+    outline = np.zeros((n_rows, n_cols), dtype=bool)
+    for s, center in enumerate(centers):
+        # only the rows the square can reach, in its own (unrotated) coordinates
+        rows = slice(max(int(np.floor((top - center - reach) * px_per_deg)), 0),
+                     int(np.ceil((top - center + reach) * px_per_deg)))
+        dy = y[rows, np.newaxis] - center
+        dist = np.maximum(np.abs(x * cos - dy * sin), np.abs(x * sin + dy * cos))
+
+        # the fill and then the outline, over the squares below
+        fill, edge = dist <= half, np.abs(dist - half) <= half_line
+        owner[rows][fill | edge] = s
+        outline[rows][fill] = False
+        outline[rows][edge] = True
+
+    return owner, outline, (left, top - n_rows / px_per_deg, -left, top)
+
+
+def checker_texture(owner, outline, pattern="pat1"):
+    """
+    Makes the image and the mask of a checkerboard from its layout.
+
+    Parameters
+    ----------
+    owner, outline : np.ndarray
+        from checker_layout
+    pattern : str
+        "pat1" has a black square at the bottom, "pat2" is its counter-phase
+
+    Returns
+    -------
+    tuple
+        image (-1 black to 1 white, 0 for the gray outlines) and mask (1 on the squares, -1 around them)
+    """
+    colors = np.where(np.arange(owner.max() + 1) % 2, 1., -1.)
+    if pattern == "pat2":
+        colors = -colors
+
+    image = np.where(outline, 0., colors[owner])
+    mask = np.where(owner >= 0, 1., -1.)
+    return image, mask
+
+
+def make_checkerboards(win, x_offset, path_ori, sqr_sz=3, sqr_step=1, n_sqrs=8, px_per_deg=32., line_width=1.5,
+                       sides=("left", "right"), patterns=("pat1", "pat2"), oris=("vert", "obl")):
+    """
+    Makes one stimulus for every side, pattern, and orientation of the checkerboard.
+
+    The column starts on the horizontal meridian at the gabor's location and goes up. The squares of the oblique
+    checkerboards are tilted by the path orientation of their side.
+
+    Parameters
+    ----------
+    win : visual.Window
+    x_offset : float
+        horizontal distance of the path from fixation in degrees
+    path_ori : float or dict
+        orientation of the oblique path in degrees (clockwise from vertical), or a dict that maps the sides to their
+        orientations
+    sqr_sz : float
+        size of the squares in degrees
+    sqr_step : float
+        distance between the squares in degrees
+    n_sqrs : int
+        number of squares
+    px_per_deg : float
+        pixels per degree of the screen
+    line_width : float
+        width of the gray outlines in pixels
+    sides : tuple of str
+    patterns : tuple of str
+    oris : tuple of str
+
+    Returns
+    -------
+    dict
+        maps "{side}_{pattern}_{ori}" to its stimulus
+    """
+    path_oris = path_ori if isinstance(path_ori, dict) else dict.fromkeys(sides, path_ori)
+    checkers = {}
+
+    for ori in oris:
+        for side in sides:
+            owner, outline, (left, bottom, right, top) = checker_layout(
+                0 if ori == "vert" else path_oris[side], sqr_sz, sqr_step, n_sqrs, px_per_deg, line_width
+            )
+            x_start = -x_offset if side == "left" else x_offset
+            for pat in patterns:
+                image, mask = checker_texture(owner, outline, pat)
+                checkers[f"{side}_{pat}_{ori}"] = visual.ImageStim(
+                    win=win,
+                    image=image,
+                    mask=mask,
+                    size=(right - left, top - bottom),
+                    pos=(x_start + (left + right) / 2, (bottom + top) / 2),
+                    interpolate=False,
+                    autoLog=False
+                )
+
+    return checkers
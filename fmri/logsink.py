@@ -0,0 +1,90 @@
+#!usr/bin/env python
+"""
+Buffered log file for the runtime logs
+
+PsychoPy's LogFile writes to disk whenever the logger is flushed, which can happen in the middle of a trial. This log
+file only keeps the formatted records in memory, and a background thread writes them to disk when the experiment
+commits them at an idle point (between trials or block parts). The records and their format are the same as with
+LogFile.
+"""
+import atexit
+import threading
+from collections import deque
+
+from psychopy import logging
+
+
+class AsyncLogFile:
+    """
+    Drop-in replacement for logging.LogFile that writes from a background thread.
+
+    Parameters
+    ----------
+    f : str
+        path of the log file
+    level : int
+        lowest level of the records that are saved
+    filemode : str
+        'w' to overwrite, 'a' to append
+    logger : logging._Logger
+        the logger this file is a target of. Defaults to the root logger.
+    encoding : str
+    """
+    def __init__(self, f, level=logging.INFO, filemode='w', logger=None, encoding='utf8'):
+        self.level = level
+        self.logger = logger or logging.root
+
+        # the logger writes into the queue, and it has no flush() so the logger can't force a write to disk
+        self._queue = deque()
+        self.stream = self._queue
+
+        self._file = open(f, filemode, encoding=encoding)
+        self._pending = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, name="log_writer", daemon=True)
+        self._thread.start()
+
+        self.logger.addTarget(self)
+        atexit.register(self.close)  # also save the records when quitting with core.quit()
+
+    def setLevel(self, level):
+        """Changes the lowest level of the records that are saved"""
+        self.level = level
+        self.logger.removeTarget(self)
+        self.logger.addTarget(self)
+
+    def write(self, txt):
+        """Called by the logger with an already formatted record"""
+        self._queue.append(txt)
+
+    def commit(self):
+        """Formats the pending records of the logger and hands them to the background writer."""
+        self.logger.flush()
+        self._pending.set()
+
+    def close(self):
+        """Writes all the remaining records and closes the file."""
+        if self._closed:
+            return
+        self.logger.flush()
+        self.logger.removeTarget(self)
+
+        self._closed = True
+        self._pending.set()
+        self._thread.join()
+        self._drain()
+        self._file.close()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._pending.wait()
+            self._pending.clear()
+            self._drain()
+
+    def _drain(self):
+        records = []
+        while self._queue:
+            records.append(self._queue.popleft())
+        if records:
+            self._file.write(''.join(records))
+            self._file.flush()
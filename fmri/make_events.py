@@ -0,0 +1,238 @@
+#!usr/bin/env python
+"""
+Makes the BIDS events.tsv files of the fMRI runs from the runtime logs.
+
+The runtime log has the BIDS-level records of every run mixed in with the other records. The log is read line by
+line (so memory doesn't grow with the size of the log) and the records of each run are written to
+sub-XX_ses-XX_task-<label>_run-XX_events.tsv next to it. If a run shows up more than once (e.g. a continued session),
+the last one is kept.
+
+The file names only have BIDS entities: the session is the one in the log's name (left out for older logs without
+one), the task label loses the characters BIDS doesn't allow in labels (contrast_change -> contrastchange), and the
+part and experiment of the log's name go into the JSON sidecar of every events file, with the task name and the
+descriptions of the columns.
+
+Usage: python make_events.py [data directory] [number of processes]
+"""
+import json
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+LOG_SUFFIX = "_runtime-log.log"
+BIDS_LEVEL = "BIDS"
+BIDS_HEADER = "onset\tduration\ttrial_type\ttask_side\teye"
+RUN_START = re.compile(r"Run (\d+) started")
+LOG_NAME = re.compile(r"(?P<sub>sub-[a-zA-Z0-9]+)(_ses-(?P<ses>[a-zA-Z0-9]+))?_task-(?P<task>.+?)"
+                      r"(_part-(?P<part>.+?))?(_exp-(?P<exp>.+?))?" + re.escape(LOG_SUFFIX) + "$")
+COLUMNS = {
+    "onset": {"Description": "Start of the block from the first trigger of the run", "Units": "s"},
+    "duration": {"Description": "Duration of the block", "Units": "s"},
+    "trial_type": {
+        "Description": "Part of the block",
+        "Levels": {"cue": "arrow cue to the attended hemifield", "stim": "double-drift gabors and checkerboards",
+                   "fix": "fixation"}
+    },
+    "task_side": {"Description": "Cued hemifield of the run", "Levels": {"L": "left", "R": "right"}},
+    "eye": {"Description": "Eye that views the stimuli in the run", "Levels": {"L": "left", "R": "right"}}
+}
+
+
+def iter_records(log_file):
+    """
+    Reads the records of a runtime log one by one.
+
+    Parameters
+    ----------
+    log_file : str or Path
+
+    Yields
+    ------
+    tuple
+        (time, level name, message) of every record
+    """
+    with open(log_file, encoding='utf8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t', 2)
+            if len(parts) < 3:
+                continue  # continuation of a message with line breaks
+            try:
+                t = float(parts[0])
+            except ValueError:
+                continue
+            yield t, parts[1].strip(), parts[2]
+
+
+def bids_label(value):
+    """A label with only the characters BIDS allows (letters and digits)"""
+    return re.sub(r"[^a-zA-Z0-9]", "", value)
+
+
+def bids_prefix(sub, task, ses=None):
+    """
+    Start of the BIDS names of the files of a subject in a session.
+
+    Parameters
+    ----------
+    sub : str
+        'sub-XX'
+    task : str
+        name of the task, e.g. 'contrast_change'
+    ses : str
+        label of the session, e.g. '01'. The names have no session if None.
+
+    Returns
+    -------
+    str
+        'sub-XX_ses-XX_task-<label>'
+    """
+    ses = f"_ses-{ses}" if ses is not None else ""
+    return f"{sub}{ses}_task-{bids_label(task)}"
+
+
+def log_entities(log_file):
+    """
+    Reads the subject, session, task, part and experiment from the name of a runtime log.
+
+    Parameters
+    ----------
+    log_file : Path
+
+    Returns
+    -------
+    dict
+        sub, ses, task, part and exp (None if the name doesn't have them)
+    """
+    match = LOG_NAME.match(log_file.name)
+    if match is None:
+        raise ValueError(f"{log_file.name} isn't named like a runtime log (sub-XX_ses-XX_task-..._runtime-log.log).")
+    return match.groupdict()
+
+
+def events_file(log_file, run):
+    """
+    Name of the events file of a run.
+
+    Parameters
+    ----------
+    log_file : Path
+    run : int
+
+    Returns
+    -------
+    Path
+    """
+    entities = log_entities(log_file)
+    prefix = bids_prefix(entities["sub"], entities["task"], entities["ses"])
+    return log_file.with_name(f"{prefix}_run-{run:02d}_events.tsv")
+
+
+def write_sidecar(file_name, task, part=None, exp=None):
+    """
+    Writes the JSON sidecar of an events file.
+
+    Parameters
+    ----------
+    file_name : str or Path
+        the events.tsv file
+    task : str
+        name of the task
+    part : str
+        part of the experiment (e.g. 'fmri')
+    exp : str
+        name of the experiment
+
+    Returns
+    -------
+    Path
+    """
+    sidecar = Path(file_name).with_suffix(".json")
+    info = {"TaskName": task, "Part": part, "Experiment": exp, **COLUMNS}
+    with open(sidecar, 'w', encoding='utf8') as f:
+        json.dump({key: value for key, value in info.items() if value is not None}, f, indent=2)
+    return sidecar
+
+
+def write_events(log_file):
+    """
+    Writes the events.tsv file of every run in a runtime log.
+
+    Parameters
+    ----------
+    log_file : str or Path
+
+    Returns
+    -------
+    list of Path
+        the events files that were written
+    """
+    log_file = Path(log_file)
+    entities = log_entities(log_file)
+    written = []
+    out = None
+    run = None
+    header = BIDS_HEADER
+
+    try:
+        for t, level, message in iter_records(log_file):
+
+            # a new run: close the events of the last one
+            match = RUN_START.match(message)
+            if match:
+                if out is not None:
+                    out.close()
+                    out = None
+                run = int(match.group(1))
+                continue
+
+            # the header is logged once at the start of the session (older sessions have no trial_type column)
+            if level == BIDS_LEVEL and message.startswith("onset\t"):
+                header = message
+                continue
+
+            # events of the current run
+            if level == BIDS_LEVEL and run is not None:
+                if out is None:
+                    file_name = events_file(log_file, run)
+                    out = open(file_name, 'w', encoding='utf8')
+                    out.write(header + '\n')
+                    if file_name not in written:
+                        written.append(file_name)
+                        write_sidecar(file_name, entities["task"], entities["part"], entities["exp"])
+                out.write(message + '\n')
+    finally:
+        if out is not None:
+            out.close()
+
+    return written
+
+
+def convert_tree(data_dir, n_jobs=None):
+    """
+    Writes the events files of all the runtime logs under a data directory, one log per process.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        the data directory with the sub-XX directories
+    n_jobs : int
+        number of processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dict
+        maps every log file to the events files made from it
+    """
+    log_files = sorted(Path(data_dir).glob(f"sub-*/*/*{LOG_SUFFIX}"))
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return dict(zip(log_files, pool.map(write_events, log_files)))
+
+
+if __name__ == '__main__':
+
+    data_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path(__file__).resolve().parent.parent / "data"
+    n_procs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    for log, events in convert_tree(data_path, n_procs).items():
+        print(f"{log.name}: {len(events)} runs")
@@ -6,13 +6,21 @@ Created at 10/23/21
 fMRI experiment for finding the location of attentional feedback in V1
 """
 from psychopy import visual, monitors, event, core, logging, gui, data
-from mr_helpers import setup_path, get_monitors
+from mr_helpers import setup_path, get_monitors, get_path_params, build_design, TrialTable, TrialJournal
+from checkerboard import make_checkerboards
+from trajectory import drift_path
+from scheduler import BlockScheduler
+from triggers import TriggerListener
+from inputs import InputListener
+from logsink import AsyncLogFile
+from frames import FrameMarkers, save_intervals, saved_frames
+from profiling import FrameProfiler, UPDATE, DRAW, FLIP
+from realtime import RealTimeMode, default_cpus
+from messages import make_messages
 
 import numpy as np
 from pathlib import Path
-import pandas as pd
-from itertools import product
-from collections import defaultdict
+from os.path import exists
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -35,8 +43,11 @@ input_gui.addField('Age: ', choices=list(range(18, 81)))
 input_gui.addField('Vision: ', choices=["Normal", "Corrected", "Other"])
 
 input_gui.addText("Experiment Parameters", color='blue')
-input_gui.addField("Path orientation: ", 10)
-input_gui.addField("Path length: ")
+input_gui.addText("Leave the path and the speeds empty to use the prescan results", color='blue')
+input_gui.addField("Path orientation: ", '')
+input_gui.addField("Path length: ", '')
+input_gui.addField("Internal speed: ", '')
+input_gui.addField("External speed: ", '')
 input_gui.addField("Initial Eye:", choices=["Left", "Right"])
 input_gui.addFixedField("Date: ", data.getDateStr())
 
@@ -55,22 +66,64 @@ else:
     sub_init = 'gg'
     sub_id = 0
 
-init_eye = part_info[10]
-date = part_info[11]
+session = int(part_info[5])
+init_eye = part_info[12]
+date = part_info[13]
 
 # Directories and files
 EXP = "DoubleDriftODC"
 PART = "fmri"
 TASK = "contrast_change"
 ROOTDIR = Path(__file__).resolve().parent.parent  # find the current file
+
+# Path parameters
+# from the prescan summary of the subject (behavioral/sub_path.py), which has them for each quadrant along with the
+# speeds they were measured with. The values typed in the dialog override them (the path in both quadrants)
+quadrants = ["L", "R"]
+path_params = get_path_params(sub_id, ROOTDIR) or {}
+if debug:
+    path_params = {**{f"PATH_ORI_{quad}": 10 for quad in quadrants}, **{f"PATH_LEN_{quad}": 1 for quad in quadrants},
+                   "V_INTERNAL": 4, "V_EXTERNAL": 5, **path_params}
+path_ori = {quad: float(part_info[8]) if str(part_info[8]).strip() else path_params.get(f"PATH_ORI_{quad}")
+            for quad in quadrants}
+path_len = {quad: float(part_info[9]) if str(part_info[9]).strip() else path_params.get(f"PATH_LEN_{quad}")
+            for quad in quadrants}
+# internal and external speeds of the gabors
+speeds = [float(part_info[10]) if str(part_info[10]).strip() else path_params.get("V_INTERNAL"),
+          float(part_info[11]) if str(part_info[11]).strip() else path_params.get("V_EXTERNAL")]
+if None in path_ori.values() or None in path_len.values() or None in speeds:
+    raise ValueError(f"No prescan results for sub-{sub_id:02d}. Run behavioral/sub_path.py or type the path "
+                     f"orientation and length and the speeds in the dialog.")
+path_ori = {quad: round(ori, 2) for quad, ori in path_ori.items()}
+path_len = {quad: round(length, 2) for quad, length in path_len.items()}
+
 PARTDIR = setup_path(sub_id, ROOTDIR, PART)
-run_file = PARTDIR / f"sub-{sub_id:02d}_task-{TASK}_part-{PART}_exp-{EXP}"
+run_file = PARTDIR / f"sub-{sub_id:02d}_ses-{session:02d}_task-{TASK}_part-{PART}_exp-{EXP}"
 
 # file names
 exp_file = str(run_file)
 frames_file = str(run_file) + "_frame-intervals.log"
+markers_file = str(run_file) + "_frame-markers.tsv"
 log_file = str(run_file) + "_runtime-log.log"
 
+# a saved session of the participant is continued if it is unfinished, and a finished one is never overwritten
+resume = False
+saved_session = None if debug else TrialJournal.saved_progress(exp_file)
+if saved_session is not None:
+    n_saved, n_planned, finished = saved_session
+    resume_gui = gui.Dlg(title=">_<")
+    if finished:
+        resume_gui.addText(f"sub-{sub_id:02d} has already finished session {session}. Check the participant number "
+                           f"and the session.")
+        resume_gui.show()
+        core.quit()
+    resume_gui.addText(f"sub-{sub_id:02d} has an unfinished session {session} ({n_saved} of {n_planned} block parts). "
+                       f"Continue it from the start of its unfinished run?")
+    resume_gui.show()
+    if not resume_gui.OK:
+        core.quit()
+    resume = True
+
 # Monitor
 mon_name = 'RaZer'
 mon_specs = get_monitors(mon_name)
@@ -88,6 +141,13 @@ else:
     full_screen = True
     fake_ans = False
 
+# per-frame profiling of the render loops, saved next to the data file
+profile_frames = False
+
+# real-time mode: garbage collection only in idle phases, higher priority, and warm-up frames before the first trial
+realtime_mode = True
+realtime_cpus = default_cpus()  # CPUs the session is pinned to (all but the first one). None leaves them to the OS
+
 # Window
 exp_win = visual.Window(
     monitor=exp_mon,
@@ -103,8 +163,14 @@ exp_win = visual.Window(
 # Logging
 log_clock = core.Clock()
 logging.setDefaultClock(log_clock)
-log_data = logging.LogFile(log_file, filemode='w', level=logging.INFO)
+# written to disk at idle points. A continued session adds to the log of the interrupted one,
+# and the events of its repeated run replace the old ones in make_events.py
+log_data = AsyncLogFile(log_file, filemode='a' if resume else 'w', level=logging.INFO)
 logging.console.setLevel(logging.ERROR)
+logging.exp(f"Path orientation: {path_ori} ({'dialog' if str(part_info[8]).strip() else 'prescan'}), "
+            f"path length: {path_len} ({'dialog' if str(part_info[9]).strip() else 'prescan'}), "
+            f"speeds: {speeds[0]} internal ({'dialog' if str(part_info[10]).strip() else 'prescan'}), "
+            f"{speeds[1]} external ({'dialog' if str(part_info[11]).strip() else 'prescan'})")
 
 # Add a new logging level name called bids
 # we will use this level to log information that will be saved
@@ -113,8 +179,8 @@ BIDS = 69
 logging.addLevel(BIDS, 'BIDS')
 
 # BIDS TEMPLATE
-logging.root.log("onset\tduration\ttask_side\teye", level=BIDS)
-template_bids = '{onset:.3f}\t{duration:.3f}\t{hemifield}\t{eye}'
+logging.root.log("onset\tduration\ttrial_type\ttask_side\teye", level=BIDS)
+template_bids = '{onset:.3f}\t{duration:.3f}\t{block_part}\t{hemifield}\t{eye}'
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -143,28 +209,25 @@ right_gabor = visual.GratingStim(
 )
 
 # checkerboards
+# one pre-rendered column per side, pattern, and orientation, so flickering is one draw call per side. The textures
+# have the resolution of the screen (pixels per degree the way psychopy converts them) to keep the 1.5 px outlines
 sqr_sz = 3
 n_sqrs = 8
+px_per_deg = mon_specs["size_px"][0] / mon_specs["size_cm"][0] * mon_specs["dist"] * np.deg2rad(1)
 stim_sides = ["left", "right"]
 patterns = ["pat1", "pat2"]
 oris = ["vert", "obl"]
-checkers = defaultdict(list)
-
-for lr in stim_sides:
-    for pat in patterns:
-        for ori in oris:
-            for s in range(n_sqrs):
-                checkers[f"{lr}_{pat}_{ori}"].append(
-                    visual.Rect(
-                        win=exp_win,
-                        size=sqr_sz,
-                        pos=[-horiz_offset if lr == "left" else horiz_offset, sqr_sz / 2 + s],
-                        lineColor=0,
-                        ori=0 if (ori == "vert") else int(part_info[8]),
-                        fillColor=(1 if s % 2 else -1) if (pat == "pat1") else (-1 if s % 2 else 1),
-                        autoLog=False
-                    )
-                )
+checkers = make_checkerboards(
+    exp_win,
+    x_offset=horiz_offset,
+    path_ori={side: path_ori[side[0].upper()] for side in stim_sides},
+    sqr_sz=sqr_sz,
+    n_sqrs=n_sqrs,
+    px_per_deg=px_per_deg,
+    sides=stim_sides,
+    patterns=patterns,
+    oris=oris
+)
 
 # cue
 cue = visual.ImageStim(
@@ -182,10 +245,6 @@ fix = visual.Circle(
     autoLog=False
 )
 
-# Text messages
-msg_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, alignText='left', autoLog=False)
-rep_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, pos=[0, -5], autoLog=False)
-
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
 # ------------------------------ ! PROCEDURE -------------------------------- #
@@ -202,16 +261,27 @@ instr_msg = \
     "If the gabor on the cued side becomes dimmer, press the response button!\n\n"\
     "Press the response button to start the experiment..."
 
+wait_msg = "Waiting for scanner..."
 end_msg = "Thank you for your participation :)"
 
+# text messages, each laid out once
+msg_stims = make_messages(
+    exp_win,
+    {"instr": instr_msg, "wait": wait_msg, "end": end_msg},
+    wrapWidth=30, height=.8, alignText='left'
+)
+
 # Conditions
 hemifields = ["L", "R"]  # target left or right side of the fixation
 # trial_types = ["dd", "ctrl_vert", "ctrl_oblq"]  # is it a double- or single-drift
 trial_types = ["dd"]
 eyes = ["L", "R"]  # left eye viewing or right eye: first 5 runs are one eye and the last 5 are the other
-block_parts = ["cue", "fix", "stim"]
+block_parts = ["cue", "stim", "fix"]
 n_blocks = 12  # each block has an initial 4s wait period followed by 11s of stimulus presentation and 15s fixation
 n_runs = 8  # number of runs
+part_durs = {"cue": 4, "stim": 11, "fix": 15}  # seconds, in the order of the block parts
+assert list(part_durs) == block_parts
+dim_dur = .5  # seconds the cued gabor stays dim
 run_per_cond = 2
 
 # Data handler
@@ -219,14 +289,20 @@ run_per_cond = 2
 cols = [
     "HEMIFIELD",
     "TRIAL_TYPE",
+    "BLOCK_PART",
     "DIM",
     "DIM_TIME",
+    "RT",
     "TRIAL",
     "EYE",
     "BLOCK",
     "RUN",
-    "PATH_LEN",
-    "PATH_ORI",
+    "PATH_LEN_L",
+    "PATH_LEN_R",
+    "PATH_ORI_L",
+    "PATH_ORI_R",
+    "V_INTERNAL",
+    "V_EXTERNAL",
     "TASK",
     "EXPERIMENT",
     "SUB_ID",
@@ -236,102 +312,62 @@ cols = [
 ]
 
 # blocks and trials
-exp_runs = None  # actual dataframe
-
-# in the speed block, speeds are varied. In the duration block, durations are varied.
-conds = list(product(trial_types, eyes, hemifields))
-n_trials = n_runs * n_blocks * len(conds)  # total number of trials in the blocks
-
-# loop through conditions, make every permutation, and save it to a numpy array
-run_cnt = 0
-for eye in eyes:
-    for hemi in hemifields:
-        for run in range(run_per_cond):
-            for block in range(n_blocks):
-                for trial_type in block_parts:
-                    row = np.array([
-                        eye,
-                        hemi,  # target hemifield
-                        run + 1,
-                        block + 1,
-                        trial_type,  # cue, stim, or fixation
-                        np.NaN,  # does the target dim
-                        np.NaN,  # time of dimming
-                        np.NaN,  # trial
-                        np.NaN,  # block
-                        np.NaN,  # run
-                        np.NaN,  # path length
-                        np.NaN,  # path orientation
-                        TASK,  # task
-                        EXP,  # experiment
-                        sub_id,  # subject ID
-                        sub_init,  # subject initials
-                        part_info[3],  # DBIC ID
-                        part_info[4]  # Accession Number
-                    ])
-
-                    # if trial_type == 'fix':
-
-# for run in range(n_runs):
-#
-#     # select the initial eye for the first half of trials and the other eye for the other half
-#     run_eye = ("L" if run < n_runs / 2 else "R") if init_eye == "L" else ("R" if run < n_runs / 2 else "L")
-#
-#     # randomize block
-#     run_hemi = "L" if run in
-#     rand_blocks = np.ones(n_blocks)
-#     rand_blocks[:n_blocks // 2] = 0
-#     np.random.shuffle(rand_blocks)
-#
-#     for block in range(n_blocks):
-#
-#         # select the random hemifield for this block
-#         block_side = hemifields[rand_blocks]
-
-
-rows = None
-for hemi, trial_type, eye in conds:
-    row = np.array([
-        hemi,  # cued hemifield
-        trial_type,  # vertical control, oblique control, or dd
-        np.NaN,  # does the target dim
-        np.NaN,  # time of dimming
-        np.NaN,  # trial
-        eye,  # eye
-        np.NaN,  # block
-        np.NaN,  # run
-        np.NaN,  # path length
-        np.NaN,  # path orientation
-        TASK,  # task
-        EXP,  # experiment
-        sub_id,  # subject ID
-        sub_init,  # subject initials
-        part_info[3],  # DBIC ID
-        part_info[4]  # Accession Number
-    ])
-    if rows is None:
-        rows = row
-    else:
-        rows = np.vstack((rows, row))
-
-# repeat conditions for however many trials
-this_block = np.repeat(rows, run_per_cond, axis=0)
-
-print(this_block)
-# shuffle them
-np.random.shuffle(this_block)  # this preserves the order within row and just shuffles the rows
-
-# sanity check
-# print(f"Shape of block {b}: {this_block.shape}")
-assert this_block.shape == (n_trials, len(cols))
-
-# add trial labels
-this_block[:, 6] = np.arange(1, n_trials + 1)  # trial is the 7(-1)th col. set it to a list of ordered numbers
-
-if exp_blocks is None:
-    exp_blocks = this_block
-else:
-    exp_blocks = np.vstack((exp_blocks, this_block))
+# each eye is used for half of the runs (starting with the initial eye), and the cued hemifield is fixed within a run.
+# hemifields are counterbalanced and shuffled within the runs of each eye.
+run_order = build_design({"HEMIFIELD": hemifields}, n_reps=run_per_cond, n_groups=len(eyes))
+run_eyes = np.array(eyes if init_eye == "Left" else eyes[::-1])[run_order["GROUP"]]
+assert len(run_order) == n_runs
+
+# every run has n_blocks blocks and every block has a cue, stimulus and fixation part
+n_parts = len(block_parts)
+n_trials = n_runs * n_blocks * n_parts  # total number of trials in the runs
+block_design = build_design(
+    {"RUN": np.arange(1, n_runs + 1), "BLOCK": np.arange(1, n_blocks + 1), "BLOCK_PART": block_parts},
+    shuffle=False
+)
+run_idx = block_design["RUN"] - 1
+
+# actual dataframe
+# design columns change from trial to trial, dimming is filled in during the runs,
+# and session-level columns are stored only once
+exp_runs = TrialTable(
+    cols,
+    {
+        "HEMIFIELD": run_order["HEMIFIELD"][run_idx],  # cued hemifield
+        "TRIAL_TYPE": np.full(n_trials, trial_types[0]),  # vertical control, oblique control, or dd
+        "BLOCK_PART": block_design["BLOCK_PART"],  # cue, stimulus, or fixation
+        "EYE": run_eyes[run_idx],
+        "BLOCK": block_design["BLOCK"],
+        "RUN": block_design["RUN"]
+    },
+    meta={
+        **{f"PATH_LEN_{quad}": length for quad, length in path_len.items()},
+        **{f"PATH_ORI_{quad}": ori for quad, ori in path_ori.items()},
+        "V_INTERNAL": speeds[0],
+        "V_EXTERNAL": speeds[1],
+        "TASK": TASK,
+        "EXPERIMENT": EXP,
+        "SUB_ID": sub_id,
+        "SUB_INITIALS": sub_init,
+        "DBIC_ID": part_info[3],
+        "ACCESSION_NUM": part_info[4]
+    },
+    dtypes={"TRIAL": np.int64}
+)
+exp_runs["TRIAL"][:] = np.arange(1, n_trials + 1)  # trial labels are ordered numbers
+
+# dimming of the cued gabor: half of the stimulus parts dim once at a random time
+is_stim = exp_runs["BLOCK_PART"] == "stim"
+dims = np.random.rand(is_stim.sum()) < .5
+exp_runs["DIM"][is_stim] = dims
+exp_runs["DIM_TIME"][is_stim] = np.where(dims, np.random.uniform(1, part_durs["stim"] - 1 - dim_dur, len(dims)), np.nan)
+
+# every completed block part is saved in a journal, so an interrupted session can be continued
+# from the beginning of its first unfinished run
+journal = TrialJournal(exp_file, exp_runs)
+first_trial = journal.open(resume=resume)
+first_run = exp_runs["RUN"][first_trial] - 1 if first_trial < n_trials else n_runs
+journal.rewind(first_run * n_blocks * n_parts)
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -342,172 +378,216 @@ else:
 # Initialize parameters
 # gabor
 gab_size = 1.2  # in dva
-gab_shift = 7  # degrees shift in x from the center of the screen
 gab_sf = .5 / gab_size  # cycles per degree spatial frequency
-gabor.size = gab_size
-gabor.sf = gab_sf
+gabors = {"L": left_gabor, "R": right_gabor}
+for gab in gabors.values():
+    gab.size = gab_size
+    gab.sf = gab_sf
+dim_contrast = .5  # contrast of the cued gabor when it dims
+
+# cue
+cue.size = (1.5, 1.1)
 
 # runtime params
-exp_win.refreshThreshold = (1 / mon_specs["refresh_rate"]) + 0.003
+refresh_rate = int(mon_specs["refresh_rate"])
+frame_dur = 1 / refresh_rate
+exp_win.refreshThreshold = frame_dur + 0.003
 path_dur = 1000  # milli-second
-n_frames = np.floor(path_dur * int(mon_specs["refresh_rate"]) / 1000)
+flicker_dur = .125  # seconds of each checkerboard pattern in the counter-phase flicker
+
+# gabor paths: up and down the path, over and over during the stimulus
+gab_paths = {
+    side: drift_path(speeds[0], speeds[1], refresh_rate, path_dur / 1000, tuple(gab.pos))
+    for side, gab in gabors.items()
+}
+n_frames = len(gab_paths["L"][0])
+checker_oris = {"ctrl_vert": "vert", "ctrl_oblq": "obl"}
+
+# trial parameters
+trial_hemis = exp_runs["HEMIFIELD"].tolist()
+trial_types_ = exp_runs["TRIAL_TYPE"].tolist()
+trial_parts = exp_runs["BLOCK_PART"].tolist()
+trial_eyes = exp_runs["EYE"].tolist()
+dim_times = exp_runs["DIM_TIME"].tolist()
+resp_times = exp_runs["RT"]  # seconds from the dimming to the first button press after it
+
+# schedule of the block parts in each run, locked to the first trigger
+scheduler = BlockScheduler(part_durs, n_blocks, frame_dur)
 
 # clocks
 exp_clock = core.Clock()
+run_clock = core.Clock()
+
+# start of every block part in the frame intervals
+frame_markers = FrameMarkers(exp_win, first_frame=saved_frames(frames_file) if resume else 0)
+profiler = FrameProfiler(phases=["wait"] + block_parts, enabled=profile_frames)
+realtime = RealTimeMode(enabled=realtime_mode, cpus=realtime_cpus)
+logging.exp(realtime.start())
+
+# draw every stimulus a few times so everything is on the GPU before the first trial
+exp_win.recordFrameIntervals = True
+realtime.warm_up(exp_win, [*gabors.values(), *checkers.values(), cue, fix, *msg_stims.values()], n_frames=5,
+                 markers=frame_markers)
+
+# scanner triggers are timestamped on the run clock by a background thread
+# use the keyboard ('5') if there is no serial device
+serial_path = 'COM3'
+trigger_listener = TriggerListener(run_clock, serial_path=serial_path if exists(serial_path) else None)
+trigger_listener.start()
+logging.exp(f"Listening to triggers from the {trigger_listener.source}.")
+
+# button presses are collected and timestamped on a background thread too, instead of once per frame. The button box
+# types '1' to '4' like a keyboard (the serial port above is the scanner's). A button box on its own serial port goes
+# in button_box_path
+button_box_path = None
+inputs = InputListener(run_clock, keys=['1', '2', '3', '4', 'escape'], serial_path=button_box_path)
+inputs.start()
 
 # show instructions and wait for keypress
-msg_stim.text = instr_msg
-msg_stim.draw()
+msg_stims["instr"].draw()
 exp_win.flip()
-event.waitKeys(keyList=['space'])
+event.waitKeys(keyList=['1', 'space'])
 logging.exp("===========================")
-logging.exp("Experiment started")
+logging.exp("Experiment started" if not first_run else f"Experiment continued from run {first_run + 1}")
 logging.exp("===========================")
 exp_win.flip()
 exp_clock.reset()
 
-# start trials
-for trial in range(n_trials):
-
-    # log it
-    logging.exp(f"---------------------------")
-    logging.exp(f"Trial {trial} started.")
+# start runs
+for run in range(first_run, n_runs):
 
-    # run parameters
-    # from Hz to cycles/frame
-    v_tex = [exp_blocks[trial, 1] / mon_specs["refresh_rate"], 0]
-    v_env = [0, exp_blocks[trial, 2] / mon_specs["refresh_rate"]]
+    run_trials = np.flatnonzero(exp_runs["RUN"] == run + 1)
 
-    # start recording frames
+    # wait for the first sync pulse from the scanner (or the keyboard)
+    realtime.idle_phase()
     exp_win.recordFrameIntervals = True
+    frame_markers.mark(run_trials[0], "wait")
+    profiler.set_context(run_trials[0], "wait")
+    trigger_listener.reset()
+    while trigger_listener.latest() is None:  # raises if the port is lost
+        msg_stims["wait"].draw()
+        exp_win.flip()
 
-    # show fixation
-    fix.autoDraw = True
-
-    # log it
-    logging.exp("Moving the stimulus.")
-
-    # show the drift
-    for rep in range(2):
+        # escape is quitting here too
+        if any(press.value == 'escape' for press in inputs.drain()):
+            logging.error("Aborted experiment while waiting for the scanner.")
+            trigger_listener.stop()
+            inputs.stop()
+            journal.close()
+            exp_win.close()
+            core.quit()
+    scheduler.start(trigger_listener.tr_time(1))
+    inputs.clear()
+    logging.exp("---------------------------")
+    logging.exp(f"Run {run + 1} started.")
+
+    # show the block parts until their deadlines
+    for part, trial in enumerate(run_trials):
+
+        hemi = trial_hemis[trial]
+        block_part = trial_parts[trial]
+        trial_type = trial_types_[trial]
+        dim_time = dim_times[trial]
+        if block_part == "cue":
+            cue.ori = 0 if hemi == "R" else 180  # the arrow points right
+            realtime.stimulus_phase()
 
         # control drawing every frame
-        for frame in range(n_frames):
-
-            # drift right / move up on odd repetitions
-            if not rep:
-                gabor.phase += v_tex
-                gabor.pos += v_env
-
-            # drift left / move down on even repetitions
-            else:
-                gabor.phase -= v_tex
-                gabor.pos -= v_env
-
-            gabor.draw()
-            exp_win.flip()
-
-    # Get the response
-    # clean buffer
-    event.clearEvents()
-
-    # reporting device
-    ans_mouse = event.Mouse(visible=False, win=exp_win)
-
-    # initialize response line length and ori every trial
-    resp_line.size = .1 if resp_stages[0] == 'Length' else 1  # starting line size with 1 dva
-    resp_line.ori = 90
-
-    # for debugging
-    if not fake_ans:
-
-        # text message
-        rep_stim.autoDraw = True
-
-        # reporting stages
-        for stage in resp_stages:
-
-            # get response
-            resp = True
-
-            # reporting loop
-            while resp:
-
-                # mouse wheel for controlling the line
-                wheel_dX, wheel_dY = ans_mouse.getWheelRel()
-
-                # change the orientation
-                if stage == 'Orientation':
-
-                    # text message
-                    rep_stim.text = "Match orientation"
-                    rep_stim.draw()
-
-                    if 0 <= resp_line.ori < 180:  # don't allow weird responses
-                        resp_line.setOri(wheel_dY * 2, '-')
-                    else:
-                        resp_line.ori = 0
-
-                # change the length
+        frame_markers.mark(trial, block_part)
+        profiler.set_context(trial, block_part)
+        onset = None
+        dim_onset = None
+        while True:
+
+            profiler.start()
+
+            # time since the planned onset of the part
+            t = max(run_clock.getTime() - scheduler.onset(part), 0)
+
+            # update the stimulus
+            dimmed = False
+            if block_part == "stim":
+
+                # double-drift on both sides, and the cued one may dim
+                if trial_type == "dd":
+                    frame = int(t * refresh_rate) % n_frames
+                    dimmed = dim_time <= t < dim_time + dim_dur
+                    for side, gab in gabors.items():
+                        gab.phase = gab_paths[side][0][frame]
+                        gab.pos = gab_paths[side][1][frame]
+                        gab.contrast = dim_contrast if (side == hemi and dimmed) else 1
+
+                # counter-phase flickering checkerboards on the control paths
                 else:
+                    pat = patterns[int(t / flicker_dur) % 2]
+            profiler.lap(UPDATE)
+
+            # draw it
+            if block_part == "cue":
+                cue.draw()
+            elif block_part == "stim":
+                if trial_type == "dd":
+                    for gab in gabors.values():
+                        gab.draw()
+                else:
+                    for side in stim_sides:
+                        checkers[f"{side}_{pat}_{checker_oris[trial_type]}"].draw()
+            fix.draw()
+            profiler.lap(DRAW)
 
-                    # text message
-                    rep_stim.text = "Match length"
-                    rep_stim.draw()
-
-                    if resp_line.size > 0:  # don't allow below 0 size!
-                        resp_line.size += wheel_dY * .05
-                    else:
-                        resp_line.size = .1
-
-                resp_line.draw()
-                exp_win.flip()
-
-                # get the keypress for end of reporting
-                keys = event.getKeys()
-
-                for key in keys:
-
-                    # space is the end of reporting
-                    if key == 'space':
-
-                        # save the orientation
-                        if stage == 'Orientation':
-                            exp_blocks[trial, 4] = resp_line.ori
-
-                        # save the length
-                        else:
-                            # sometimes .size returns an np array!
-                            try:
-                                # the default response line size=1 means 2dva
-                                exp_blocks[trial, 5] = np.round(resp_line.size, 2)
-                            except:
-                                exp_blocks[trial, 5] = np.round(resp_line.size[0], 2)
-
-                        # log and end reporting
-                        logging.exp(f"Response recorded: {exp_blocks[trial, 4]}")
-                        resp = False  # end reporting
-                        rep_stim.autoDraw = False
-
-                    # escape is quitting
-                    elif key == 'escape':  # quit button
-                        logging.error("Aborted experiment.")
-                        exp_win.close()
-                        core.quit()
-
-    # if in debugging mode
-    else:
-        # just generate fake responses
-        exp_win.flip()
-        core.wait(4)  # approximate response time
-        exp_blocks[trial, 4] = .33  # random orientation
-        exp_blocks[trial, 5] = .69  # random size
-
-    # Turn fixation off
-    fix.autoDraw = False
-
-    # clear buffer
-    event.clearEvents()
-    logging.exp(f"Trial ended.")
+            exp_win.flip()
+            profiler.lap(FLIP)
+            flip_time = run_clock.getTime()
+            if dimmed and dim_onset is None:
+                dim_onset = flip_time
+
+            # log the onset of the part
+            if onset is None:
+                onset = flip_time
+                slip = scheduler.record_onset(part, flip_time)
+                logging.exp(f"Block {part // n_parts + 1} {block_part} onset: planned "
+                            f"{scheduler.planned[part]:.3f}, actual {onset - scheduler.t0:.3f} ({slip * 1000:.1f} ms)")
+                logging.root.log(template_bids.format(
+                    onset=onset - scheduler.t0,
+                    duration=scheduler.durations[part],
+                    block_part=block_part,
+                    hemifield=hemi,
+                    eye=trial_eyes[trial]
+                ), level=BIDS)
+
+                # fixation is idle time, so save the log records of the block and collect the garbage
+                if block_part == "fix":
+                    log_data.commit()
+                    realtime.idle_phase()
+
+            # button presses, with the times they happened at
+            for press in inputs.drain():
+
+                # escape is quitting
+                if press.value == 'escape':
+                    logging.error("Aborted experiment.")
+                    trigger_listener.stop()
+                    inputs.stop()
+                    journal.close()
+                    exp_win.close()
+                    core.quit()
+
+                logging.exp(f"Button {press.value} pressed at {press.time - scheduler.t0:.3f}.")
+
+                # the first press after the dimming is the response to it
+                if dim_onset is not None and press.time >= dim_onset and np.isnan(resp_times[trial]):
+                    resp_times[trial] = press.time - dim_onset
+
+            if scheduler.is_done(part, flip_time):
+                break
+
+        journal.append(trial)
+
+    # how much the block parts slipped in this run
+    slips = scheduler.summary()
+    logging.exp(f"Run {run + 1} ended after {trigger_listener.n_trs} TRs. Onset slippage: "
+                f"mean {slips['mean_ms']:.1f} ms, max {slips['max_ms']:.1f} ms, last {slips['last_ms']:.1f} ms.")
+    log_data.commit()
 
 # =========================================================================== #
 # --------------------------------------------------------------------------- #
@@ -521,19 +601,29 @@ logging.exp(f"Experiment finished. Duration: {t_end} minutes.")
 print(f"Experiment finished. Duration: {t_end} minutes.")
 
 # show than you message
-msg_stim.text = end_msg
-msg_stim.draw()
+msg_stims["end"].draw()
 exp_win.flip()
 core.wait(2)
 exp_win.logOnFlip("Experiment ended.", level=logging.EXP)
 exp_win.flip()
 
-# save in csv
-exp_df = pd.DataFrame(exp_blocks, columns=cols)  # turn it into a pandas dataframe
-exp_df.to_csv(exp_file + '.csv', sep=',', index=False)
+# stop listening to the scanner and the buttons
+trigger_listener.stop()
+inputs.stop()
 
-# save recorded frames
-exp_win.saveFrameIntervals(fileName=frames_file)
+# save in csv (rebuilt from the journal of the block parts), and don't continue the session when it is started again
+journal.close()
+journal.finish()
+journal.to_csv(exp_file + '.csv')
 
+# save recorded frames
+save_intervals(exp_win, frames_file, append=resume)
+frame_markers.save(markers_file, append=resume)
+profiler.save(str(run_file) + "_frame-profile")
+profiler.close()
+logging.exp(realtime.report())
+realtime.stop()
+
+log_data.close()
 exp_win.close()
 core.quit()
@@ -0,0 +1,112 @@
+#!usr/bin/env python
+"""
+Deadline-driven scheduling of block parts in an fMRI run
+
+Every block part (cue, stimulus, fixation) gets an absolute onset computed from the first scanner trigger of the run.
+Parts are rendered until their deadline instead of for a number of frames, so a dropped frame only delays the frame
+it happened on and never pushes the later blocks.
+"""
+import numpy as np
+
+
+class BlockScheduler:
+    """
+    Planned and actual onsets of all block parts in a run.
+
+    Parameters
+    ----------
+    part_durs : dict
+        duration of every block part in seconds, in the order they are shown within a block
+    n_blocks : int
+        number of blocks in the run
+    frame_dur : float
+        duration of one frame in seconds
+    """
+    def __init__(self, part_durs, n_blocks, frame_dur):
+        self.parts = list(part_durs) * n_blocks
+        self.durations = np.tile(np.array(list(part_durs.values()), dtype=float), n_blocks)
+        self.planned = np.concatenate([[0], np.cumsum(self.durations)[:-1]])  # relative to the trigger
+        self.actual = np.full(len(self.parts), np.nan)
+        self.frame_dur = frame_dur
+        self.t0 = None
+
+    def __len__(self):
+        return len(self.parts)
+
+    def start(self, t0):
+        """
+        Locks the schedule to the time of the first trigger and clears the recorded onsets.
+
+        Parameters
+        ----------
+        t0 : float
+            time of the first trigger on the clock that is used for the flips
+        """
+        self.t0 = t0
+        self.actual[:] = np.nan
+
+    def onset(self, part):
+        """Absolute planned onset of a part"""
+        return self.t0 + self.planned[part]
+
+    def offset(self, part):
+        """Absolute deadline of a part, which is the onset of the next one"""
+        return self.onset(part) + self.durations[part]
+
+    def is_done(self, part, flip_time):
+        """
+        Checks if the part should end after this flip, i.e. if the next flip would land within half a frame of its
+        deadline or after it.
+
+        Parameters
+        ----------
+        part : int
+        flip_time : float
+            time of the last flip
+
+        Returns
+        -------
+        bool
+        """
+        return flip_time + 1.5 * self.frame_dur >= self.offset(part)
+
+    def record_onset(self, part, flip_time):
+        """
+        Saves the time of the first flip of a part.
+
+        Parameters
+        ----------
+        part : int
+        flip_time : float
+
+        Returns
+        -------
+        float
+            slippage of the onset in seconds (positive is late)
+        """
+        self.actual[part] = flip_time - self.t0
+        return self.actual[part] - self.planned[part]
+
+    def slippage(self):
+        """
+        Actual minus planned onsets of all parts in seconds (NaN for the parts that were not shown).
+
+        Returns
+        -------
+        np.ndarray
+        """
+        return self.actual - self.planned
+
+    def summary(self):
+        """
+        Summary of the onset slippage for the run in milliseconds.
+
+        Returns
+        -------
+        dict
+        """
+        slips = self.slippage()
+        slips = slips[~np.isnan(slips)] * 1000
+        if not len(slips):
+            return {"n_parts": 0, "mean_ms": np.nan, "max_ms": np.nan, "last_ms": np.nan}
+        return {"n_parts": len(slips), "mean_ms": slips.mean(), "max_ms": np.abs(slips).max(), "last_ms": slips[-1]}
@@ -1,9 +1,10 @@
 import sys
 import time
-import serial
 from os.path import exists
 from psychopy import visual, core, event, monitors
 from mr_helpers import setup_path, get_monitors
+from triggers import TriggerListener
+from messages import make_messages
 from pygaze import eyetracker, libscreen
 import pygaze
 
@@ -30,39 +31,33 @@ exp_win = visual.Window(
     name='behav_win'
 )
 
-msg_stim = visual.TextStim(win=exp_win, wrapWidth=30, height=.8, alignText='left', autoLog=False)
-
-waiting = visual.TextStim(exp_win, pos=[0, 0], text="Waiting for scanner...",
-                          color='black', name="Waiting")
-waiting_fake = visual.TextStim(exp_win, pos=[0, 0], text="Waiting for (fake) scanner...",
-                               color='black', name="Waiting_fake")
+# waiting messages for the scanner and for the keyboard, each laid out once
+waiting = make_messages(
+    exp_win,
+    {"serial": "Waiting for scanner...", "keyboard": "Waiting for (fake) scanner..."},
+    pos=[0, 0], color='black'
+)
 
 serial_path = 'COM3'
 # serial_path = '/dev/cu.USA19H62P1.1'
 # serial_path = '/dev/cu.USA19H142P1.1'
 # serial_path = '/dev/tty.USA19H142P1.1'
 
-if not exists(serial_path):
-    waiting_fake.draw()
-    exp_win.flip()
-    serial_exists = False
+# listen to the triggers on a background thread instead of polling the port here
+trigger_clock = core.Clock()
+trigger_listener = TriggerListener(trigger_clock, serial_path=serial_path if exists(serial_path) else None)
+trigger_listener.start()
+
+waiting[trigger_listener.source].draw()
+if trigger_listener.source == "keyboard":
     b_serial = "No serial device detected, using keyboard"
-    event.waitKeys(keyList=['5'])
     first_trigger = "Got sync from keyboard. Resetting clocks"
 else:
-    waiting.draw()
-    exp_win.flip()
-    serial_exists = True
     b_serial = "Serial device detected"
-    ser = serial.Serial(serial_path, 19200, timeout=.0001)
-    ser.flushInput()
-    scanner_wait = True
-
-    while scanner_wait:
-        ser_out = ser.read()
-        if b'5' in ser_out:
-            scanner_wait = False
-            first_trigger = "Got sync from scanner!"
+    first_trigger = "Got sync from scanner!"
+exp_win.flip()
+trigger_listener.wait_for(1)
+trigger_listener.stop()
 
 # check keys
 print(b_serial)
@@ -0,0 +1,266 @@
+#!usr/bin/env python
+"""
+Scanner trigger listener
+
+Reads the sync pulses of the scanner from the serial port (or the '5' key when there is no serial device) on a
+background thread. Every pulse is timestamped on the experiment clock as soon as it arrives, so the stimulus loop
+never has to poll the port itself. If the port is lost, the listener stops and the error is raised by latest() and
+wait_for() instead of leaving the session waiting for pulses that never come.
+"""
+import os
+import threading
+import time
+
+
+class TriggerListener:
+    """
+    Listens to scanner triggers on a background thread.
+
+    Parameters
+    ----------
+    clock : object
+        anything with a getTime() method (e.g. core.Clock) that the pulses are timestamped with
+    serial_path : str
+        path of the serial device. If None, the keyboard is used.
+    baudrate : int
+    trigger : bytes
+        the character the scanner sends on every TR
+    tr : float
+        repetition time in seconds, used to predict when future pulses arrive
+    port : object
+        an already opened port with read() and reset_input_buffer() methods (e.g. for testing). Overrides
+        `serial_path`.
+    poll_interval : float
+        seconds between reads of the port or the keyboard
+    """
+    def __init__(self, clock, serial_path=None, baudrate=19200, trigger=b'5', tr=None, port=None, poll_interval=.0005):
+        self.clock = clock
+        self.serial_path = serial_path
+        self.baudrate = baudrate
+        self.trigger = trigger
+        self.tr = tr
+        self.poll_interval = poll_interval
+
+        self._port = port
+        self._pulses = []
+        self._lock = threading.Lock()
+        self._new_pulse = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+        self.error = None  # the error that stopped the thread
+
+    @property
+    def source(self):
+        return "keyboard" if (self._port is None and self.serial_path is None) else "serial"
+
+    def start(self):
+        """Opens the port (if needed) and starts listening."""
+        if self.source == "serial" and self._port is None:
+            import serial
+            # blocking reads with a short timeout so the thread sleeps in the driver instead of spinning
+            self._port = serial.Serial(self.serial_path, self.baudrate, timeout=self.poll_interval * 10)
+        if self._port is not None:
+            self._port.reset_input_buffer()
+
+        self._stop.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._listen, name="trigger_listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops listening and closes the port if it was opened here."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.serial_path is not None and self._port is not None:
+            self._port.close()
+            self._port = None
+
+    def reset(self):
+        """Forgets the pulses received so far, e.g. between runs."""
+        with self._lock:
+            self._pulses = []
+
+    def _listen(self):
+        if self.source == "serial":
+            read = self._read_serial
+        else:
+            # the psychtoolbox keyboard queues the keys outside of the window's event loop, so it can be read here
+            from psychopy.hardware import keyboard
+            kb = keyboard.Keyboard()
+            read = lambda: len(kb.getKeys(keyList=['5'], waitRelease=False))  # noqa: E731
+
+        while not self._stop.is_set():
+            try:
+                n_new = read()
+            except OSError as err:  # the device was disconnected
+                with self._new_pulse:
+                    self.error = err
+                    self._new_pulse.notify_all()
+                break
+            if n_new:
+                self._add(n_new)
+            elif self.source == "keyboard":
+                time.sleep(self.poll_interval)
+
+    def _read_serial(self):
+        data = self._port.read(max(1, getattr(self._port, "in_waiting", 0)))
+        return data.count(self.trigger)
+
+    def _add(self, n_new):
+        t = self.clock.getTime()
+        with self._new_pulse:
+            self._pulses.extend([t] * n_new)
+            self._new_pulse.notify_all()
+
+    @property
+    def n_trs(self):
+        """Number of pulses received so far"""
+        return len(self._pulses)
+
+    def _check(self):
+        if self.error is not None:
+            raise OSError(f"The trigger listener stopped: {self.error}") from self.error
+
+    def latest(self):
+        """
+        The last pulse.
+
+        Returns
+        -------
+        tuple
+            (number of the TR starting from 1, time on the clock) or None if there has not been a pulse yet
+
+        Raises
+        ------
+        OSError
+            if the port was lost
+        """
+        with self._lock:
+            self._check()
+            if not self._pulses:
+                return None
+            return len(self._pulses), self._pulses[-1]
+
+    def pulses(self):
+        """
+        Times of all the pulses received so far.
+
+        Returns
+        -------
+        list of float
+        """
+        with self._lock:
+            return list(self._pulses)
+
+    def tr_time(self, n):
+        """
+        Time of TR number n (starting from 1). If it has not arrived yet, it is predicted from the last pulse and the
+        repetition time, which makes it usable as a deadline.
+
+        Parameters
+        ----------
+        n : int
+
+        Returns
+        -------
+        float
+            None if the TR has not arrived and cannot be predicted
+        """
+        with self._lock:
+            if n <= len(self._pulses):
+                return self._pulses[n - 1]
+            if not self._pulses or self.tr is None:
+                return None
+            return self._pulses[-1] + (n - len(self._pulses)) * self.tr
+
+    def wait_for(self, n, timeout=None):
+        """
+        Blocks until TR number n arrives.
+
+        Parameters
+        ----------
+        n : int
+        timeout : float
+            in seconds. None waits forever.
+
+        Returns
+        -------
+        float
+            time of the TR or None if it timed out
+
+        Raises
+        ------
+        OSError
+            if the port was lost before the TR arrived
+        """
+        with self._new_pulse:
+            arrived = self._new_pulse.wait_for(lambda: len(self._pulses) >= n or self.error is not None,
+                                               timeout=timeout)
+            if len(self._pulses) < n:
+                self._check()
+            if not arrived:
+                return None
+            return self._pulses[n - 1]
+
+
+def fake_scanner(tr, n_trs, trigger=b'5', hold=None):
+    """
+    Stand-in for the scanner: sends a trigger every TR on a pseudo-terminal from a background thread.
+    The returned path can be opened like the real serial port, e.g. for dry runs without the scanner.
+
+    Parameters
+    ----------
+    tr : float
+        repetition time in seconds
+    n_trs : int
+        number of triggers to send
+    trigger : bytes
+    hold : float
+        seconds the port stays open after the last trigger before it is closed (like a disconnected port). Defaults to
+        one TR.
+
+    Returns
+    -------
+    tuple
+        (path of the serial device, list that gets the send time of every trigger on time.perf_counter)
+    """
+    import pty  # only on unix
+
+    scanner, device = pty.openpty()
+    sent = []
+
+    def send():
+        t_start = time.perf_counter()
+        for n in range(n_trs):
+            # sleep until the deadline of this TR so the pulses do not drift (the first one comes after one TR)
+            time.sleep(max(0, t_start + (n + 1) * tr - time.perf_counter()))
+            os.write(scanner, trigger)
+            sent.append(time.perf_counter())
+        time.sleep(tr if hold is None else hold)
+        os.close(scanner)
+
+    threading.Thread(target=send, name="fake_scanner", daemon=True).start()
+
+    return os.ttyname(device), sent
+
+
+if __name__ == '__main__':
+
+    # dry run with a fake scanner: how late are the pulses timestamped?
+    class PerfClock:
+        @staticmethod
+        def getTime():
+            return time.perf_counter()
+
+    device_path, sent_times = fake_scanner(tr=.1, n_trs=20)
+    listener = TriggerListener(PerfClock(), serial_path=device_path, tr=.1)
+    listener.start()
+    print(f"TR 20 expected at {listener.wait_for(1) + 19 * .1:.4f}")
+    listener.wait_for(20, timeout=5)
+    listener.stop()
+
+    lags = [(got - sent) * 1000 for got, sent in zip(listener.pulses(), sent_times)]
+    print(f"{listener.n_trs} pulses, latest {listener.latest()}")
+    print(f"timestamp lag: mean {sum(lags) / len(lags):.3f} ms, max {max(lags):.3f} ms")
@@ -0,0 +1,348 @@
+#!usr/bin/env python
+"""
+Headless, time-compressed sessions with a simulated participant
+
+The run scripts are executed as they are, with the PsychoPy window, mouse, keyboard and dialogs replaced by the stubs
+in stubs.py. Every flip moves a virtual clock forward instead of waiting for the display, so a whole session takes a
+fraction of a second and writes the same data, journal, log and frame files as a real one. Many sessions can be run
+in parallel to test the analysis pipeline.
+
+Usage: python simulate.py [prescan|scan] [number of sessions] [output directory] [number of processes]
+"""
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from stubs import PsychopyStubs
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+SCRIPTS = {
+    "prescan": ROOTDIR / "behavioral" / "run_prescan.py",
+    "scan": ROOTDIR / "fmri" / "run_scan.py"
+}
+REFRESH_RATES = {"prescan": 240, "scan": 165}  # of the monitors the scripts use
+
+
+class SimulatedParticipant:
+    """
+    Watches the drawn stimuli and answers through the stub mouse and keyboard.
+
+    In the prescan, the perceived path of the double-drift is tilted from the physical (vertical) path by
+    atan(illusion_gain * internal speed / external speed), where the internal speed is the drift of the texture in
+    degrees per second. The response line is turned and stretched with the mouse wheel until it matches the percept,
+    and each adjustment is submitted with the spacebar after at least its response time.
+    In the scanner, the dimming of a gabor is detected with `hit_rate` and answered with button '1' after the
+    response time.
+
+    Parameters
+    ----------
+    illusion_gain : float
+    ori_sd : float
+        trial-to-trial spread of the reported orientation in degrees
+    length_gain : float
+        reported length as a fraction of the physical path length
+    length_sd : float
+        trial-to-trial spread of the reported length in degrees
+    rt_mean : float
+        mean response time in seconds
+    rt_sd : float
+    wheel_speed : int
+        most wheel steps in one frame
+    hit_rate : float
+        probability of detecting a dimming
+    false_alarm_rate : float
+        probability of a button press per second without a dimming
+    seed : int
+    """
+    def __init__(self, illusion_gain=.5, ori_sd=5., length_gain=1., length_sd=.3, rt_mean=.8, rt_sd=.2,
+                 wheel_speed=5, hit_rate=.9, false_alarm_rate=.01, seed=None):
+        self.illusion_gain = illusion_gain
+        self.ori_sd = ori_sd
+        self.length_gain = length_gain
+        self.length_sd = length_sd
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.wheel_speed = wheel_speed
+        self.hit_rate = hit_rate
+        self.false_alarm_rate = false_alarm_rate
+        self.rng = np.random.default_rng(seed)
+
+        self.now = 0.
+        self._trace = []  # (phase, y, sf) of the gabor on its last two frames
+        self._y_range = [np.inf, -np.inf]
+        self._target = None  # perceived {'orientation', 'length'} of the last path
+        self._line = None
+        self._stage = None
+        self._stage_start = 0.
+        self._stage_rt = 0.
+        self._submitted = None
+        self._dimmed = set()
+        self._presses = []  # (time, key) of the button presses to come
+        self._lock = threading.Lock()  # the presses are read by the input listener's thread
+        self._next_false_alarm = self.rng.exponential(1 / false_alarm_rate) if false_alarm_rate else np.inf
+
+    def response_time(self):
+        return max(self.rng.normal(self.rt_mean, self.rt_sd), .15)
+
+    def wait_time(self):
+        """Seconds to answer a prompt (instructions)"""
+        return self.response_time()
+
+    def see(self, stim):
+        """Called for every drawn stimulus"""
+        if stim.kind == "GratingStim":
+            self._stage = None
+            if self._target is not None:  # a new trial started
+                self._trace, self._y_range, self._target, self._submitted = [], [np.inf, -np.inf], None, None
+            phase, y = np.ravel(stim.phase)[0], stim.pos[1]
+            self._trace = self._trace[-1:] + [(phase, y, stim.sf)]
+            if y < self._y_range[0]:
+                self._y_range[0] = y
+            if y > self._y_range[1]:
+                self._y_range[1] = y
+
+            # dimming of a gabor in the scanner
+            if stim.contrast < 1 and id(stim) not in self._dimmed:
+                self._dimmed.add(id(stim))
+                if self.rng.random() < self.hit_rate:
+                    with self._lock:
+                        self._presses.append((self.now + self.response_time(), '1'))
+            elif stim.contrast >= 1:
+                self._dimmed.discard(id(stim))
+
+        elif stim.kind == "Line":
+            self._line = stim
+
+        elif stim.kind == "TextStim":
+            text = stim.text.lower()
+            stage = "orientation" if "orientation" in text else ("length" if "length" in text else None)
+            if stage is not None and stage != self._stage:
+                self._stage = stage
+                self._stage_start = self.now
+                self._stage_rt = self.response_time()
+
+    def flip(self, now):
+        """Called after every flip with the virtual time"""
+        self.now = now
+        if now >= self._next_false_alarm:
+            with self._lock:
+                self._presses.append((now, '1'))
+            self._next_false_alarm = now + self.rng.exponential(1 / self.false_alarm_rate)
+
+    def percept(self):
+        """
+        The perceived path of the last double-drift.
+
+        Returns
+        -------
+        dict
+            orientation of the path in degrees (clockwise from vertical, like the response line) and its length in
+            units of the response line (size 1 is 2 dva)
+        """
+        (ph0, y0, sf), (ph1, y1, _) = self._trace
+        v_internal = ((ph1 - ph0 + .5) % 1 - .5) / sf  # texture drift in degrees per frame
+        v_external = y1 - y0
+        tilt = np.degrees(np.arctan(self.illusion_gain * v_internal / v_external)) if v_external else 0.
+        length = (self._y_range[1] - self._y_range[0]) * self.length_gain / 2
+        return {
+            "orientation": float(self.rng.normal(tilt, self.ori_sd) % 180),
+            "length": float(max(self.rng.normal(length, self.length_sd), .05))
+        }
+
+    def _step(self):
+        """Wheel steps that bring the line closer to the percept"""
+        if self._line is None or self._stage is None:
+            return 0
+        if self._stage == "orientation":
+            steps = -(self._target["orientation"] - self._line.ori) / 2  # the line turns 2 degrees per step
+        else:
+            steps = (self._target["length"] - float(np.ravel(self._line.size)[0])) / .05
+        return max(-self.wheel_speed, min(self.wheel_speed, round(steps)))
+
+    def wheel(self, now):
+        """Vertical wheel movement since the last read. The wheel is only turned while a response is asked for."""
+        if self._stage is None:
+            return 0.
+        if self._target is None:
+            if len(self._trace) < 2:
+                return 0.
+            self._target = self.percept()
+        return float(self._step())
+
+    def keys(self, now, key_list=None):
+        """
+        Keys pressed since the last read that are in `key_list` (all if None).
+
+        Returns
+        -------
+        list of tuple
+            (key, time of the press)
+        """
+        keys = []
+        if self._submit_due(now):
+            self._submitted = self._stage
+            keys.append(('space', now))
+
+        if self._presses:
+            with self._lock:
+                due = [(t, key) for t, key in self._presses if t <= now and (key_list is None or key in key_list)]
+                self._presses = [press for press in self._presses if press not in due]
+            keys += [(key, t) for t, key in due]
+
+        return [(key, t) for key, t in keys if key_list is None or key in key_list]
+
+    def _submit_due(self, now):
+        """Whether the line matches the percept and the response time of the stage has passed"""
+        return (self._target is not None and self._stage is not None and self._stage != self._submitted
+                and now - self._stage_start >= self._stage_rt and self._step() == 0)
+
+    def pending(self, now, key_list=None):
+        """Whether there are presses in `key_list` that are due but not read yet"""
+        if (key_list is None or 'space' in key_list) and self._submit_due(now):
+            return True
+        return any(t <= now and (key_list is None or key in key_list) for t, key in self._presses)
+
+
+def run_session(part, sub_id=1, root=None, participant=None, refresh_rate=None, time_step=None, drop_rate=0., tr=2.,
+                answers=None, seed=None):
+    """
+    Runs one session of a run script with the stubs.
+
+    Parameters
+    ----------
+    part : str
+        'prescan' or 'scan'
+    sub_id : int
+    root : str or Path
+        directory that takes the place of the repository, so the data go to root/data/sub-XX. The data directory of
+        the repository is used if None.
+    participant : SimulatedParticipant
+        a default one is made if None
+    refresh_rate : int
+        refresh rate of the simulated display in Hz. Defaults to the rate of the monitor in the script.
+    time_step : float
+        virtual seconds per flip, see PsychopyStubs
+    drop_rate : float
+        probability of a dropped frame
+    tr : float
+        repetition time of the simulated scanner in seconds
+    answers : dict
+        extra answers to the dialog of the script, by field label (e.g. {"Adaptive: ": True} for the adaptive
+        prescan)
+    seed : int
+        seeds the participant, the stubs and numpy's global generator that the scripts use
+
+    Returns
+    -------
+    dict
+        directory of the data, virtual duration of the session, and the wall-clock time it took
+    """
+    script = SCRIPTS[part]
+    root = Path(root) if root is not None else ROOTDIR
+    participant = participant if participant is not None else SimulatedParticipant(seed=seed)
+    answers = {"Debug: ": False, "Participant Number: ": sub_id, "Initials: ": "sim", **(answers or {})}
+
+    refresh_rate = refresh_rate or REFRESH_RATES[part]
+
+    stubs = PsychopyStubs(participant, answers, refresh_rate, time_step, drop_rate, tr, seed)
+    np.random.seed(seed)
+
+    # the modules next to the script are imported again, so they get the stubs instead of psychopy
+    replaced = stubs.install()
+    _drop_modules(script.parent)
+    sys.path.insert(0, str(script.parent))
+
+    t_start = time.perf_counter()
+    try:
+        code = compile(script.read_text(encoding='utf8'), str(script), 'exec')
+        exec(code, {"__name__": "__main__", "__file__": str(root / script.parent.name / script.name)})
+    except SystemExit:  # core.quit
+        pass
+    finally:
+        t_wall = time.perf_counter() - t_start
+        sys.path.remove(str(script.parent))
+        _drop_modules(script.parent)
+        stubs.uninstall(replaced)
+
+    part_dir = {"prescan": "psychophysics", "scan": "fmri"}[part]
+    return {
+        "sub_id": sub_id,
+        "data_dir": root / "data" / f"sub-{sub_id:02d}" / part_dir,
+        "virtual_s": stubs.clock.now,
+        "wall_s": t_wall
+    }
+
+
+def _drop_modules(directory):
+    """Forgets the imported modules that live in `directory`"""
+    for name, module in list(sys.modules.items()):
+        file = getattr(module, "__file__", None)
+        if file is not None and Path(file).resolve().parent == directory:
+            del sys.modules[name]
+
+
+def _run_one(args):
+    part, sub_id, root, participant_kwargs, kwargs = args
+    return run_session(part, sub_id, root, SimulatedParticipant(**participant_kwargs), **kwargs)
+
+
+def run_sessions(part, n_sessions, root, n_jobs=None, participant_kwargs=None, seed=0, **kwargs):
+    """
+    Runs many simulated sessions in parallel, one participant (sub-01, sub-02, ...) per session.
+
+    Parameters
+    ----------
+    part : str
+        'prescan' or 'scan'
+    n_sessions : int
+    root : str or Path
+        the data go to root/data
+    n_jobs : int
+        number of processes. None uses every CPU.
+    participant_kwargs : dict
+        parameters of the simulated participants (see SimulatedParticipant). Each one gets its own seed.
+    seed : int
+        seed of the first session, the others count up from it
+    kwargs
+        passed to run_session
+
+    Returns
+    -------
+    list of dict
+        the results of run_session in the order of the participants
+    """
+    root = Path(root)
+    (root / "data").mkdir(parents=True, exist_ok=True)  # made once, not by every process
+    participant_kwargs = dict(participant_kwargs or {})
+
+    jobs = [
+        (part, s + 1, root, {**participant_kwargs, "seed": seed + s}, {**kwargs, "seed": seed + s})
+        for s in range(n_sessions)
+    ]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(_run_one, jobs))
+
+
+if __name__ == '__main__':
+
+    exp_part = sys.argv[1] if len(sys.argv) > 1 else "prescan"
+    n_subs = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    out_dir = Path(sys.argv[3]) if len(sys.argv) > 3 else ROOTDIR / "simulated"
+    n_procs = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    # a coarse step keeps the hour-long scan sessions fast
+    step = .05 if exp_part == "scan" else None
+
+    # scan sessions take their path and speeds from the prescan summary (behavioral/sub_path.py) of the same
+    # directory, or fixed ones without it
+    dlg_answers = None
+    if exp_part == "scan" and not (out_dir / "data" / "derivatives" / "illusion-size_subjects.tsv").exists():
+        dlg_answers = {"Path orientation: ": 10, "Path length: ": 1, "Internal speed: ": 4, "External speed: ": 5}
+
+    for res in run_sessions(exp_part, n_subs, out_dir, n_procs, time_step=step, answers=dlg_answers):
+        print(f"sub-{res['sub_id']:02d}: {res['virtual_s'] / 60:.1f} virtual minutes in {res['wall_s']:.2f} s "
+              f"-> {res['data_dir']}")
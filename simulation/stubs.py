@@ -0,0 +1,449 @@
+#!usr/bin/env python
+"""
+Headless stand-ins for the parts of PsychoPy the experiment scripts use
+
+Time is virtual: every flip moves the clock forward by one frame (or a chosen time step), and waiting for keys or
+for seconds returns right away. Drawn stimuli are shown to a simulated participant, which answers through the stub
+mouse, keyboard and button box.
+"""
+import sys
+import threading
+import types
+
+import numpy as np
+
+
+class VirtualTime:
+    """The shared virtual clock of a simulated session"""
+    def __init__(self):
+        self.now = 0.
+
+    def advance(self, dt):
+        self.now += dt
+
+
+class NoParticipant:
+    """Nobody in front of the screen: nothing is seen and nothing is pressed"""
+    def see(self, stim):
+        pass
+
+    def flip(self, now):
+        pass
+
+    def wheel(self, now):
+        return 0.
+
+    def keys(self, now, key_list=None):
+        return []
+
+    def pending(self, now, key_list=None):
+        return False
+
+    def wait_time(self):
+        return 0.
+
+
+class PsychopyStubs:
+    """
+    Builds stub psychopy modules around a virtual clock and a participant.
+
+    Parameters
+    ----------
+    participant : object
+        gets the drawn stimuli (see simulate.SimulatedParticipant) and answers the input devices. Nobody if None.
+    answers : dict
+        values of the GUI fields by their label. Other fields get their default or first choice.
+    refresh_rate : int
+        refresh rate of the simulated display in Hz
+    time_step : float
+        virtual seconds per flip. Defaults to one frame of the display. A longer step makes long sessions faster to
+        simulate; the deadline-based code treats it like dropped frames.
+    drop_rate : float
+        probability of a flip taking two frames, to exercise the timing code
+    tr : float
+        seconds between the triggers of the simulated scanner (keyboard '5')
+    seed : int
+    """
+    def __init__(self, participant=None, answers=None, refresh_rate=60, time_step=None, drop_rate=0., tr=2., seed=None):
+        self.clock = VirtualTime()
+        self.participant = participant if participant is not None else NoParticipant()
+        self.answers = dict(answers or {})
+        self.refresh_rate = refresh_rate
+        self.time_step = time_step
+        self.drop_rate = drop_rate
+        self.tr = tr
+        self.rng = np.random.default_rng(seed)
+        self.keyboards = []
+        self.modules = self._build()
+
+    def install(self):
+        """Puts the stubs in sys.modules and returns what they replaced."""
+        replaced = {name: sys.modules.get(name) for name in self.modules}
+        sys.modules.update(self.modules)
+        return replaced
+
+    @staticmethod
+    def uninstall(replaced):
+        for name, module in replaced.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def _build(self):
+        stubs = self
+        vclock = self.clock
+        participant = self.participant
+
+        # ------------------------------------------------------------------ core
+        core = types.ModuleType("psychopy.core")
+
+        class Clock:
+            def __init__(self):
+                self._t0 = vclock.now
+
+            def getTime(self):
+                return vclock.now - self._t0
+
+            def reset(self, newT=0.):
+                self._t0 = vclock.now + newT
+
+        def wait(secs, hogCPUperiod=0):
+            vclock.advance(secs)
+
+        def quit():
+            logging.flush()
+            raise SystemExit(0)
+
+        core.Clock = Clock
+        core.MonotonicClock = Clock
+        core.wait = wait
+        core.quit = quit
+        core.rush = lambda value=True, realtime=False: False
+        core.getTime = lambda: vclock.now
+        core.monotonicClock = Clock()
+
+        # --------------------------------------------------------------- logging
+        logging = types.ModuleType("psychopy.logging")
+        levels = {50: "CRITICAL", 40: "ERROR", 30: "WARNING", 25: "DATA", 22: "EXP", 20: "INFO", 10: "DEBUG"}
+        for level, name in levels.items():
+            setattr(logging, name, level)
+
+        class _Logger:
+            format = "{t:.4f} \t{levelname} \t{message}"
+
+            def __init__(self):
+                self.targets = []
+                self.toFlush = []
+
+            def addTarget(self, target):
+                self.targets.append(target)
+
+            def removeTarget(self, target):
+                if target in self.targets:
+                    self.targets.remove(target)
+
+            def log(self, message, level, t=None, obj=None):
+                t = logging.defaultClock.getTime() if t is None else t
+                self.toFlush.append((t, level, message))
+
+            def flush(self):
+                for target in self.targets:
+                    for t, level, message in self.toFlush:
+                        if level >= target.level:
+                            target.write(self.format.format(t=t, levelname=levels.get(level, level),
+                                                            message=message) + '\n')
+                    if hasattr(target.stream, 'flush'):
+                        target.stream.flush()
+                self.toFlush = []
+
+        class LogFile:
+            def __init__(self, f=None, level=logging.WARNING, filemode='a', logger=None, encoding='utf8'):
+                self.level = level
+                self.stream = sys.stdout if f is None else open(f, filemode, encoding=encoding)
+                (logger or logging.root).addTarget(self)
+
+            def setLevel(self, level):
+                self.level = level
+
+            def write(self, txt):
+                self.stream.write(txt)
+
+        class _Console:
+            level = logging.ERROR
+            stream = None
+
+            def setLevel(self, level):
+                self.level = level
+
+            def write(self, txt):
+                pass
+
+        logging.root = _Logger()
+        logging.console = _Console()
+        logging.defaultClock = Clock()
+        logging.LogFile = LogFile
+        logging.addLevel = lambda level, name: levels.__setitem__(level, name)
+        logging.setDefaultClock = lambda clock: setattr(logging, "defaultClock", clock)
+        logging.flush = logging.root.flush
+        logging.log = lambda msg, level, t=None, obj=None: logging.root.log(msg, level, t, obj)
+        for name in ["critical", "error", "warning", "data", "exp", "info", "debug"]:
+            level = getattr(logging, name.upper())
+            setattr(logging, name, lambda msg, t=None, obj=None, _level=level: logging.root.log(msg, _level, t, obj))
+
+        # ---------------------------------------------------------------- visual
+        visual = types.ModuleType("psychopy.visual")
+
+        class WinHandle:
+            """The pyglet window: its mouse-wheel handlers get the participant's wheel steps on every flip"""
+            def __init__(self):
+                self.scroll_handlers = []
+
+            def push_handlers(self, on_mouse_scroll=None, **kwargs):
+                if on_mouse_scroll is not None:
+                    self.scroll_handlers.append(on_mouse_scroll)
+
+            def remove_handlers(self, on_mouse_scroll=None, **kwargs):
+                if on_mouse_scroll in self.scroll_handlers:
+                    self.scroll_handlers.remove(on_mouse_scroll)
+
+            def dispatch_events(self):
+                if self.scroll_handlers:
+                    steps = participant.wheel(vclock.now)
+                    if steps:
+                        for handler in self.scroll_handlers:
+                            handler(0, 0, 0., steps)
+
+        class Window:
+            def __init__(self, monitor=None, size=(1024, 768), **kwargs):
+                self.size = size
+                self.refresh_rate = stubs.refresh_rate
+                self.frameIntervals = []
+                self.recordFrameIntervals = False
+                self.refreshThreshold = 1 / self.refresh_rate + .004
+                self.auto_draw = []
+                self._on_flip = []
+                self.winHandle = WinHandle()
+
+            def flip(self, clearBuffer=True):
+                for stim in self.auto_draw:
+                    stim.draw()
+                dt = stubs.time_step or 1 / self.refresh_rate
+                if stubs.drop_rate and stubs.rng.random() < stubs.drop_rate:
+                    dt *= 2
+                vclock.advance(dt)
+                if self.recordFrameIntervals:
+                    self.frameIntervals.append(dt)
+                for func, args in self._on_flip:
+                    func(*args)
+                self._on_flip = []
+                participant.flip(vclock.now)
+                self.winHandle.dispatch_events()
+                for kb in stubs.keyboards:
+                    kb.sync()
+                return vclock.now
+
+            def callOnFlip(self, func, *args, **kwargs):
+                self._on_flip.append((lambda: func(*args, **kwargs), ()))
+
+            def logOnFlip(self, msg, level, obj=None):
+                self._on_flip.append((logging.root.log, (msg, level)))
+
+            def saveFrameIntervals(self, fileName=None, clear=True):
+                with open(fileName, 'w') as f:
+                    f.write(str([float(i) for i in self.frameIntervals])[1:-1])
+                if clear:
+                    self.frameIntervals = []
+
+            def getActualFrameRate(self, **kwargs):
+                return self.refresh_rate
+
+            def close(self):
+                pass
+
+        class _Stim:
+            kind = "stim"
+
+            def __init__(self, win=None, **kwargs):
+                self.win = win
+                self._auto_draw = False
+                self.pos = np.zeros(2)
+                self.ori = 0.
+                self.size = 1.
+                self.contrast = 1.
+                self.phase = 0.
+                self.sf = 1.
+                self.opacity = 1.
+                self.text = ""
+                for key, value in kwargs.items():
+                    setattr(self, key, value)
+
+            @property
+            def autoDraw(self):
+                return self._auto_draw
+
+            @autoDraw.setter
+            def autoDraw(self, value):
+                self._auto_draw = value
+                if value and self not in self.win.auto_draw:
+                    self.win.auto_draw.append(self)
+                elif not value and self in self.win.auto_draw:
+                    self.win.auto_draw.remove(self)
+
+            def setOri(self, value, operation=''):
+                self.ori = self.ori - value if operation == '-' else (self.ori + value if operation == '+' else value)
+
+            def draw(self, win=None):
+                participant.see(self)
+
+        for name in ["GratingStim", "ImageStim", "Circle", "Line", "Rect", "TextStim", "ElementArrayStim"]:
+            setattr(visual, name, type(name, (_Stim,), {"kind": name}))
+        visual.Window = Window
+
+        # -------------------------------------------------------------- monitors
+        monitors = types.ModuleType("psychopy.monitors")
+
+        class Monitor:
+            def __init__(self, name=None, width=None, distance=None, **kwargs):
+                self.name = name
+
+            def setSizePix(self, size):
+                self.size_px = size
+
+            def save(self):
+                pass
+
+        monitors.Monitor = Monitor
+
+        # ----------------------------------------------------------------- event
+        event = types.ModuleType("psychopy.event")
+
+        class Mouse:
+            def __init__(self, visible=True, win=None, **kwargs):
+                pass
+
+            def getWheelRel(self):
+                return 0., participant.wheel(vclock.now)
+
+        def getKeys(keyList=None, timeStamped=False):
+            presses = participant.keys(vclock.now, keyList)
+            if timeStamped:
+                t_now = timeStamped.getTime() if hasattr(timeStamped, "getTime") else vclock.now
+                return [(key, t_now - (vclock.now - t)) for key, t in presses]
+            return [key for key, t in presses]
+
+        def waitKeys(maxWait=float('inf'), keyList=None, timeStamped=False, **kwargs):
+            vclock.advance(participant.wait_time())
+            key = keyList[0] if keyList else 'space'
+            if timeStamped:
+                t = timeStamped.getTime() if hasattr(timeStamped, "getTime") else vclock.now
+                return [(key, t)]
+            return [key]
+
+        event.Mouse = Mouse
+        event.getKeys = getKeys
+        event.waitKeys = waitKeys
+        event.clearEvents = lambda eventType=None: None
+
+        # ------------------------------------------------------------------- gui
+        gui = types.ModuleType("psychopy.gui")
+
+        class _Answers(list):
+            OK = True
+
+            @property
+            def data(self):
+                return self
+
+        class Dlg:
+            def __init__(self, title="", **kwargs):
+                self.data = _Answers()
+                self.OK = True
+
+            def addText(self, text, **kwargs):
+                pass
+
+            def addField(self, label, initial='', choices=None, **kwargs):
+                default = choices[0] if (choices and initial == '') else initial
+                self.data.append(stubs.answers.get(label, default))
+
+            def addFixedField(self, label, initial='', **kwargs):
+                self.addField(label, initial)
+
+            def show(self):
+                return self.data
+
+        gui.Dlg = Dlg
+
+        # ------------------------------------------------------------------ data
+        data = types.ModuleType("psychopy.data")
+        data.getDateStr = lambda *args, **kwargs: "2021_Oct_23_0000"
+
+        # -------------------------------------------------------------- hardware
+        hardware = types.ModuleType("psychopy.hardware")
+        keyboard = types.ModuleType("psychopy.hardware.keyboard")
+
+        class KeyPress:
+            def __init__(self, name, rt):
+                self.name = name
+                self.rt = rt
+
+        class Keyboard:
+            """
+            The participant's keys, and the scanner triggers as '5' keys (one every TR of virtual time), with their
+            times on the keyboard's clock. The listeners read it on their own threads, so a flip that passes a TR or
+            a key press waits until they have read it, like the real devices would.
+            """
+            def __init__(self, *args, **kwargs):
+                self.clock = Clock()
+                self._n_read = int(vclock.now / stubs.tr)
+                self._key_list = None
+                self._read = threading.Event()
+                self._read.set()
+                stubs.keyboards.append(self)
+
+            def getKeys(self, keyList=None, waitRelease=True, clear=True):
+                self._key_list = keyList
+                keys = []
+                if keyList is None or '5' in keyList:
+                    n_trs = int(vclock.now / stubs.tr)
+                    keys += [KeyPress('5', n * stubs.tr - self.clock._t0) for n in range(self._n_read + 1, n_trs + 1)]
+                    self._n_read = n_trs
+                key_list = None if keyList is None else [key for key in keyList if key != '5']
+                if key_list is None or key_list:
+                    keys += [KeyPress(key, t - self.clock._t0) for key, t in participant.keys(vclock.now, key_list)]
+                self._read.set()
+                return keys
+
+            def _unread(self):
+                reads_triggers = self._key_list is None or '5' in self._key_list
+                return (reads_triggers and int(vclock.now / stubs.tr) > self._n_read
+                        or participant.pending(vclock.now, self._key_list))
+
+            def sync(self):
+                if self._unread():
+                    self._read.clear()
+                    if self._unread():  # not read in the meantime
+                        self._read.wait(.05)  # a stopped listener doesn't hold the session
+
+        keyboard.Keyboard = Keyboard
+        hardware.keyboard = keyboard
+
+        psychopy = types.ModuleType("psychopy")
+        psychopy.__path__ = []
+        for name, module in [("core", core), ("logging", logging), ("visual", visual), ("monitors", monitors),
+                             ("event", event), ("gui", gui), ("data", data), ("hardware", hardware)]:
+            setattr(psychopy, name, module)
+
+        return {
+            "psychopy": psychopy,
+            "psychopy.core": core,
+            "psychopy.logging": logging,
+            "psychopy.visual": visual,
+            "psychopy.monitors": monitors,
+            "psychopy.event": event,
+            "psychopy.gui": gui,
+            "psychopy.data": data,
+            "psychopy.hardware": hardware,
+            "psychopy.hardware.keyboard": keyboard
+        }
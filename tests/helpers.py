@@ -0,0 +1,43 @@
+"""
+Shared helpers of the tests
+
+The run scripts and their helpers are flat modules in behavioral/ and fmri/, and some of them have the same name in
+both (e.g. frames.py), so they are imported from their files as '{directory}_{module}'.
+"""
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+ROOTDIR = Path(__file__).resolve().parent.parent
+
+
+def load_module(directory, name):
+    """
+    Imports a module of the repository from its file.
+
+    Parameters
+    ----------
+    directory : str
+        'behavioral', 'fmri', 'simulation', or 'analysis'
+    name : str
+        file name without .py
+
+    Returns
+    -------
+    module
+    """
+    module_name = f"{directory}_{name}"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, ROOTDIR / directory / f"{name}.py")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+class PerfClock:
+    """A clock on time.perf_counter, like core.Clock"""
+    @staticmethod
+    def getTime():
+        return time.perf_counter()
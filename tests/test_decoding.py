@@ -0,0 +1,46 @@
+"""Leave-one-run-out decoding at chance on noise (analysis/decoding.py and analysis/searchlight.py)"""
+import sys
+
+import numpy as np
+import pytest
+
+from helpers import ROOTDIR, load_module
+
+sys.path.insert(0, str(ROOTDIR / "analysis"))
+decoding = load_module("analysis", "decoding")
+searchlight = load_module("analysis", "searchlight")
+
+# 4 runs of each eye with 12 blocks each, like the scan
+RUNS = np.repeat(np.arange(8), 12)
+EYES = np.where(RUNS % 2, "R", "L")
+
+
+@pytest.mark.parametrize("n_features", [1, 5, 50])
+def test_noise_decodes_at_chance(n_features):
+    rng = np.random.default_rng(n_features)
+    accuracy = [decoding.cross_validate(rng.normal(size=(len(RUNS), n_features)), EYES, RUNS)["accuracy"]
+                for _ in range(200)]
+    assert np.mean(accuracy) == pytest.approx(.5, abs=.02)
+
+
+def test_signal_decodes():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(len(RUNS), 50))
+    x[:, :5] += np.where(EYES == "R", .5, -.5)[:, np.newaxis]
+    assert decoding.cross_validate(x, EYES, RUNS)["accuracy"] > .8
+
+
+def test_single_voxel_searchlights_decode_at_chance():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(len(RUNS), 400))
+    indptr, indices = np.arange(401), np.arange(400)  # every ball is one voxel
+    accuracy = searchlight.searchlight(x, RUNS, EYES, indptr, indices, n_jobs=1)[:, 0]
+    assert accuracy.mean() == pytest.approx(.5, abs=.02)
+
+
+def test_radius_smaller_than_the_voxels():
+    voxels = np.arange(27)
+    with pytest.raises(ValueError, match="single voxel"):
+        searchlight.build_neighbourhoods(voxels, (3, 3, 3), [2.5, 2.5, 2.5], radius=2.)
+    indptr, _ = searchlight.build_neighbourhoods(voxels, (3, 3, 3), [2.5, 2.5, 2.5], radius=2.5)
+    assert np.diff(indptr).min() > 1
@@ -0,0 +1,39 @@
+"""Sessions in the events names and the voxel stores (fmri/make_events.py and analysis/store.py)"""
+import sys
+
+import numpy as np
+
+from helpers import ROOTDIR, load_module
+
+sys.path.insert(0, str(ROOTDIR / "fmri"))
+make_events = load_module("fmri", "make_events")
+store = load_module("analysis", "store")
+
+LOG = "sub-01_ses-{ses}_task-contrast_change_part-fmri_exp-DoubleDriftODC" + make_events.LOG_SUFFIX
+
+
+def write_log(file_name, n_runs):
+    lines = [f"0.000\t{make_events.BIDS_LEVEL}\t{make_events.BIDS_HEADER}"]
+    for run in range(1, n_runs + 1):
+        lines += [f"{run}.000\tEXP\tRun {run} started", f"{run}.500\t{make_events.BIDS_LEVEL}\t0.000\t4.000\tcue\tL\tL"]
+    file_name.write_text("\n".join(lines) + "\n", encoding='utf8')
+
+
+def test_sessions_keep_their_runs_apart(tmp_path):
+    fmri = tmp_path / "sub-01" / "fmri"
+    fmri.mkdir(parents=True)
+    for ses, n_runs in [("01", 2), ("02", 1)]:
+        log = fmri / LOG.format(ses=ses)
+        write_log(log, n_runs)
+        events = make_events.write_events(log)
+        assert [f.name for f in events] == [f"sub-01_ses-{ses}_task-contrastchange_run-{r:02d}_events.tsv"
+                                            for r in range(1, n_runs + 1)]
+        for f in events:
+            np.save(str(f).replace("_events.tsv", "_bold.npy"), np.full((3, 2, 2, 1), float(ses), dtype=np.float32))
+
+    assert store.find_sessions(tmp_path) == [(tmp_path / "sub-01", "01"), (tmp_path / "sub-01", "02")]
+    for ses, n_runs in [("01", 2), ("02", 1)]:
+        voxels = store.open_store(tmp_path / "sub-01", ses)
+        assert voxels.directory == tmp_path / "derivatives" / "store" / "sub-01" / f"ses-{ses}"
+        assert len(voxels) == n_runs
+        assert (voxels.get() == float(ses)).all()
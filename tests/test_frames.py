@@ -0,0 +1,40 @@
+"""Dropped frames of the trial phases joined to the trials (behavioral/frames.py and fmri/frames.py)"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from helpers import ROOTDIR, load_module
+
+sys.path.insert(0, str(ROOTDIR / "simulation"))
+simulate = load_module("simulation", "simulate")
+
+SESSION = "sub-01_task-IllusionSize_part-psychophysics_exp-DoubleDriftODC"
+CONDITIONS = ["V_INTERNAL", "V_EXTERNAL", "QUADRANT"]
+
+
+@pytest.fixture(scope="module")
+def adaptive_session(tmp_path_factory):
+    """An adaptive prescan session, which skips the trials of the conditions that are precise enough"""
+    root = tmp_path_factory.mktemp("sim")
+    (root / "data").mkdir()
+    res = simulate.run_session("prescan", root=root, answers={"Adaptive: ": True}, seed=3)
+    return Path(res["data_dir"]) / SESSION
+
+
+@pytest.mark.parametrize("directory", ["behavioral", "fmri"])
+def test_phases_get_the_conditions_of_their_trials(adaptive_session, directory):
+    frames = load_module(directory, "frames")
+    base = str(adaptive_session)
+    design = pd.DataFrame(np.load(base + "_design.npz")["data"])
+    data = pd.read_csv(base + ".csv")
+    assert len(data) < len(design)  # some trials were skipped
+
+    phases = frames.analyze_session(base + frames.INTERVALS_SUFFIX, base + frames.MARKERS_SUFFIX, base + ".csv")
+    assert phases.loc[phases["trial"] < 0, "TRIAL"].isna().all()  # the warm-up frames belong to no trial
+    phases = phases[phases["trial"] >= 0]
+    np.testing.assert_array_equal(phases["TRIAL"], phases["trial"] + 1)
+    for col in CONDITIONS:
+        np.testing.assert_array_equal(phases[col], design[col].to_numpy()[phases["trial"]])
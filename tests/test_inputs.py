@@ -0,0 +1,168 @@
+"""Response capture from a button box on a pseudo-terminal, a keyboard, and a mouse wheel (fmri/inputs.py and
+behavioral/inputs.py)"""
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from helpers import load_module, PerfClock
+
+pty = pytest.importorskip("pty")
+pytest.importorskip("serial")
+inputs = load_module("fmri", "inputs")
+
+
+class FakeKeyboard:
+    """Keys pressed from the test, read like psychopy.hardware.keyboard.Keyboard with its own clock"""
+    def __init__(self, offset=-100.):
+        self.clock = SimpleNamespace(getTime=lambda: time.perf_counter() + offset)
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def press(self, name):
+        with self._lock:
+            self._keys.append(SimpleNamespace(name=name, rt=self.clock.getTime()))
+
+    def getKeys(self, keyList=None, waitRelease=False):
+        with self._lock:
+            got = [key for key in self._keys if keyList is None or key.name in keyList]
+            self._keys = [key for key in self._keys if key not in got]
+        return got
+
+
+class FakeWinHandle:
+    """The pyglet window of a psychopy window, which calls its scroll handlers when it dispatches its events"""
+    def __init__(self):
+        self.handlers = []
+
+    def push_handlers(self, on_mouse_scroll):
+        self.handlers.append(on_mouse_scroll)
+
+    def remove_handlers(self, on_mouse_scroll):
+        self.handlers.remove(on_mouse_scroll)
+
+    def scroll(self, steps):
+        for handler in self.handlers:
+            handler(0, 0, 0., steps)
+
+
+def collect(listener, duration=.2):
+    """Drains the listener like a frame loop"""
+    events = []
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        events += listener.drain()
+        time.sleep(1 / 165)
+    return events + listener.drain()
+
+
+@pytest.fixture
+def box():
+    master, device = pty.openpty()
+    yield master, os.ttyname(device)
+    os.close(master)
+
+
+def test_buttons(box):
+    master, device = box
+    listener = inputs.InputListener(PerfClock(), keys=[], serial_path=device)
+    listener.start()
+
+    sent = []
+    for byte in [b'1', b'2', b'x', b'3', b'4', b'1']:
+        time.sleep(.01)
+        sent.append(time.perf_counter())
+        os.write(master, byte)
+    events = collect(listener)
+    listener.stop()
+
+    assert [ev.source for ev in events] == ["serial"] * 5
+    assert [ev.value for ev in events] == ['1', '2', '3', '4', '1']  # 'x' isn't a button
+    times = np.array([ev.time for ev in events])
+    assert np.all(np.diff(times) > 0)
+    assert np.all(times >= np.delete(sent, 2))
+
+
+def test_keys():
+    kb = FakeKeyboard()
+    listener = inputs.InputListener(PerfClock(), keys=['1', '2'], keyboard=kb)
+    listener.start()
+
+    pressed = []
+    for name in ['1', '5', '2', '1']:
+        time.sleep(.01)
+        pressed.append(time.perf_counter())
+        kb.press(name)
+    events = collect(listener)
+    listener.stop()
+
+    # the scanner's '5' stays in the keyboard for the trigger listener
+    assert [ev.value for ev in events] == ['1', '2', '1']
+    assert [key.name for key in kb.getKeys()] == ['5']
+    # the keyboard's timestamps are moved to the listener's clock
+    times = np.array([ev.time for ev in events])
+    assert np.all(np.diff(times) > 0)
+    assert times == pytest.approx(np.delete(pressed, 1), abs=.005)
+
+
+def test_keys_and_buttons_in_order(box):
+    master, device = box
+    kb = FakeKeyboard()
+    listener = inputs.InputListener(PerfClock(), keys=['space'], serial_path=device, keyboard=kb)
+    listener.start()
+
+    for press in range(6):
+        time.sleep(.01)
+        if press % 2:
+            kb.press('space')
+        else:
+            os.write(master, b'1')
+    events = collect(listener)
+    listener.stop()
+
+    assert [ev.source for ev in events] == ["serial", "keyboard"] * 3
+    assert np.all(np.diff([ev.time for ev in events]) > 0)
+
+
+def test_injected_events_in_order():
+    listener = inputs.InputListener(PerfClock(), keys=[])
+    thread, sent = inputs.inject_events(listener, [(.03, "wheel", 1.), (.01, "keyboard", "1"), (.02, "serial", "2")])
+    thread.join()
+
+    events = listener.drain()
+    assert [ev.source for ev in events] == ["keyboard", "serial", "wheel"]
+    assert [ev.time for ev in events] == sent
+    assert listener.drain() == []
+
+
+def test_stop_joins_the_thread(box):
+    _, device = box
+    listener = inputs.InputListener(PerfClock(), keys=None, serial_path=device, keyboard=FakeKeyboard())
+    listener.start()
+    thread = listener._thread
+    assert thread.is_alive()
+
+    listener.stop()
+    assert not thread.is_alive()
+    assert listener._thread is None
+    assert listener._port is None
+
+
+@pytest.mark.parametrize("directory", ["behavioral", "fmri"])
+def test_wheel_steps(directory):
+    win = SimpleNamespace(winHandle=FakeWinHandle())
+    listener = load_module(directory, "inputs").InputListener(PerfClock(), keys=[], win=win)
+    listener.start()
+    assert listener.sources == ["wheel"]
+
+    for steps in [1., 1., -2.]:  # two steps in one frame stay two events
+        win.winHandle.scroll(steps)
+    events = listener.drain()
+    listener.stop()
+
+    assert [(ev.source, ev.value) for ev in events] == [("wheel", 1.), ("wheel", 1.), ("wheel", -2.)]
+    assert np.all(np.diff([ev.time for ev in events]) >= 0)
+    assert win.winHandle.handlers == []
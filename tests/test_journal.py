@@ -0,0 +1,100 @@
+"""Trial journal: appending, resuming, and rewinding (behavioral/dd_helpers.py and fmri/mr_helpers.py)"""
+import numpy as np
+import pytest
+
+from helpers import load_module
+
+COLS = ["COND", "RT", "TRIAL", "SUBJECT_ID"]
+
+
+@pytest.fixture(params=[("behavioral", "dd_helpers"), ("fmri", "mr_helpers")], ids=["behavioral", "fmri"])
+def helpers(request):
+    return load_module(*request.param)
+
+
+def make_table(helpers, n_trials=6):
+    design = helpers.build_design({"COND": ["a", "b"]}, n_reps=n_trials // 2, shuffle=False)
+    table = helpers.TrialTable(COLS, design, meta={"SUBJECT_ID": 1}, dtypes={"TRIAL": np.int64})
+    table["TRIAL"][:] = np.arange(1, n_trials + 1)
+    return table
+
+
+def fill(journal, trials):
+    for trial in trials:
+        journal.table["RT"][trial] = trial + .4
+        journal.append(trial)
+
+
+def test_rewind_resets_the_dropped_trials(helpers, tmp_path):
+    journal = helpers.TrialJournal(str(tmp_path / "sub-01"), make_table(helpers))
+    journal.open()
+    design = journal.table.data.copy()
+    fill(journal, range(5))
+    journal.table["RT"][5] = 5.4  # a response in the trial that was interrupted
+
+    journal.rewind(3)
+    assert journal.n_done == 3
+    np.testing.assert_array_equal(journal.table["RT"], [.4, 1.4, 2.4, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(journal.table["COND"], design["COND"])
+    np.testing.assert_array_equal(journal.table["TRIAL"], design["TRIAL"])
+
+    # the repeated trials are journaled after the kept ones
+    fill(journal, range(3, 6))
+    journal.close()
+    lines = open(journal.journal_file, encoding='utf8').read().splitlines()
+    assert [line.split(',')[0] for line in lines[1:]] == ['0', '1', '2', '3', '4', '5']
+
+
+def test_rewind_after_resuming(helpers, tmp_path):
+    journal = helpers.TrialJournal(str(tmp_path / "sub-01"), make_table(helpers))
+    journal.open()
+    fill(journal, range(5))
+    journal.close()
+
+    # the session is started again and repeats its unfinished run
+    resumed = helpers.TrialJournal(str(tmp_path / "sub-01"), make_table(helpers))
+    assert resumed.open(resume=True) == 5
+    np.testing.assert_array_equal(resumed.table["RT"], [.4, 1.4, 2.4, 3.4, 4.4, np.nan])
+
+    resumed.rewind(3)
+    np.testing.assert_array_equal(resumed.table["RT"], [.4, 1.4, 2.4, np.nan, np.nan, np.nan])
+    resumed.close()
+
+    again = helpers.TrialJournal(str(tmp_path / "sub-01"), make_table(helpers))
+    assert again.open(resume=True) == 3
+    np.testing.assert_array_equal(again.table["RT"], [.4, 1.4, 2.4, np.nan, np.nan, np.nan])
+    again.close()
+
+
+def test_rewind_past_the_journal(helpers, tmp_path):
+    journal = helpers.TrialJournal(str(tmp_path / "sub-01"), make_table(helpers))
+    journal.open()
+    fill(journal, range(2))
+    journal.rewind(4)
+    assert journal.n_done == 2
+    np.testing.assert_array_equal(journal.table["RT"][:2], [.4, 1.4])
+    journal.close()
+
+
+def test_finished_sessions_are_not_continued(helpers, tmp_path):
+    file_name = str(tmp_path / "sub-01")
+    assert helpers.TrialJournal.saved_progress(file_name) is None
+
+    journal = helpers.TrialJournal(file_name, make_table(helpers))
+    journal.open()
+    fill(journal, range(2))
+    journal.close()
+    assert helpers.TrialJournal.saved_progress(file_name) == (2, 6, False)
+
+    # e.g. the adaptive prescan skipped the last trials
+    journal.finish()
+    assert helpers.TrialJournal.saved_progress(file_name) == (2, 6, True)
+    with pytest.raises(FileExistsError):
+        helpers.TrialJournal(file_name, make_table(helpers)).open(resume=True)
+
+    # a session with all of its trials journaled is finished too
+    journal = helpers.TrialJournal(file_name, make_table(helpers))
+    journal.open(resume=False)
+    fill(journal, range(6))
+    journal.close()
+    assert helpers.TrialJournal.saved_progress(file_name) == (6, 6, True)
@@ -0,0 +1,38 @@
+"""Real-time mode where the CPUs can't be pinned (behavioral/realtime.py and fmri/realtime.py)"""
+import gc
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from helpers import ROOTDIR, load_module
+
+sys.path.insert(0, str(ROOTDIR / "simulation"))
+from stubs import PsychopyStubs  # noqa: E402
+
+
+@pytest.fixture(params=["behavioral", "fmri"])
+def realtime(request):
+    stubs = PsychopyStubs()
+    replaced = stubs.install()
+    try:
+        yield load_module(request.param, "realtime")
+    finally:
+        stubs.uninstall(replaced)
+
+
+def test_start_without_an_affinity_call(realtime, monkeypatch):
+    # like macOS: no sched_setaffinity, and a psutil without cpu_affinity
+    monkeypatch.delattr(os, "sched_setaffinity", raising=False)
+    monkeypatch.setattr(realtime, "psutil", SimpleNamespace(Process=type("Process", (), {})))
+
+    mode = realtime.RealTimeMode(cpus=[1])
+    try:
+        message = mode.start()
+    finally:
+        if mode._on_gc in gc.callbacks:
+            gc.callbacks.remove(mode._on_gc)
+        gc.unfreeze()
+    assert "CPU affinity not set" in message
+    assert "garbage collection only in idle phases" in message
@@ -0,0 +1,97 @@
+"""Trigger listener against a fake scanner on a pseudo-terminal (fmri/triggers.py)"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from helpers import load_module, PerfClock
+
+pytest.importorskip("pty")
+pytest.importorskip("serial")
+triggers = load_module("fmri", "triggers")
+
+TR = .05
+N_TRS = 10
+
+
+@pytest.fixture
+def listener():
+    device, sent = triggers.fake_scanner(TR, N_TRS)
+    listener = triggers.TriggerListener(PerfClock(), serial_path=device, tr=TR)
+    listener.sent = sent
+    listener.start()
+    yield listener
+    listener.stop()
+
+
+def test_counts_every_tr(listener):
+    assert listener.latest() is None
+    assert listener.tr_time(1) is None
+
+    assert listener.wait_for(N_TRS, timeout=N_TRS * TR + 2) is not None
+    assert listener.n_trs == N_TRS
+    assert len(listener.pulses()) == N_TRS
+
+
+def test_latest(listener):
+    t_first = listener.wait_for(1, timeout=2)
+    n, t = listener.latest()
+    assert n >= 1
+    assert t >= t_first
+
+    listener.wait_for(N_TRS, timeout=N_TRS * TR + 2)
+    assert listener.latest() == (N_TRS, listener.pulses()[-1])
+
+
+def test_tr_times(listener):
+    t_first = listener.wait_for(1, timeout=2)
+    # a TR that hasn't come yet is predicted from the last pulse
+    n, t_last = listener.latest()
+    assert listener.tr_time(n + 3) == pytest.approx(t_last + 3 * TR)
+
+    listener.wait_for(N_TRS, timeout=N_TRS * TR + 2)
+    times = np.array([listener.tr_time(n) for n in range(1, N_TRS + 1)])
+    assert times[0] == t_first
+    assert np.all(np.diff(times) > 0)
+    assert np.mean(np.diff(times)) == pytest.approx(TR, rel=.2)
+    # timestamped when they were sent (the scanner notes the time right after writing, so either can be first)
+    assert np.all(np.abs(times - np.array(listener.sent)) < TR / 2)
+
+
+def test_wait_for_times_out():
+    device, _ = triggers.fake_scanner(TR, N_TRS, hold=2)
+    listener = triggers.TriggerListener(PerfClock(), serial_path=device, tr=TR)
+    listener.start()
+    try:
+        listener.wait_for(N_TRS, timeout=N_TRS * TR + 2)
+        t_start = time.perf_counter()
+        assert listener.wait_for(N_TRS + 1, timeout=.2) is None
+        assert time.perf_counter() - t_start >= .2
+    finally:
+        listener.stop()
+
+
+def test_lost_port_is_raised(listener):
+    # the fake scanner closes the port one TR after its last trigger
+    t_start = time.perf_counter()
+    with pytest.raises(OSError, match="trigger listener stopped"):
+        listener.wait_for(N_TRS + 1, timeout=N_TRS * TR + 2)
+    assert time.perf_counter() - t_start < N_TRS * TR + 1
+    with pytest.raises(OSError):
+        listener.latest()
+    assert listener.n_trs == N_TRS
+
+
+def test_stop_joins_the_thread():
+    device, _ = triggers.fake_scanner(TR, 2)
+    listener = triggers.TriggerListener(PerfClock(), serial_path=device, tr=TR)
+    listener.start()
+    thread = listener._thread
+    assert thread.is_alive()
+
+    listener.stop()
+    assert not thread.is_alive()
+    assert listener._thread is None
+    assert listener._port is None
+    assert "trigger_listener" not in [t.name for t in threading.enumerate()]